@@ -1,13 +1,17 @@
 import os
+from pathlib import Path
 import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
 
+from neural_feature_identification.data_discovery import DISCOVERY_INDEX_FILENAME, discover_sessions, file_sizes
+
 # --- Configuration ---
 # IMPORTANT: Please update these paths to match your project structure.
 MANIFEST_PATH = "reports/manifest.tsv"  # Path to your manifest file
 DATA_ROOT = "/uufs/chpc.utah.edu/common/home/george-group1/data-usea"
 OUTPUT_PLOT_PATH = "file_size_analysis.png" # Updated filename for new plot
+DISCOVERY_INDEX_PATH = os.path.join("reports", DISCOVERY_INDEX_FILENAME)  # Cached directory index
 
 def analyze_dataset_sizes():
     """
@@ -31,21 +35,22 @@ def analyze_dataset_sizes():
     file_sizes_gb = []
     print(f"Found {len(manifest)} jobs in the manifest. Checking file sizes...")
 
+    # File sizes come from the cached directory index shared with generate_manifest_tsv.py
+    index = discover_sessions(Path(DATA_ROOT), manifest['session_dir'].tolist(), Path(DISCOVERY_INDEX_PATH))
+    sizes = file_sizes(index)
+
     # Loop through each job defined in the manifest
     for job_id, row in manifest.iterrows():
         try:
             session_dir = row['session_dir']
             filename = row['training_filename']
 
-            # Construct the full, absolute path to the data file
-            full_path = os.path.join(DATA_ROOT, session_dir, filename)
-
-            if os.path.exists(full_path):
+            if (session_dir, filename) in sizes:
                 # Get size in bytes and convert to gigabytes
-                size_bytes = os.path.getsize(full_path)
-                size_gb = size_bytes / (1024**3)
+                size_gb = sizes[(session_dir, filename)] / (1024**3)
                 file_sizes_gb.append(size_gb)
             else:
+                full_path = os.path.join(DATA_ROOT, session_dir, filename)
                 print(f"  [WARNING] File not found for job_id {job_id}: {full_path}")
 
         except KeyError as e:
@@ -1,35 +1,30 @@
 import yaml
-import h5py
 from pathlib import Path
 import sys
 
+from neural_feature_identification.integrity import INTEGRITY_REPORT_FILENAME, scan_feature_files
+
 CONFIG_FILE = "config.yaml"
 
 def check_feature_files(base_path: Path):
     """
-    Recursively find HDF5 files within '/features' subdirectories inside the base path and checks them for corruption.
+    Checks the HDF5 files in the '/features' subdirectories of the base path for corruption, truncation
+    (sample count vs. kinematics.h5) and NaN/Inf values. Only files changed since the last run are re-read
+    (see neural_feature_identification.integrity).
     """
-    print(f"\nSearchin for feature files in {base_path}")
-    files_to_check = list(base_path.rglob("features/*.h5"))
+    print(f"\nSearching for feature files in {base_path}")
+    index = scan_feature_files(base_path)
 
-    if not files_to_check:
+    if len(index) == 0:
         print("\tNo feature files found. Verify the 'scratch_root' path in config.yaml")
         return []
 
-    print(f"\tFound {len(files_to_check)} feature files to verify.")
-
+    print(f"\tVerified {len(index)} feature files.")
     corrupted_file_list = []
-    required_keys = {'features', 'computation_times'}
-    for filepath in files_to_check:
-        try:
-            with h5py.File(filepath, 'r') as f:
-                file_keys = set(f.keys())
-                if not required_keys.issubset(file_keys):
-                    print(f"\tIncomplete keys in file: {filepath}")
-                    corrupted_file_list.append(str(filepath))
-        except OSError:
-            print(f"\tFile {filepath} is corrupted.")
-            corrupted_file_list.append(str(filepath))
+    for path, status, message in index.select(['path', 'status', 'message']).iter_rows():
+        if status != 'ok':
+            print(f"\t{status}: {path} ({message})")
+            corrupted_file_list.append(path)
 
     return corrupted_file_list
 
@@ -38,7 +33,7 @@ def main():
         with open(CONFIG_FILE, 'r') as f:
             config = yaml.safe_load(f)
         scratch_root = Path(config["paths"]["scratch_root"])
-        results_root = Path(config["paths"]["scratch_root"])
+        results_root = Path(config["paths"]["results_root"])
     except FileNotFoundError:
         print(f"Error:  Config file ({CONFIG_FILE}) not found", file=sys.stderr)
         sys.exit(1)
@@ -50,11 +45,11 @@ def main():
 
     print("\n===== Summary =====")
     if corrupted_file_list:
-        output_filename = "corrupted_file_list.txt"
-        output_filepath = results_root / output_filename
+        output_filepath = results_root / INTEGRITY_REPORT_FILENAME
 
         print(f"Found {len(corrupted_file_list)} corrupted feature files.")
-        with open(output_filename, 'w') as f:
+        output_filepath.parent.mkdir(parents=True, exist_ok=True)
+        with open(output_filepath, 'w') as f:
             for file in corrupted_file_list:
                 f.write(f"{file}\n")
         print(f"The file list has been saved to '{output_filepath}'")
@@ -62,4 +57,4 @@ def main():
         print("No corrupted files were found\n")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,22 +1,33 @@
-import os
+from pathlib import Path
 import pandas as pd
 import sqlite3
 import yaml
 
-def get_full_stream_filename(session_dir):
-    session_dir_path = os.path.join(config["paths"]["data_root"], session_dir)
-    try:
-        ns5_files = [f for f in os.listdir(session_dir_path) if f.endswith('ns5')]
-        if ns5_files:
-            if len(ns5_files) > 1:
-                print(f"\t\tWarning 3: More than one NS5 found in {session_dir_path}")
-            return ns5_files[0]
-        else:
+from neural_feature_identification.data_discovery import DISCOVERY_INDEX_FILENAME, discover_sessions, session_files
+
+def get_full_stream_filenames(session_dirs):
+    """
+    First NS5 file of each session directory, from the cached directory index (reports/data_index.parquet).
+    Directories are listed concurrently and only re-listed when they changed since the last run.
+    """
+    data_root = Path(config["paths"]["data_root"])
+    index = discover_sessions(data_root, session_dirs, Path("reports") / DISCOVERY_INDEX_FILENAME)
+    listed = set(index.filter(index["dir_mtime_ns"] >= 0)["session_dir"].to_list())
+    ns5_files = session_files(index, "ns5")
+    full_stream_filenames = {}
+    for session_dir in dict.fromkeys(session_dirs):
+        session_dir_path = data_root / session_dir
+        if session_dir not in listed:
+            print(f"Warning 0: Directory not found -> {session_dir_path}")
+            full_stream_filenames[session_dir] = None
+        elif session_dir not in ns5_files:
             print(f"\tWarning 1: NS5 not found -> {session_dir_path}")
-            return None
-    except FileNotFoundError:
-        print(f"Warning 0: Directory not found -> {session_dir_path}")
-        return None
+            full_stream_filenames[session_dir] = None
+        else:
+            if len(ns5_files[session_dir]) > 1:
+                print(f"\t\tWarning 3: More than one NS5 found in {session_dir_path}")
+            full_stream_filenames[session_dir] = ns5_files[session_dir][0]
+    return full_stream_filenames
 
 with open("config.yaml") as f:
     config = yaml.safe_load(f)
@@ -31,7 +42,7 @@ file_list["session_dir"] = file_list["session_dir"].apply(
 
 file_list["job_id"] = file_list.index + 1
 file_list["events_filename"] = file_list["training_filename"].apply(lambda x: x.replace(".kdf", ".kef"))
-file_list["full_stream_filename"] = file_list["session_dir"].apply(get_full_stream_filename)
+file_list["full_stream_filename"] = file_list["session_dir"].map(get_full_stream_filenames(file_list["session_dir"].tolist()))
 
 file_list = file_list[["job_id", "participant_id", "session_dir", "training_filename", "baseline_filename", "events_filename", "full_stream_filename"]]
 file_list.to_csv("./reports/manifest.tsv", sep="\t", index=False)
\ No newline at end of file
@@ -0,0 +1,201 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+from pathlib import Path
+import time
+
+from loguru import logger
+import polars as pl
+import typer
+
+app = typer.Typer()
+
+# Cached index of the raw files in the session directories under data_root, one row per file.
+# Directories are listed concurrently with os.scandir. On a refresh, a directory whose mtime is unchanged
+# keeps its cached rows: adding, removing or renaming files changes the directory mtime, rewriting a file
+# in place does not (the raw data is immutable; use full=True after in-place edits).
+DISCOVERY_INDEX_FILENAME = "data_index.parquet"
+DISCOVERY_MAX_WORKERS = 16
+RAW_FILE_SUFFIXES = ['.ns5', '.ns2', '.kdf', '.kef']
+RAW_FILE_PREFIXES = {'RecStart_': 'recstart', 'Kalman_SSStruct_': 'ssstruct'}  # .mat files used for the NIP offset
+MANIFEST_FILE_COLUMNS = ['training_filename', 'baseline_filename', 'events_filename', 'full_stream_filename']
+INDEX_SCHEMA = {
+    'session_dir': pl.Utf8,
+    'dir_mtime_ns': pl.Int64,  # -1 if the directory could not be listed
+    'filename': pl.Utf8,  # null for directories without raw files, so they are cached too
+    'kind': pl.Utf8,
+    'size': pl.Int64,
+    'mtime_ns': pl.Int64,
+}
+
+
+def raw_file_kind(filename: str) -> str | None:
+    """:return: 'ns5', 'ns2', 'kdf', 'kef', 'recstart' or 'ssstruct', or None for other files"""
+    suffix = os.path.splitext(filename)[1].lower()
+    if suffix in RAW_FILE_SUFFIXES:
+        return suffix[1:]
+    if suffix == '.mat':
+        for prefix, kind in RAW_FILE_PREFIXES.items():
+            if filename.startswith(prefix):
+                return kind
+    return None
+
+
+def _dir_mtime_ns(dirpath: Path) -> int:
+    try:
+        return dirpath.stat().st_mtime_ns
+    except OSError:
+        return -1
+
+
+def scan_session_dir(data_root: Path, session_dir: str) -> list[dict]:
+    """:return: index rows of the raw files in data_root/session_dir"""
+    dirpath = data_root / session_dir
+    dir_mtime_ns = _dir_mtime_ns(dirpath)
+    rows = []
+    try:
+        with os.scandir(dirpath) as entries:
+            for entry in entries:
+                kind = raw_file_kind(entry.name)
+                if kind is None or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                rows.append({'session_dir': session_dir, 'dir_mtime_ns': dir_mtime_ns, 'filename': entry.name,
+                             'kind': kind, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns})
+    except OSError:
+        dir_mtime_ns = -1
+    return rows or [{'session_dir': session_dir, 'dir_mtime_ns': dir_mtime_ns, 'filename': None, 'kind': None,
+                     'size': None, 'mtime_ns': None}]
+
+
+def read_discovery_index(index_filepath: Path) -> pl.DataFrame:
+    """:return: the discovery index, or an empty index if it does not exist"""
+    if index_filepath is None or not index_filepath.exists():
+        return pl.DataFrame(schema=INDEX_SCHEMA)
+    return pl.read_parquet(index_filepath)
+
+
+def discover_sessions(
+        data_root: Path,
+        session_dirs: list[str],
+        index_filepath: Path | None = None,
+        max_workers: int = DISCOVERY_MAX_WORKERS,
+        full: bool = False
+) -> pl.DataFrame:
+    """
+    Lists the raw files of session directories, reusing the cached rows of directories that did not change.
+    :param data_root: root dir of the raw data
+    :param session_dirs: session directories relative to data_root
+    :param index_filepath: cached index, updated in place. Not cached if None
+    :param max_workers: directories listed concurrently
+    :param full: re-list every directory
+    :return: index rows of session_dirs
+    """
+    timer = time.perf_counter()
+    session_dirs = list(dict.fromkeys(session_dirs))
+    cached = read_discovery_index(index_filepath)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        dir_mtimes = dict(zip(session_dirs, executor.map(lambda d: _dir_mtime_ns(data_root / d), session_dirs)))
+        cached_mtimes = dict(cached.select(['session_dir', 'dir_mtime_ns']).unique('session_dir').iter_rows())
+        to_scan = [d for d in session_dirs
+                   if full or dir_mtimes[d] < 0 or cached_mtimes.get(d) != dir_mtimes[d]]
+        scanned = [row for rows in executor.map(lambda d: scan_session_dir(data_root, d), to_scan) for row in rows]
+    index = pl.concat([cached.filter(~pl.col('session_dir').is_in(to_scan)),
+                       pl.DataFrame(scanned, schema=INDEX_SCHEMA)])
+    logger.info(f"Listed {len(to_scan)}/{len(session_dirs)} session directories "
+                f"in {time.perf_counter() - timer:0.1f} sec")
+    if index_filepath is not None:
+        index_filepath.parent.mkdir(parents=True, exist_ok=True)
+        # Unique per process: concurrent refreshes must not write the same temporary file
+        tmp_filepath = index_filepath.with_name(f".{index_filepath.name}.{os.getpid()}.tmp")
+        index.sort(['session_dir', 'filename']).write_parquet(tmp_filepath)
+        os.replace(tmp_filepath, index_filepath)
+    return index.filter(pl.col('session_dir').is_in(session_dirs))
+
+
+def session_files(index: pl.DataFrame, kind: str | None = None) -> dict[str, list[str]]:
+    """:return: {session_dir: sorted filenames} of the indexed files, optionally of one kind only"""
+    files = index.filter(pl.col('filename').is_not_null())
+    if kind is not None:
+        files = files.filter(pl.col('kind') == kind)
+    grouped = files.group_by('session_dir').agg(pl.col('filename').sort())
+    return dict(grouped.iter_rows())
+
+
+def file_sizes(index: pl.DataFrame) -> dict[tuple[str, str], int]:
+    """:return: {(session_dir, filename): size in bytes} of the indexed files"""
+    files = index.filter(pl.col('filename').is_not_null())
+    return {(session_dir, filename): size
+            for session_dir, filename, size in files.select(['session_dir', 'filename', 'size']).iter_rows()}
+
+
+def missing_manifest_files(manifest: pl.DataFrame, index: pl.DataFrame) -> dict[int, list[str]]:
+    """
+    :param manifest: manifest.tsv rows (job_id, session_dir and the MANIFEST_FILE_COLUMNS present)
+    :param index: discovery index covering the manifest's session directories
+    :return: {job_id: missing filenames} of the jobs with missing raw files
+    """
+    sizes = file_sizes(index)
+    columns = [column for column in MANIFEST_FILE_COLUMNS if column in manifest.columns]
+    missing = {}
+    for row in manifest.select(['job_id', 'session_dir', *columns]).iter_rows(named=True):
+        filenames = [row[column] for column in columns]
+        absent = [filename or f"<{column}>" for column, filename in zip(columns, filenames)
+                  if not filename or (row['session_dir'], filename) not in sizes]
+        if absent:
+            missing[row['job_id']] = absent
+    return missing
+
+
+def check_manifest_inputs(
+        data_root: Path,
+        manifest_filepath: Path,
+        index_filepath: Path | None = None,
+        max_workers: int = DISCOVERY_MAX_WORKERS,
+        refresh: bool = True
+) -> dict[int, list[str]]:
+    """
+    Refreshes the index for the sessions of a manifest and returns missing_manifest_files
+    :param refresh: if False, only read the cached index; sessions it does not cover are not reported
+    """
+    manifest = pl.read_csv(manifest_filepath, separator='\t', infer_schema_length=0).with_columns(
+        pl.col('job_id').cast(pl.Int64))
+    if refresh:
+        index = discover_sessions(data_root, manifest['session_dir'].to_list(), index_filepath, max_workers)
+    else:
+        index = read_discovery_index(index_filepath)
+        manifest = manifest.filter(pl.col('session_dir').is_in(index['session_dir'].unique().implode()))
+    return missing_manifest_files(manifest, index)
+
+
+@app.command()
+def scan(
+    data_root: Path,
+    manifest_filepath: Path,
+    index_filepath: Path = Path("reports") / DISCOVERY_INDEX_FILENAME,
+    max_workers: int = DISCOVERY_MAX_WORKERS,
+    full: bool = False,
+):
+    """Refresh the raw file index for the session directories of a manifest."""
+    session_dirs = pl.read_csv(manifest_filepath, separator='\t', infer_schema_length=0)['session_dir'].to_list()
+    index = discover_sessions(data_root, session_dirs, index_filepath, max_workers, full)
+    logger.success(f"{index['filename'].drop_nulls().len()} raw files indexed in {index_filepath}")
+
+
+@app.command()
+def check(
+    data_root: Path,
+    manifest_filepath: Path,
+    index_filepath: Path = Path("reports") / DISCOVERY_INDEX_FILENAME,
+    max_workers: int = DISCOVERY_MAX_WORKERS,
+):
+    """Report the manifest jobs whose raw files are missing."""
+    missing = check_manifest_inputs(data_root, manifest_filepath, index_filepath, max_workers)
+    for job_id, filenames in sorted(missing.items()):
+        logger.warning(f"job_id {job_id}: missing {', '.join(filenames)}")
+    if missing:
+        raise typer.Exit(code=1)
+    logger.success("All raw files of the manifest were found")
+
+
+if __name__ == "__main__":
+    app()
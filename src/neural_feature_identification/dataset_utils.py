@@ -1,41 +1,250 @@
 # from neural_feature_identification.config import PROCESSED_DATA_DIR, RAW_DATA_DIR
-import h5py
-import numpy as np
-import random
-import yaml
 from collections import defaultdict
-from loguru import logger
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from functools import lru_cache
+import hashlib
+import json
+import os
 from pathlib import Path
+import random
+
+import h5py
+from loguru import logger
+import numpy as np
+import polars as pl
 from tqdm import tqdm
+import yaml
 
 logger.remove()
 # Configure logger. add() configures logger destinations (a.k.a. sinks).
 # 'level' sets the min level for this sink; messages with lower levels (e.g., DEBUG) will be ignored
 logger.add(lambda msg: print(msg, end=""), colorize=True, level="INFO")
 
+# Split plan cache (see load_train_test_split)
+SPLIT_PLAN_DIRNAME = "split_plans"
+SPLIT_PLAN_SOURCES = ("kinematics.h5", "events.h5")
+SPLIT_PLAN_CACHE_SIZE = 64
+TRIAL_INFO_INDEX_KEYS = ('start_idx', 'stop_idx', 'relative_start_idx', 'relative_stop_idx')
+
+# Feature store layout (see features.write_feature_file). Files carrying the version attribute hold
+# 'features' as (samples x features), C-order, chunked along time and compressed. Files without it are
+# the (features x samples) column-major files written by extract_features.m.
+# Quantized datasets store float16 values and the float32 'scale' they were divided by.
+FEATURE_STORE_VERSION = 1
+FEATURE_STORE_VERSION_ATTR = 'feature_store_version'
+FEATURE_STORE_SCALE_ATTR = 'scale'
+
 def load_project_config(config_filepath: Path) -> dict:
     with open(config_filepath, 'r') as f:
         return yaml.safe_load(f)
 
-def read_hdf_dataset(filepath: Path, keys: list[str]) -> dict:
+class LazyDataset:
+    """
+    Read-only, array-like view of a 2-D HDF5 dataset that only reads the rows/columns you index.
+    Used for chunked or compressed datasets that cannot be memory-mapped. Integer index arrays (e.g. the
+    stitched train/test indices) are read as one slice per contiguous run. Quantized datasets are scaled
+    back to float32 as they are read.
+    """
+    def __init__(self, filepath: Path, key: str, transposed: bool = False):
+        self.filepath = filepath
+        self.key = key
+        self.transposed = transposed
+        self._file = None
+        with h5py.File(filepath, 'r') as f:
+            self._disk_shape = f[key].shape
+            self.scale = f[key].attrs.get(FEATURE_STORE_SCALE_ATTR)
+            self.dtype = f[key].dtype if self.scale is None else np.dtype(np.float32)
+
+    @property
+    def shape(self) -> tuple:
+        return self._disk_shape[::-1] if self.transposed else self._disk_shape
+
+    @property
+    def ndim(self) -> int:
+        return len(self._disk_shape)
+
+    @property
+    def T(self) -> 'LazyDataset':
+        view = LazyDataset.__new__(LazyDataset)
+        view.__dict__.update(self.__dict__, transposed=not self.transposed, _file=None)
+        return view
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        data = self[...]
+        return data if dtype is None else data.astype(dtype)
+
+    def __getstate__(self):
+        return {**self.__dict__, '_file': None}
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __getitem__(self, index):
+        if self._file is None:
+            self._file = h5py.File(self.filepath, 'r')
+        index = index if isinstance(index, tuple) else (index,)
+        if len(index) == 1 and index[0] is Ellipsis:
+            index = ()
+        index = index + (slice(None),) * (self.ndim - len(index))
+        if self.transposed:
+            return self._read(index[::-1]).T
+        return self._read(index)
+
+    def _read(self, disk_index: tuple) -> np.ndarray:
+        data = self._read_stored(disk_index)
+        return data if self.scale is None else _dequantize(data, self.scale)
+
+    def _read_stored(self, disk_index: tuple) -> np.ndarray:
+        dataset = self._file[self.key]
+        # h5py only supports one increasing index list, so arrays are read as contiguous runs
+        array_axes = [axis for axis, idx in enumerate(disk_index) if isinstance(idx, (list, np.ndarray))]
+        if not array_axes:
+            return dataset[disk_index]
+        axis = array_axes[0]
+        idxs = np.asarray(disk_index[axis]).flatten()
+        if idxs.dtype == bool:
+            idxs = np.flatnonzero(idxs)
+        idxs = np.where(idxs < 0, idxs + self._disk_shape[axis], idxs)
+        if idxs.size == 0:
+            empty_shape = list(self._disk_shape)
+            empty_shape[axis] = 0
+            return np.empty(empty_shape, dtype=dataset.dtype)[tuple(
+                slice(None) if i == axis else idx for i, idx in enumerate(disk_index))]
+        order = np.argsort(idxs, kind='stable')
+        sorted_idxs = idxs[order]
+        run_breaks = np.flatnonzero(np.diff(sorted_idxs) != 1) + 1
+        run_starts = np.concatenate([[0], run_breaks])
+        run_stops = np.concatenate([run_breaks, [len(sorted_idxs)]])
+        parts = []
+        for start, stop in zip(run_starts, run_stops):
+            run_index = list(disk_index)
+            run_index[axis] = slice(sorted_idxs[start], sorted_idxs[stop - 1] + 1)
+            parts.append(dataset[tuple(run_index)])
+        data = np.concatenate(parts, axis=axis)
+        if not np.array_equal(order, np.arange(len(order))):
+            data = np.take(data, np.argsort(order), axis=axis)
+        return data
+
+
+def _dequantize(data: np.ndarray, scale: float) -> np.ndarray:
+    """float16 values of a quantized dataset times their stored scale, as float32"""
+    data = data.astype(np.float32)
+    data *= np.float32(scale)
+    return data
+
+
+def _contiguous_offset(dataset: h5py.Dataset):
+    """
+    Byte offset of an unchunked, uncompressed dataset in its file, or None if it cannot be read directly
+    """
+    if dataset.chunks is not None or dataset.compression is not None or dataset.size == 0:
+        return None
+    return dataset.id.get_offset()
+
+
+def read_hdf_dataset(filepath: Path, keys: list[str], lazy: bool = False) -> dict:
+    """
+    Reads datasets from an HDF5 file.
+    Contiguous datasets (the layout written by MATLAB's h5write) are read straight from their byte offset,
+    which releases the GIL so several files can be read concurrently from threads.
+    :param filepath: HDF5 file
+    :param keys: dataset names to read
+    :param lazy: if True, return read-only np.memmap views (contiguous datasets) or LazyDataset objects
+                 (chunked datasets) that only read the slices you index
+    :return: dict of arrays keyed by dataset name
+    """
     if not filepath.exists():
         raise FileNotFoundError(f"Could not find '{filepath}'")
-    file_data = {}
+    file_data, direct_reads = {}, {}
     with h5py.File(filepath, 'r') as f:
         for key in keys:
-            if key in f:
-                file_data[key] = f[key][:]
-            else:
+            if key not in f:
                 logger.warning(f"'{key}' not found in {filepath.name}")
-    return file_data
+                continue
+            offset = _contiguous_offset(f[key])
+            if offset is not None:
+                direct_reads[key] = (offset, f[key].shape, f[key].dtype)
+            elif lazy:
+                file_data[key] = LazyDataset(filepath, key)
+            elif FEATURE_STORE_SCALE_ATTR in f[key].attrs:
+                file_data[key] = _dequantize(f[key][:], f[key].attrs[FEATURE_STORE_SCALE_ATTR])
+            else:
+                file_data[key] = f[key][:]
+    for key, (offset, shape, dtype) in direct_reads.items():
+        if lazy:
+            file_data[key] = np.memmap(filepath, dtype=dtype, mode='r', offset=offset, shape=shape)
+        else:
+            file_data[key] = np.fromfile(filepath, dtype=dtype, count=int(np.prod(shape)),
+                                         offset=offset).reshape(shape)
+    return {key: file_data[key] for key in keys if key in file_data}
+
+def feature_store_version(filepath: Path) -> int | None:
+    """:return: feature store version of a feature file, or None for the MATLAB (features x samples) layout"""
+    with h5py.File(filepath, 'r') as f:
+        version = f.attrs.get(FEATURE_STORE_VERSION_ATTR)
+    if version is not None and version > FEATURE_STORE_VERSION:
+        raise ValueError(f"{filepath} has feature store version {version}, "
+                         f"this version reads up to {FEATURE_STORE_VERSION}")
+    return None if version is None else int(version)
+
+def read_feature_file(filepath: Path, lazy: bool = False, samples_as_rows: bool = True):
+    """
+    Reads the features of a feature file in either layout.
+    :param filepath: feature HDF5 file
+    :param lazy: return a memory map or LazyDataset (see read_hdf_dataset)
+    :param samples_as_rows: if True, return (N x F), C-contiguous for feature store files. If False, return the
+                            (F x N) orientation of the MATLAB files (a view for feature store files), as expected
+                            by enforce_samples_as_rows
+    :return: feature array
+    """
+    time_major = feature_store_version(filepath) is not None
+    features = read_hdf_dataset(filepath, ['features'], lazy)['features']
+    return features if time_major == samples_as_rows else features.T
+
+def feature_file_shape(filepath: Path) -> tuple[int, int]:
+    """:return: (samples, features) shape of a feature file without reading it"""
+    time_major = feature_store_version(filepath) is not None
+    with h5py.File(filepath, 'r') as f:
+        shape = f['features'].shape
+    return shape if time_major else shape[::-1]
+
+def _read_session_file(filepath: Path, keys: list[str], lazy: bool = False) -> dict:
+    """read_hdf_dataset, with feature files in the (F x N) orientation of the other session files"""
+    if keys == ['features']:
+        return {'features': read_feature_file(filepath, lazy, samples_as_rows=False)}
+    return read_hdf_dataset(filepath, keys, lazy)
 
 def load_session_data(
         session_dirpath: Path,
         project_config: dict,
         events_flag: bool=True,
         kinematics_flag: bool=True,
-        features_flag: bool=True
+        features_flag: bool=True,
+        max_workers: int=1,
+        lazy: bool=False
 ) -> dict:
+    """
+    Loads the events, kinematics and feature sets of a session.
+    :param session_dirpath: session directory on scratch (scratch_root/job_id)
+    :param project_config: project config from load_project_config
+    :param events_flag: load events.h5
+    :param kinematics_flag: load kinematics.h5
+    :param features_flag: load every feature set in analysis.feature_sets
+    :param max_workers: number of files read concurrently. Defaults to 1 (serial)
+    :param lazy: return memory-mapped/lazy arrays instead of reading the datasets (see read_hdf_dataset)
+    :return: dict of {file_name: {key: array}}
+    """
     files_to_load = {}
     if events_flag:
         files_to_load['events'] = {'filepath': session_dirpath / "events.h5",
@@ -49,10 +258,182 @@ def load_session_data(
             files_to_load[key_name] = {'filepath': session_dirpath / "features" / f"{feature_name}.h5", 'keys': ['features']}
 
     session_data = {}
-    for file_name, file_details in tqdm(files_to_load.items(), desc='Loading session data'):
-        session_data[file_name] = read_hdf_dataset(file_details['filepath'], file_details['keys'])
+    if max_workers <= 1:
+        for file_name, file_details in tqdm(files_to_load.items(), desc='Loading session data'):
+            session_data[file_name] = _read_session_file(file_details['filepath'], file_details['keys'], lazy)
+        return session_data
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(_read_session_file, file_details['filepath'], file_details['keys'], lazy): file_name
+            for file_name, file_details in files_to_load.items()
+        }
+        for future in tqdm(as_completed(futures), total=len(futures), desc='Loading session data'):
+            session_data[futures[future]] = future.result()
+    # Keep the same key order as the serial loader
+    return {file_name: session_data[file_name] for file_name in files_to_load}
+
+def _read_cohort_session_shape(session_dirpath: Path, feature_sets: list[str]) -> dict:
+    """
+    Worker: number of samples and feature columns of a session without reading any data.
+    """
+    shapes = {}
+    with h5py.File(session_dirpath / "kinematics.h5", 'r') as f:
+        shapes['kinematics'] = f['kinematics'].shape[::-1]
+    for feature_name in feature_sets:
+        shapes[feature_name] = feature_file_shape(session_dirpath / "features" / f"{feature_name}.h5")
+    return shapes
+
+
+def _load_cohort_session(session_dirpath: Path, feature_sets: list[str]) -> dict:
+    """
+    Worker: reads one session with samples as rows
+    """
+    session = {
+        'kinematics': read_hdf_dataset(session_dirpath / "kinematics.h5", ['kinematics', 'nip_time']),
+        'events': read_hdf_dataset(session_dirpath / "events.h5", ['trial_start_idxs', 'trial_stop_idxs']),
+    }
+    for feature_name in feature_sets:
+        session[feature_name] = _read_session_file(
+            session_dirpath / "features" / f"{feature_name}.h5", ['features'])
+    enforce_samples_as_rows(session)
+    return session
+
+
+def _drop_cohort_sessions(cohort: dict, trial_starts: list, trial_stops: list, drop_idxs: list[int]) -> tuple:
+    """:return: (cohort, trial_starts, trial_stops) without the sessions at drop_idxs"""
+    keep = np.setdiff1d(np.arange(len(cohort['job_ids'])), drop_idxs)
+    n_rows = np.diff(cohort['offsets'])[keep]
+    row_mask = np.isin(cohort['session_idxs'], keep)
+    cohort = {
+        'job_ids': cohort['job_ids'][keep],
+        'offsets': np.concatenate([[0], np.cumsum(n_rows)]),
+        'session_idxs': np.repeat(np.arange(len(keep), dtype=np.int32), n_rows),
+        'kinematics': cohort['kinematics'][row_mask],
+        'nip_time': cohort['nip_time'][row_mask],
+        'features': {name: features[row_mask] for name, features in cohort['features'].items()},
+    }
+    return cohort, [trial_starts[i] for i in keep], [trial_stops[i] for i in keep]
 
-    return session_data
+
+def load_cohort_data(
+        manifest_filepath: Path,
+        scratch_root: Path,
+        feature_sets: list[str],
+        max_workers: int = 4,
+        dtype: np.dtype = np.float32
+) -> dict:
+    """
+    Loads every session of a manifest (e.g. manifest_bidirectional_8DOF-TASKA.tsv) into one contiguous,
+    ragged structure: all sessions are stacked along the sample axis and session s occupies rows
+    offsets[s]:offsets[s+1] of every array, so kinematics and features share the same row index.
+    Sessions are read in a process pool and copied into the preallocated arrays as they arrive. At most
+    `max_workers` sessions are submitted at a time, so peak memory is the cohort size plus `max_workers`
+    sessions. Sessions that fail to load are dropped with a warning, which costs one extra copy of the cohort.
+    :param manifest_filepath: manifest TSV with a job_id column
+    :param scratch_root: scratch_root containing one directory per job_id
+    :param feature_sets: feature sets to load, e.g. analysis.feature_sets
+    :param max_workers: number of worker processes
+    :param dtype: dtype of the stacked kinematics and feature arrays
+    :return: dict with
+             - 'job_ids': (S, ) job_ids of the loaded sessions
+             - 'offsets': (S+1, ) row offsets of each session
+             - 'session_idxs': (N, ) position in job_ids of each row
+             - 'kinematics': (N x D), 'nip_time': (N, )
+             - 'features': {feature_set: (N x F)}
+             - 'trial_start_timestamps', 'trial_stop_timestamps': ragged event timestamps with
+               'trial_offsets' (S+1, ) delimiting each session
+    """
+    job_ids = pl.read_csv(manifest_filepath, separator='\t')['job_id'].to_list()
+    session_dirpaths = {job_id: scratch_root / str(job_id) for job_id in job_ids}
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        shape_futures = {executor.submit(_read_cohort_session_shape, path, feature_sets): job_id
+                         for job_id, path in session_dirpaths.items()}
+        shapes = {}
+        for future in as_completed(shape_futures):
+            job_id = shape_futures[future]
+            try:
+                shapes[job_id] = future.result()
+            except (FileNotFoundError, OSError, KeyError) as e:
+                logger.warning(f"Skipping job_id {job_id}: {e}")
+        loaded_job_ids = [job_id for job_id in job_ids if job_id in shapes]
+        if not loaded_job_ids:
+            raise FileNotFoundError(f"No complete sessions found for {manifest_filepath}")
+
+        widths = {}
+        for name in ['kinematics', *feature_sets]:
+            job_widths = defaultdict(list)
+            for job_id in loaded_job_ids:
+                job_widths[shapes[job_id][name][1]].append(job_id)
+            if len(job_widths) > 1:
+                raise ValueError(f"Sessions of {manifest_filepath} have different {name} widths: "
+                                 + "; ".join(f"{width} in job_ids {ids}" for width, ids in sorted(job_widths.items())))
+            widths[name] = next(iter(job_widths))
+
+        # Kinematics define the rows of each session; feature sets are trimmed/NaN-padded to match
+        n_rows = np.array([shapes[job_id]['kinematics'][0] for job_id in loaded_job_ids])
+        offsets = np.concatenate([[0], np.cumsum(n_rows)])
+        cohort = {
+            'job_ids': np.array(loaded_job_ids),
+            'offsets': offsets,
+            'session_idxs': np.repeat(np.arange(len(loaded_job_ids), dtype=np.int32), n_rows),
+            'kinematics': np.empty((offsets[-1], widths['kinematics']), dtype=dtype),
+            'nip_time': np.empty(offsets[-1], dtype=np.float64),
+            'features': {name: np.full((offsets[-1], widths[name]), np.nan, dtype=dtype)
+                         for name in feature_sets},
+        }
+        trial_starts, trial_stops = [None] * len(loaded_job_ids), [None] * len(loaded_job_ids)
+
+        # Sliding window of max_workers sessions, so finished sessions cannot pile up in the parent
+        pending_idxs = iter(range(len(loaded_job_ids)))
+        session_futures, failed_idxs = {}, []
+        progress = tqdm(total=len(loaded_job_ids), desc='Loading cohort')
+        while True:
+            for i in pending_idxs:
+                future = executor.submit(_load_cohort_session, session_dirpaths[loaded_job_ids[i]], feature_sets)
+                session_futures[future] = i
+                if len(session_futures) >= max_workers:
+                    break
+            if not session_futures:
+                break
+            future = next(iter(wait(session_futures, return_when=FIRST_COMPLETED).done))
+            i = session_futures.pop(future)
+            progress.update()
+            try:
+                session = future.result()
+            except (FileNotFoundError, OSError, KeyError) as e:
+                logger.warning(f"Skipping job_id {loaded_job_ids[i]}: {e}")
+                failed_idxs.append(i)
+                continue
+            rows = slice(offsets[i], offsets[i + 1])
+            cohort['kinematics'][rows] = session['kinematics']['kinematics']
+            cohort['nip_time'][rows] = session['kinematics']['nip_time'].flatten()
+            for name in feature_sets:
+                session_features = session[name]['features']
+                if len(session_features) != n_rows[i]:
+                    logger.warning(f"job_id {loaded_job_ids[i]}: {name} has {len(session_features)} rows, "
+                                   f"kinematics has {n_rows[i]}")
+                n_copy = min(len(session_features), n_rows[i])
+                cohort['features'][name][offsets[i]:offsets[i] + n_copy] = session_features[:n_copy]
+            # Unpaired markers are dropped, as in generate_train_test_split
+            starts = session['events']['trial_start_idxs'].flatten()
+            stops = session['events']['trial_stop_idxs'].flatten()
+            n_trials = min(len(starts), len(stops))
+            trial_starts[i], trial_stops[i] = starts[:n_trials], stops[:n_trials]
+            del session
+        progress.close()
+
+    if failed_idxs:
+        cohort, trial_starts, trial_stops = _drop_cohort_sessions(cohort, trial_starts, trial_stops, failed_idxs)
+        loaded_job_ids, offsets = cohort['job_ids'].tolist(), cohort['offsets']
+        if not loaded_job_ids:
+            raise FileNotFoundError(f"No session of {manifest_filepath} could be loaded")
+    cohort['trial_offsets'] = np.concatenate([[0], np.cumsum([len(t) for t in trial_starts])])
+    cohort['trial_start_timestamps'] = np.concatenate(trial_starts)
+    cohort['trial_stop_timestamps'] = np.concatenate(trial_stops)
+    logger.info(f"Loaded {len(loaded_job_ids)}/{len(job_ids)} sessions ({offsets[-1]} samples)")
+    return cohort
 
 def _create_trial_info(trial_list):
     """
@@ -83,10 +464,66 @@ def print_data_shape(session_data):
             print(f"\t{key_j}: {type(val_j)}, {val_j.shape}")
 
 def enforce_samples_as_rows(session_data):
-    for key_i, val_i in session_data.items():
+    """
+    Transposes every array of load_session_data output from the MATLAB (M x N) orientation to (N x M).
+    Feature store files are loaded as transposed views, so their features come back C-contiguous.
+    """
+    for val_i in session_data.values():
         for key_j, val_j in val_i.items():
             val_i[key_j] = val_j.T
 
+def _concatenate_ranges(starts: np.ndarray, stops: np.ndarray) -> np.ndarray:
+    """
+    Equivalent to np.concatenate([np.arange(a, b) for a, b in zip(starts, stops)]) built with a single cumsum.
+    :param starts: (T, ) inclusive range starts
+    :param stops: (T, ) exclusive range stops
+    :return: (sum(stops - starts), ) int64 array of indices
+    """
+    lengths = stops - starts
+    keep = lengths > 0
+    starts, stops, lengths = starts[keep], stops[keep], lengths[keep]
+    if len(lengths) == 0:
+        return np.array([], dtype=np.int64)
+    # Steps of one inside each range, and a jump from the end of one range to the start of the next
+    steps = np.ones(lengths.sum(), dtype=np.int64)
+    steps[0] = starts[0]
+    range_offsets = np.cumsum(lengths)[:-1]
+    steps[range_offsets] = starts[1:] - stops[:-1] + 1
+    return np.cumsum(steps)
+
+def _classify_trials(
+        kinematics: np.ndarray,
+        starts: np.ndarray,
+        stops: np.ndarray,
+        activation_threshold: float,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Classifies every trial at once with segment reductions over the stitched trial samples.
+    :param kinematics: (NxD) array of kinematic data
+    :param starts: (T, ) trial start indices, each < its stop
+    :param stops: (T, ) trial stop indices
+    :param activation_threshold: threshold to consider a kinematic channel "active"
+    :return: (TxD) bool mask of active DOFs, (TxD) bool mask of DOFs whose peak |activation| is positive
+    """
+    n_trials, n_dofs = len(starts), kinematics.shape[1]
+    if n_trials == 0:
+        return np.zeros((0, n_dofs), dtype=bool), np.zeros((0, n_dofs), dtype=bool)
+    trial_rows = _concatenate_ranges(starts, stops)
+    segment_offsets = np.concatenate([[0], np.cumsum(stops - starts)[:-1]])
+    trial_kinematics = kinematics[trial_rows]
+    abs_kinematics = np.abs(trial_kinematics)
+
+    max_abs_activations = np.maximum.reduceat(abs_kinematics, segment_offsets, axis=0)
+    active = max_abs_activations > activation_threshold
+
+    # First sample reaching the max within each trial (matches np.argmax tie-breaking)
+    trial_ids = np.repeat(np.arange(n_trials), stops - starts)
+    is_peak = abs_kinematics == max_abs_activations[trial_ids]
+    sample_positions = np.where(is_peak, np.arange(len(trial_rows))[:, None], len(trial_rows) - 1)
+    peak_positions = np.minimum.reduceat(sample_positions, segment_offsets, axis=0)
+    positive = np.take_along_axis(trial_kinematics, peak_positions, axis=0) > 0
+    return active, positive
+
 def generate_train_test_split(
         kinematics: np.ndarray,
         kinematics_timestamps: np.ndarray,
@@ -125,7 +562,6 @@ def generate_train_test_split(
     trial_stop_idxs = np.searchsorted(kinematics_timestamps.flatten(), trial_stop_timestamps.flatten(), side='left').flatten()
 
     # Validate trial markers
-    valid_trials = []
     num_starts, num_stops = len(trial_start_idxs), len(trial_stop_idxs)
     if num_starts > num_stops:
         logger.warning(f'Too many starts:\n\t{trial_start_idxs}\n\t{trial_stop_idxs}')
@@ -133,40 +569,28 @@ def generate_train_test_split(
     elif num_starts < num_stops:
         logger.warning(f'Too many stops:\n\t{trial_start_idxs}\n\t{trial_stop_idxs}')
         trial_stop_idxs = trial_stop_idxs[:num_starts]
-    for i in range(len(trial_start_idxs)):
-        start_idx, stop_idx = trial_start_idxs[i], trial_stop_idxs[i]
-        if start_idx < stop_idx < len(kinematics):
-            valid_trials.append({'start': start_idx, 'stop': stop_idx, 'original_idx': i})
-    logger.info(f"Found {len(valid_trials)} valid trials")
+    valid_mask = (trial_start_idxs < trial_stop_idxs) & (trial_stop_idxs < len(kinematics))
+    valid_original_idxs = np.flatnonzero(valid_mask)
+    valid_starts, valid_stops = trial_start_idxs[valid_mask], trial_stop_idxs[valid_mask]
+    logger.info(f"Found {len(valid_original_idxs)} valid trials")
 
     # Classify trials by DOF/COMBO_ID and directionality
+    active, positive = _classify_trials(kinematics, valid_starts, valid_stops, kinematics_activation_threshold)
     classified_trials = []
-    for trial in valid_trials:
-        trial_kinematics = kinematics[trial['start']:trial['stop'], :]
-
-        max_abs_activations = np.max(np.abs(trial_kinematics), axis=0) # find the max for each col
-        active_dofs = np.where(max_abs_activations > kinematics_activation_threshold)[0] # index by zero to handle the tuple returned by np.where
-
+    for k, original_idx in enumerate(valid_original_idxs):
+        active_dofs = np.flatnonzero(active[k])
+        if len(active_dofs) == 0:
+            continue
+        dof_details = [f"dof_{dof + 1}_{'pos' if positive[k, dof] else 'neg'}" for dof in active_dofs]
+        trial = {'start': valid_starts[k], 'stop': valid_stops[k], 'original_idx': int(original_idx)}
         if len(active_dofs) == 1:
             trial['is_combined'] = False
-            dominant_dof = active_dofs[0]
-            peak_sample_idx = np.argmax(np.abs(trial_kinematics[:, dominant_dof]))
-            peak_value = trial_kinematics[peak_sample_idx, dominant_dof]
-            direction = "pos" if peak_value > 0 else "neg"
-            trial['gesture_id'] = f"dof_{dominant_dof + 1}_{direction}"
-            classified_trials.append(trial)
-        elif len(active_dofs) > 1:
+            trial['gesture_id'] = dof_details[0]
+        else:
             trial['is_combined'] = True
-            dof_details = []
-            for dof in active_dofs:
-                peak_sample_idx = np.argmax(np.abs(trial_kinematics[:, dof]))
-                peak_value = trial_kinematics[peak_sample_idx, dof]
-                direction = "pos" if peak_value > 0 else "neg"
-                dof_details.append(f"dof_{dof + 1}_{direction}")
             # Sort the details to ensure a canonical gesture ID (e.g., 1_pos-2_neg is same as 2_neg-1_pos)
-            dof_ids_str = sorted(dof_details)
-            trial['gesture_id'] = f"combo_{'-'.join(dof_ids_str)}"
-            classified_trials.append(trial)
+            trial['gesture_id'] = f"combo_{'-'.join(sorted(dof_details))}"
+        classified_trials.append(trial)
 
     # Filter trials
     if not include_combined:
@@ -208,11 +632,164 @@ def generate_train_test_split(
         logger.warning("No training trials found. Returning empty arrays")
         return np.array([]), np.array([]), [], []
 
-    stitched_train_idxs = np.concatenate([
-        np.arange(t['start_idx'], t['stop_idx']) for t in train_trials_info
-    ])
-    stitched_test_idxs = np.concatenate([
-        np.arange(t['start_idx'], t['stop_idx']) for t in test_trials_info
-    ])
+    stitched_train_idxs = _concatenate_ranges(
+        np.array([t['start_idx'] for t in train_trials_info], dtype=np.int64),
+        np.array([t['stop_idx'] for t in train_trials_info], dtype=np.int64),
+    )
+    stitched_test_idxs = _concatenate_ranges(
+        np.array([t['start_idx'] for t in test_trials_info], dtype=np.int64),
+        np.array([t['stop_idx'] for t in test_trials_info], dtype=np.int64),
+    )
     logger.info("---Split Complete---")
-    return stitched_train_idxs, stitched_test_idxs, train_trials_info, test_trials_info
\ No newline at end of file
+    return stitched_train_idxs, stitched_test_idxs, train_trials_info, test_trials_info
+
+
+def _split_inputs_hash(arrays: list[np.ndarray], split_params: dict) -> str:
+    """Content hash of the split inputs (kinematics, timestamps, trial markers) and parameters"""
+    digest = hashlib.sha256(json.dumps(split_params, sort_keys=True).encode())
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update(f"{array.dtype.str}{array.shape}".encode())
+        digest.update(array.tobytes())
+    return digest.hexdigest()
+
+
+def _split_plan_key(session_dirpath: Path, split_params: dict) -> str:
+    """
+    Lookup key of a split plan, '<params hash>-<sources hash>': the split parameters, then the size and mtime
+    of kinematics.h5 and events.h5. Computed from file metadata only, so a cache hit never reads the kinematics.
+    """
+    sources = {}
+    for filename in SPLIT_PLAN_SOURCES:
+        stat = (session_dirpath / filename).stat()
+        sources[filename] = [stat.st_size, stat.st_mtime_ns]
+    params_hash = hashlib.sha256(json.dumps(split_params, sort_keys=True).encode()).hexdigest()[:16]
+    sources_hash = hashlib.sha256(json.dumps(sources, sort_keys=True).encode()).hexdigest()[:16]
+    return f"{params_hash}-{sources_hash}"
+
+
+def _evict_stale_split_plans(plan_filepath: Path):
+    """
+    Removes the plans of the same split parameters computed from older kinematics/events files, and plans
+    with keys of the earlier single-hash format, which can no longer be looked up.
+    """
+    params_hash = plan_filepath.stem.split('-')[0]
+    for filepath in plan_filepath.parent.glob("*.h5"):
+        if filepath != plan_filepath and (filepath.stem.startswith(f"{params_hash}-") or '-' not in filepath.stem):
+            filepath.unlink(missing_ok=True)
+
+
+def _write_split_plan(filepath: Path, split_plan: tuple, content_hash: str, split_params: dict):
+    """Writes a split plan to HDF5 via a temporary file so concurrent jobs never see a partial plan"""
+    train_idxs, test_idxs, train_trials_info, test_trials_info = split_plan
+    filepath.parent.mkdir(parents=True, exist_ok=True)
+    tmp_filepath = filepath.with_suffix(f".{os.getpid()}.tmp")
+    with h5py.File(tmp_filepath, 'w') as f:
+        f.attrs['content_hash'] = content_hash
+        f.attrs['split_params'] = json.dumps(split_params, sort_keys=True)
+        f['train_idxs'], f['test_idxs'] = train_idxs, test_idxs
+        for group_name, trials_info in [('train_trials_info', train_trials_info),
+                                        ('test_trials_info', test_trials_info)]:
+            group = f.create_group(group_name)
+            group.create_dataset('gesture_id', data=[t['gesture_id'] for t in trials_info], dtype=h5py.string_dtype())
+            for key in TRIAL_INFO_INDEX_KEYS:
+                group[key] = np.array([t[key] for t in trials_info], dtype=np.int64)
+    os.replace(tmp_filepath, filepath)
+
+
+def _read_split_plan(filepath: Path) -> tuple:
+    with h5py.File(filepath, 'r') as f:
+        split_plan = [f['train_idxs'][()], f['test_idxs'][()]]
+        for group_name in ['train_trials_info', 'test_trials_info']:
+            group = f[group_name]
+            columns = {key: group[key][()].tolist() for key in TRIAL_INFO_INDEX_KEYS}
+            split_plan.append([
+                {'gesture_id': gesture_id, **{key: columns[key][i] for key in TRIAL_INFO_INDEX_KEYS}}
+                for i, gesture_id in enumerate(group['gesture_id'].asstr()[()])
+            ])
+    return tuple(split_plan)
+
+
+def _compute_split_plan(session_dirpath: Path, split_params: dict) -> tuple[tuple, str]:
+    """Loads kinematics and events of a session and runs generate_train_test_split"""
+    session_data = load_session_data(session_dirpath, {}, features_flag=False)
+    enforce_samples_as_rows(session_data)
+    inputs = [
+        session_data['kinematics']['kinematics'], session_data['kinematics']['nip_time'],
+        session_data['events']['trial_start_idxs'], session_data['events']['trial_stop_idxs'],
+    ]
+    return generate_train_test_split(*inputs, **split_params), _split_inputs_hash(inputs, split_params)
+
+
+@lru_cache(maxsize=SPLIT_PLAN_CACHE_SIZE)
+def _get_split_plan(session_dir: str, plan_key: str, split_params_items: tuple) -> tuple:
+    """In-memory layer of the split plan cache. plan_key is part of the cache key so stale sessions miss"""
+    plan_filepath = Path(session_dir) / SPLIT_PLAN_DIRNAME / f"{plan_key}.h5"
+    if plan_filepath.exists():
+        logger.info(f"Loading cached split plan {plan_filepath}")
+        return _read_split_plan(plan_filepath)
+    split_params = dict(split_params_items)
+    split_plan, content_hash = _compute_split_plan(Path(session_dir), split_params)
+    _write_split_plan(plan_filepath, split_plan, content_hash, split_params)
+    _evict_stale_split_plans(plan_filepath)
+    return split_plan
+
+
+def load_train_test_split(
+        session_dirpath: Path,
+        train_ratio: float = 0.7,
+        kinematics_activation_threshold: float = 0.1,
+        training_type: str = 'train_first',
+        include_combined: bool = False,
+        use_cache: bool = True,
+) -> tuple[np.ndarray, np.ndarray, list[dict], list[dict]]:
+    """
+    Cached generate_train_test_split for a session directory.
+    Split plans (index arrays + trial infos) are stored in session_dirpath/split_plans/ next to kinematics.h5,
+    keyed on the split parameters and the kinematics/events files, with an LRU in-memory layer on top.
+    Hits skip both loading the kinematics and classifying the trials.
+    :param session_dirpath: session directory on scratch (scratch_root/job_id)
+    :param train_ratio: see generate_train_test_split
+    :param kinematics_activation_threshold: see generate_train_test_split
+    :param training_type: see generate_train_test_split
+    :param include_combined: see generate_train_test_split
+    :param use_cache: if False, always recompute and leave the cache untouched
+    :return: same as generate_train_test_split
+    """
+    split_params = {
+        'train_ratio': train_ratio,
+        'kinematics_activation_threshold': kinematics_activation_threshold,
+        'training_type': training_type,
+        'include_combined': include_combined,
+    }
+    session_dirpath = Path(session_dirpath)
+    if not use_cache:
+        return _compute_split_plan(session_dirpath, split_params)[0]
+
+    plan_key = _split_plan_key(session_dirpath, split_params)
+    train_idxs, test_idxs, train_trials_info, test_trials_info = _get_split_plan(
+        str(session_dirpath.resolve()), plan_key, tuple(sorted(split_params.items())))
+    # Copies, so callers cannot mutate the cached plan
+    return (train_idxs.copy(), test_idxs.copy(),
+            [dict(t) for t in train_trials_info], [dict(t) for t in test_trials_info])
+
+def load_decoding_data(session_dirpath: Path, project_config: dict) -> tuple[np.ndarray, np.ndarray, tuple]:
+    """
+    Kinematics, the concatenated feature sets in analysis.feature_sets and the train/test split of a session.
+    :param session_dirpath: session directory on scratch (scratch_root/job_id)
+    :param project_config: project config from load_project_config
+    :return: (NxD) kinematics, (NxF) features, output of load_train_test_split
+    """
+    session_data = load_session_data(session_dirpath, project_config, events_flag=False)
+    enforce_samples_as_rows(session_data)
+    features = np.hstack([
+        session_data[feature_name.lower()]['features'] for feature_name in project_config['analysis']['feature_sets']
+    ])
+    split_params = project_config['analysis']['train_test_split']
+    split = load_train_test_split(
+        session_dirpath,
+        train_ratio=split_params['train_ratio'],
+        training_type=split_params['split_type'],
+        include_combined=split_params['include_combined'],
+    )
+    return session_data['kinematics']['kinematics'], features, split
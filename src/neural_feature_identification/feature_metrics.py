@@ -0,0 +1,183 @@
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from loguru import logger
+import numpy as np
+from tqdm import tqdm
+
+from neural_feature_identification.dataset_utils import read_feature_file, read_hdf_dataset
+
+# Rows (samples) read from the feature files per block
+DEFAULT_BLOCK_ROWS = 50000
+
+
+class CorrelationAccumulator:
+    """
+    One-pass, mergeable Pearson correlation between the columns of two matrices (e.g. features vs kinematics,
+    or features vs themselves). Keeps pairwise counts, means, second moments and co-moments, updated chunk by
+    chunk with the Welford/Chan merge, so memory is O(left x right) regardless of the number of samples.
+    NaNs are masked pairwise: a pair of columns only uses the rows where both are finite.
+    """
+    def __init__(self, n_left: int, n_right: int):
+        self.n_left, self.n_right = n_left, n_right
+        shape = (n_left, n_right)
+        self.count = np.zeros(shape)
+        self.mean_left, self.mean_right = np.zeros(shape), np.zeros(shape)
+        self.m2_left, self.m2_right = np.zeros(shape), np.zeros(shape)
+        self.comoment = np.zeros(shape)
+
+    def update(self, left: np.ndarray, right: np.ndarray | None = None) -> 'CorrelationAccumulator':
+        """
+        Adds a chunk of rows.
+        :param left: (n x n_left) chunk
+        :param right: (n x n_right) chunk with the same rows. Defaults to left (auto-correlation)
+        :return: self
+        """
+        left = np.asarray(left, dtype=np.float64)
+        right = left if right is None else np.asarray(right, dtype=np.float64)
+        if len(left) == 0:
+            return self
+        return self.merge(self._chunk_statistics(left, right))
+
+    def _chunk_statistics(self, left: np.ndarray, right: np.ndarray) -> 'CorrelationAccumulator':
+        """Pairwise statistics of a single chunk, computed on data shifted by the column means for accuracy"""
+        chunk = CorrelationAccumulator(self.n_left, self.n_right)
+        valid_left, valid_right = ~np.isnan(left), ~np.isnan(right)
+        with np.errstate(invalid='ignore'):
+            shift_left = np.nan_to_num(np.nanmean(left, axis=0))
+            shift_right = np.nan_to_num(np.nanmean(right, axis=0))
+        shifted_left = np.where(valid_left, left - shift_left, 0)
+        shifted_right = np.where(valid_right, right - shift_right, 0)
+        chunk.comoment = shifted_left.T @ shifted_right
+
+        if valid_left.all() and valid_right.all():
+            # No NaNs: every pair sees every row and the shifted column sums are zero
+            chunk.count[:] = len(left)
+            chunk.mean_left[:] = shift_left[:, None]
+            chunk.mean_right[:] = shift_right[None, :]
+            chunk.m2_left[:] = np.sum(shifted_left ** 2, axis=0)[:, None]
+            chunk.m2_right[:] = np.sum(shifted_right ** 2, axis=0)[None, :]
+            return chunk
+
+        valid_left, valid_right = valid_left.astype(np.float64), valid_right.astype(np.float64)
+        count = valid_left.T @ valid_right
+        sum_left, sum_right = shifted_left.T @ valid_right, valid_left.T @ shifted_right
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean_left = np.where(count > 0, sum_left / count, 0)
+            mean_right = np.where(count > 0, sum_right / count, 0)
+        chunk.count = count
+        chunk.mean_left = mean_left + shift_left[:, None]
+        chunk.mean_right = mean_right + shift_right[None, :]
+        chunk.m2_left = (shifted_left ** 2).T @ valid_right - mean_left * sum_left
+        chunk.m2_right = valid_left.T @ shifted_right ** 2 - mean_right * sum_right
+        chunk.comoment -= mean_left * sum_right
+        return chunk
+
+    def merge(self, other: 'CorrelationAccumulator') -> 'CorrelationAccumulator':
+        """
+        Combines the statistics of another accumulator (another chunk, session or worker) into this one.
+        :return: self
+        """
+        count = self.count + other.count
+        with np.errstate(invalid='ignore', divide='ignore'):
+            weight = np.where(count > 0, other.count / count, 0)
+        delta_left, delta_right = other.mean_left - self.mean_left, other.mean_right - self.mean_right
+        cross_weight = self.count * weight
+        self.m2_left += other.m2_left + delta_left ** 2 * cross_weight
+        self.m2_right += other.m2_right + delta_right ** 2 * cross_weight
+        self.comoment += other.comoment + delta_left * delta_right * cross_weight
+        self.mean_left += delta_left * weight
+        self.mean_right += delta_right * weight
+        self.count = count
+        return self
+
+    def correlation(self) -> np.ndarray:
+        """
+        :return: (n_left x n_right) correlation matrix. Undefined correlations (flat columns) are 0, as in MATLAB
+        """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            corr = self.comoment / np.sqrt(self.m2_left * self.m2_right)
+        corr[~np.isfinite(corr)] = 0
+        return np.clip(corr, -1, 1)
+
+
+def compute_relevance(correlation: np.ndarray) -> np.ndarray:
+    """
+    Port of compute_relevance_corr.m.
+    :param correlation: (FxD) feature-kinematic correlations
+    :return: (D, ) mean absolute correlation of the features with each kinematic
+    """
+    return np.sum(np.abs(correlation), axis=0) / correlation.shape[0]
+
+
+def compute_redundancy(correlation: np.ndarray) -> float:
+    """
+    Port of compute_redundancy_corr.m.
+    :param correlation: (FxF) feature-feature correlations
+    :return: mean absolute correlation over all feature pairs
+    """
+    return float(np.sum(np.abs(correlation)) / correlation.shape[0] ** 2)
+
+
+def accumulate_session_correlations(
+        session_dirpath: Path,
+        feature_name: str,
+        sample_idxs: np.ndarray | None = None,
+        block_rows: int = DEFAULT_BLOCK_ROWS,
+        redundancy: bool = True,
+) -> tuple[CorrelationAccumulator, CorrelationAccumulator | None]:
+    """
+    Streams a session's feature file in row blocks into relevance (feature x kinematic) and redundancy
+    (feature x feature) accumulators. Only one block of features is in memory at a time.
+    :param session_dirpath: session directory on scratch (scratch_root/job_id)
+    :param feature_name: feature set, e.g. 'DWT-DB4'
+    :param sample_idxs: optional sample indices to use (e.g. the stitched train indices)
+    :param block_rows: samples per block
+    :param redundancy: also accumulate the feature-feature correlations
+    :return: relevance accumulator, redundancy accumulator (None if redundancy is False)
+    """
+    # kinematics.h5 is stored as (kinematics x samples); .T gives a lazy (samples x kinematics) view
+    kinematics = read_hdf_dataset(session_dirpath / "kinematics.h5", ['kinematics'], lazy=True)['kinematics'].T
+    features = read_feature_file(session_dirpath / "features" / f"{feature_name}.h5", lazy=True)
+    n_samples = len(features) if sample_idxs is None else len(sample_idxs)
+    relevance_acc = CorrelationAccumulator(features.shape[1], kinematics.shape[1])
+    redundancy_acc = CorrelationAccumulator(features.shape[1], features.shape[1]) if redundancy else None
+    for start in range(0, n_samples, block_rows):
+        rows = slice(start, start + block_rows) if sample_idxs is None else sample_idxs[start:start + block_rows]
+        feature_block = np.asarray(features[rows], dtype=np.float64)
+        relevance_acc.update(feature_block, np.asarray(kinematics[rows], dtype=np.float64))
+        if redundancy_acc is not None:
+            redundancy_acc.update(feature_block)
+    return relevance_acc, redundancy_acc
+
+
+def compute_cohort_correlations(
+        session_dirpaths: list[Path],
+        feature_name: str,
+        max_workers: int = 4,
+        block_rows: int = DEFAULT_BLOCK_ROWS,
+        redundancy: bool = True,
+) -> tuple[CorrelationAccumulator, CorrelationAccumulator | None]:
+    """
+    Relevance/redundancy accumulators pooled over sessions. Sessions are processed in parallel and merged.
+    :return: merged relevance accumulator, merged redundancy accumulator (None if redundancy is False)
+    """
+    if not session_dirpaths:
+        raise ValueError(f"No sessions to accumulate {feature_name} correlations over")
+    relevance_acc, redundancy_acc = None, None
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                accumulate_session_correlations, session_dirpath, feature_name, None, block_rows, redundancy)
+            for session_dirpath in session_dirpaths
+        ]
+        for future in tqdm(futures, desc=f'Accumulating {feature_name} correlations'):
+            session_relevance, session_redundancy = future.result()
+            if relevance_acc is None:
+                relevance_acc, redundancy_acc = session_relevance, session_redundancy
+                continue
+            relevance_acc.merge(session_relevance)
+            if redundancy_acc is not None:
+                redundancy_acc.merge(session_redundancy)
+    logger.info(f"Accumulated {feature_name} correlations over {len(session_dirpaths)} sessions")
+    return relevance_acc, redundancy_acc
@@ -0,0 +1,176 @@
+from loguru import logger
+import numpy as np
+
+# Ports of gramSchmDarpa_jag.m, corrChanSelZeroMeanDarpa_jag.m and stopCritDarpa.m. Samples are rows.
+STOP_CRITERIA = ['none', 'AIC', 'AICc', 'BIC']
+# Orthogonalized candidates whose squared norm falls below this fraction of the original are treated as
+# linearly dependent (NaN rows in the MATLAB implementation, which then get a correlation of zero)
+DEPENDENT_NORM_TOL = 1e-10
+
+
+def stop_criterion(rss: np.ndarray, n_samples: int, n_params: int, criterion: str) -> np.ndarray:
+    """
+    Port of stopCritDarpa.m.
+    :param rss: residual sum of squares
+    :param n_samples: number of residual samples (numel(resid))
+    :param n_params: number of parameters in the model so far
+    :param criterion: 'AIC', 'AICc', 'BIC' or 'none'
+    :return: stopping criterion value(s)
+    """
+    if criterion == 'AIC':
+        return 2 * n_params + n_samples * np.log(rss)
+    if criterion == 'AICc':
+        return 2 * n_params + n_samples * np.log(rss) + 2 * n_params * (n_params + 1) / (n_samples - n_params - 1)
+    if criterion == 'BIC':
+        return n_params * np.log(n_samples) + n_samples * np.log(rss)
+    return np.full(np.shape(rss), -n_params, dtype=np.float64)
+
+
+def split_kinematics_by_sign(x: np.ndarray) -> np.ndarray:
+    """
+    Splits each DOF into its positive part and the magnitude of its negative part (as corrChanSelZeroMeanDarpa_jag.m).
+    :param x: (NxD) kinematics
+    :return: (NxS) non-negative signals, DOF by DOF, positive part first. Parts that are never active are dropped.
+    """
+    parts = []
+    for dof in range(x.shape[1]):
+        for part in [np.where(x[:, dof] > 0, x[:, dof], 0), np.where(x[:, dof] < 0, -x[:, dof], 0)]:
+            if np.any(part):
+                parts.append(part)
+    return np.column_stack(parts) if parts else np.zeros((len(x), 0))
+
+
+def compute_kinematic_correlations(x: np.ndarray, z: np.ndarray) -> np.ndarray:
+    """
+    Absolute correlation of every feature with the sign-split kinematics ('all' window type).
+    Compute once per session and pass to gram_schmidt_selection to reuse across selection runs.
+    :param x: (NxD) kinematics
+    :param z: (NxF) features
+    :return: (FxS) absolute correlations, NaN replaced by 0
+    """
+    z = z - z.mean(axis=0)
+    sep_x = split_kinematics_by_sign(x)
+    sep_x = sep_x - sep_x.mean(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        correlations = np.abs(z.T @ sep_x / np.sqrt(np.outer(np.sum(z ** 2, axis=0), np.sum(sep_x ** 2, axis=0))))
+    correlations[np.isnan(correlations)] = 0
+    return correlations
+
+
+def preselect_features(correlations: np.ndarray, min_correlation: float) -> np.ndarray:
+    """
+    Candidate features in the order of corrChanSelZeroMeanDarpa_jag.m: for each sign-split DOF in turn, the features
+    with correlation >= min_correlation by decreasing correlation, skipping features already added.
+    :param correlations: (FxS) output of compute_kinematic_correlations
+    :param min_correlation: minimum correlation with any of the kinematics
+    :return: feature indices
+    """
+    order = np.argsort(-correlations, axis=0, kind='stable')
+    ranked = np.take_along_axis(correlations, order, axis=0)
+    candidates = order.T[((ranked >= min_correlation) & (ranked > 0)).T]
+    _, first_idxs = np.unique(candidates, return_index=True)
+    return candidates[np.sort(first_idxs)]
+
+
+def _forward_select(candidates_z: np.ndarray, x: np.ndarray, n_steps: int, criterion: str):
+    """
+    Gram-Schmidt forward selection on centered data.
+    Instead of re-orthogonalizing every candidate on each step, only inner products are updated: the candidates'
+    projections on the new basis vector (one matvec), their residual norms and their inner products with the
+    residual (rank-one updates). The residual stays orthogonal to the basis, so <z_c, r> = <z_c_orth, r>.
+    :return: selected column indices, (R x n_steps+1) loss or None
+    """
+    n_samples, n_candidates = candidates_z.shape
+    residual = x.copy()
+    cross = candidates_z.T @ residual # <z_c, r> for every candidate and target (C x R)
+    norms_sq = np.sum(candidates_z ** 2, axis=0)
+    original_norms_sq = norms_sq.copy()
+    rss = np.sum(residual ** 2, axis=0)
+    basis = np.zeros((n_steps, n_samples))
+    loss = np.zeros((x.shape[1], n_steps + 1)) if criterion != 'none' else None
+    actives = []
+    for j in range(n_steps):
+        if loss is not None:
+            loss[:, j] = stop_criterion(rss, n_samples, j, criterion)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            corrs = np.abs(cross) / np.sqrt(norms_sq[:, None] * rss[None, :])
+        corrs[norms_sq <= DEPENDENT_NORM_TOL * original_norms_sq] = 0
+        corrs[np.isnan(corrs)] = 0
+        corrs[actives] = -1
+        # MATLAB sorts corrs(:) (column-major), so ties go to the first target, then the first candidate
+        ind = int(np.argmax(corrs.T.ravel())) % n_candidates
+        actives.append(ind)
+
+        # New orthonormal basis vector, re-orthogonalized against the previous ones for stability
+        q = candidates_z[:, ind] - basis[:j].T @ (basis[:j] @ candidates_z[:, ind])
+        q -= basis[:j].T @ (basis[:j] @ q)
+        q_norm = np.linalg.norm(q)
+        q = q / q_norm if q_norm > 0 else q
+        basis[j] = q
+
+        weights = q @ residual
+        residual -= np.outer(q, weights)
+        rss = np.sum(residual ** 2, axis=0)
+        projections = q @ candidates_z
+        cross -= np.outer(projections, weights)
+        norms_sq = np.maximum(norms_sq - projections ** 2, 0)
+    if loss is not None:
+        loss[:, n_steps] = stop_criterion(rss, n_samples, n_steps, criterion)
+    return np.array(actives, dtype=np.int64), loss
+
+
+def gram_schmidt_selection(
+        x: np.ndarray,
+        z: np.ndarray,
+        max_features: int = 48,
+        min_correlation: float = 0.3,
+        per_dof: bool = False,
+        criterion: str = 'none',
+        dofs: np.ndarray | list[int] | None = None,
+        correlations: np.ndarray | None = None,
+) -> tuple[list[np.ndarray], list[np.ndarray | None]]:
+    """
+    Forward feature selection by Gram-Schmidt orthogonalization (gramSchmDarpa_jag.m, 'all' window type).
+    :param x: (NxD) kinematics
+    :param z: (NxF) features
+    :param max_features: maximum number of features to select (algorithms.feature_selection.max_features)
+    :param min_correlation: minimum correlation with the kinematics to be a candidate
+           (algorithms.feature_selection.min_correlation)
+    :param per_dof: select features for each DOF individually instead of all DOFs at once
+    :param criterion: 'AIC', 'AICc', 'BIC' or 'none'. Loss values are reported, selection always runs max_features steps
+    :param dofs: DOFs to fit. Defaults to all. Candidate pruning always uses all DOFs, as in MATLAB.
+    :param correlations: precomputed output of compute_kinematic_correlations(x, z)
+    :return: list of selected feature indices (one entry, or one per DOF if per_dof) and the matching
+             (targets x steps+1) loss arrays (None if criterion is 'none'). See best_feature_count.
+    """
+    if criterion not in STOP_CRITERIA:
+        raise ValueError(f"Invalid stopping criterion: {criterion}")
+    dofs = np.arange(x.shape[1]) if dofs is None else np.asarray(dofs)
+    if correlations is None:
+        correlations = compute_kinematic_correlations(x, z)
+    candidates = preselect_features(correlations, min_correlation)
+    logger.info(f"{len(candidates)} of {z.shape[1]} features pass the {min_correlation} correlation threshold")
+
+    candidates_z = z[:, candidates].astype(np.float64)
+    candidates_z -= candidates_z.mean(axis=0)
+    candidates_z[np.isnan(candidates_z)] = 0
+    targets = x[:, dofs].astype(np.float64)
+    targets -= targets.mean(axis=0)
+    target_groups = [targets[:, [i]] for i in range(len(dofs))] if per_dof else [targets]
+
+    n_steps = min(max_features, len(candidates))
+    selected, losses = [], []
+    for target in target_groups:
+        actives, loss = _forward_select(candidates_z, target, n_steps, criterion)
+        selected.append(candidates[actives])
+        losses.append(loss)
+    return selected, losses
+
+
+def best_feature_count(loss: np.ndarray) -> int:
+    """
+    Number of features at the stopping criterion minimum, taking the largest over targets (as gramSchmDarpa_jag.m).
+    :param loss: (targets x steps+1) loss from gram_schmidt_selection
+    :return: number of features to keep
+    """
+    return int(np.max(np.argmin(loss, axis=1)))
@@ -1,28 +1,1707 @@
+from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import hashlib
+import json
+import os
 from pathlib import Path
+import time
+import tracemalloc
 
+import h5py
 from loguru import logger
-from tqdm import tqdm
+import numpy as np
+from scipy import signal
 import typer
 
-from neural_feature_identification.config import PROCESSED_DATA_DIR
+from neural_feature_identification.dataset_utils import (
+    FEATURE_STORE_SCALE_ATTR,
+    FEATURE_STORE_VERSION,
+    FEATURE_STORE_VERSION_ATTR,
+    feature_store_version,
+    load_project_config,
+    read_feature_file,
+    read_hdf_dataset,
+)
+from neural_feature_identification.filtering import SOSFilter, sosfiltfilt_blocks
+from neural_feature_identification.nsx_utils import (
+    read_kdf,
+    read_nsx_range,
+)
+from neural_feature_identification.session_clock import session_nip_offset
 
 app = typer.Typer()
 
+# Constants shared with the MATLAB extractors in scripts/matlab
+FS_NS5 = 30_000  # [Hz] NS5 sampling rate
+LOOP_TIME_SECONDS = 0.033  # [sec] simulated 30 Hz software loop time
+MAX_DATA_LOOKBACK = 37 * 30  # [samples] max look back when NIP time separation is large
+NFR_KERNEL_WIDTH_SECONDS = 0.3  # [sec] NFR firing rate smoothing kernel
+SPIKE_HPF_ORDER = 4  # NFR/MAV high-pass filter order
+SPIKE_HPF_CUTOFF_HZ = 750  # NFR/MAV high-pass filter cutoff
+SPIKE_REFRACTORY_SAMPLES = 52  # skipOnThreshold in findSpikesRealTimeMex.cpp
+SBP_DOWNSAMPLE_30KHZ_TO_2KHZ = 15
+SBP_DOWNSAMPLE_2KHZ_TO_30HZ = 66
+SBP_FS = FS_NS5 // SBP_DOWNSAMPLE_30KHZ_TO_2KHZ
+CHANNEL_BLOCK_SIZE = 16  # channels filtered at once to bound float64 temporaries
+DWT_FRAME_BLOCK_SIZE = 16  # DWT frames decomposed at once
+DWT_STREAM_BLOCK_FRAMES = 64  # frames per stretch of stream decomposed at once by dwt_stream_energies
+PREFIX_BLOCK_ROWS = 8192  # rows per block of the blocked prefix sums
+FEATURE_STORE_DTYPES = ['float64', 'float32', 'float16']  # float16 is stored with a per-file scale
+FEATURE_STORE_COMPRESSIONS = ['gzip', 'lzf', 'none']  # gzip and lzf are applied after the byte shuffle
+FEATURE_STORE_CHUNK_BYTES = 2 ** 20  # target size of a (rows x all features) chunk
+
+# Decomposition low-pass filters (PyWavelets/MATLAB convention). High-pass filters are derived
+# with the quadrature mirror relation in _wavelet_filters.
+WAVELET_DEC_LO = {
+    'db1': np.array([0.7071067811865476, 0.7071067811865476]),
+    'db4': np.array([
+        -0.010597401784997278, 0.032883011666982945, 0.030841381835986965, -0.18703481171888114,
+        -0.02798376941698385, 0.6308807679295904, 0.7148465705525415, 0.23037781330885523,
+    ]),
+}
+
+
+def compute_loop_frames(
+        kdf_nip_time: np.ndarray,
+        n_samples: int,
+        max_lookback: int = MAX_DATA_LOOKBACK
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Reproduces the 30 Hz acquisition loop simulator used by the MATLAB extractors.
+    Frame i covers the 30 kHz samples received between KDF timestamps i-1 and i, clipped to
+    `max_lookback` samples when the NIP time separation is large.
+    :param kdf_nip_time: (N, ) array of KDF NIP timestamps
+    :param n_samples: number of 30 kHz samples available
+    :param max_lookback: maximum number of samples per frame
+    :return: (N-1, ) arrays of 0-based, half-open [start, stop) sample indices for each frame
+    """
+    kdf_idxs_30k = np.ceil(kdf_nip_time.flatten() - kdf_nip_time.flatten()[0]).astype(np.int64)
+    idx_diffs = np.minimum(np.diff(kdf_idxs_30k), max_lookback)
+    stops = np.minimum(kdf_idxs_30k[1:], n_samples)
+    starts = np.clip(kdf_idxs_30k[1:] - idx_diffs, 0, stops)
+    return starts, stops
+
+
+def filtfilt_channels(
+        b: np.ndarray,
+        a: np.ndarray,
+        data: np.ndarray,
+        block_size: int = CHANNEL_BLOCK_SIZE,
+        n_threads: int | None = None,
+        decimate: int = 1
+) -> np.ndarray:
+    """
+    Zero-phase filters each column of a (time x channel) array.
+    Matches project_utils.FiltFiltM (odd extension of 3*(order-1) samples) to float32 precision. The filter
+    runs as second-order sections in time chunks (filtering.sosfiltfilt_blocks), with channel blocks spread
+    over threads, so the float64 temporaries scale with the chunk and `block_size`, not the recording.
+    :param b: numerator coefficients
+    :param a: denominator coefficients
+    :param data: (T x C) array
+    :param block_size: number of channels filtered at once by a thread
+    :param n_threads: worker threads. Defaults to the CPUs available to the process
+    :param decimate: keep every `decimate`-th filtered sample, i.e. filtered[::decimate]
+    :return: (ceil(T / decimate) x C) float32 filtered array
+    """
+    padlen = 3 * (max(len(a), len(b)) - 1)
+    return sosfiltfilt_blocks(signal.tf2sos(b, a), data, padlen=padlen, decimate=decimate, block_size=block_size,
+                              n_threads=n_threads)
+
+
+def segment_sums(values: np.ndarray, starts: np.ndarray, stops: np.ndarray) -> np.ndarray:
+    """
+    Sums rows of `values` over disjoint, ordered [start, stop) segments. See range_sums.
+    :param values: (T x C) array
+    :param starts: (F, ) segment starts
+    :param stops: (F, ) segment stops
+    :return: (F x C) float64 array of segment sums
+    """
+    return range_sums(values, starts, stops)
+
+
+def prefix_sums_at(
+        values: np.ndarray,
+        bounds: np.ndarray,
+        block_rows: int = PREFIX_BLOCK_ROWS,
+        block_transform=None
+) -> np.ndarray:
+    """
+    Column sums of values[:b] for each bound b. The cumulative sum is built one row block at a time, which
+    keeps the float64 temporaries small and is much faster than a full-length cumsum along axis 0.
+    :param values: (T x C) array, e.g. a memory-mapped cache
+    :param bounds: (B, ) sorted row bounds in [0, T]
+    :param block_rows: rows accumulated at once
+    :param block_transform: optional row-wise function applied to each block before it is summed (e.g.
+           rectification), so transformed signals are never materialized in full
+    :return: (B x C) float64 array
+    """
+    prefix = np.zeros((len(bounds), values.shape[1]))
+    running = np.zeros(values.shape[1])
+    n_rows = int(bounds[-1]) if len(bounds) else 0
+    for row_start in range(0, n_rows, block_rows):
+        row_stop = min(row_start + block_rows, n_rows)
+        # Bounds in (row_start, row_stop] fall in this block
+        lo, hi = np.searchsorted(bounds, [row_start, row_stop], side='right')
+        block = values[row_start:row_stop] if block_transform is None else block_transform(values[row_start:row_stop])
+        if lo == hi:
+            running += block.sum(axis=0, dtype=np.float64)
+            continue
+        block_cumsum = np.cumsum(block, axis=0, dtype=np.float64)
+        prefix[lo:hi] = running + block_cumsum[bounds[lo:hi] - row_start - 1]
+        running += block_cumsum[-1]
+    return prefix
+
+
+def range_sums(values: np.ndarray, starts: np.ndarray, stops: np.ndarray, block_transform=None) -> np.ndarray:
+    """
+    Sums rows of `values` over arbitrary, possibly overlapping [start, stop) ranges as differences of
+    prefix sums, so the cost is one pass over the rows regardless of the range lengths.
+    :param values: (T x C) array, e.g. a memory-mapped cache
+    :param starts: (R, ) range starts
+    :param stops: (R, ) range stops
+    :param block_transform: optional row-wise transform of `values`, see prefix_sums_at
+    :return: (R x C) float64 array of range sums
+    """
+    if len(starts) == 0:
+        return np.zeros((0, values.shape[1]))
+    bounds = np.unique(np.concatenate([starts, stops]))
+    prefix = prefix_sums_at(values, bounds, block_transform=block_transform)
+    return prefix[np.searchsorted(bounds, stops)] - prefix[np.searchsorted(bounds, starts)]
+
+
+def windowed_means(values: np.ndarray, ends: np.ndarray, window_len: int, block_transform=None) -> np.ndarray:
+    """
+    Mean of the `window_len` rows ending at (and including) each index in `ends`, zero-padded before the
+    first row. Computed from prefix sums, so the cost does not depend on window_len.
+    :param values: (T x C) array
+    :param ends: (F, ) row indices
+    :param window_len: window length in rows
+    :param block_transform: optional row-wise transform of `values`, see prefix_sums_at
+    :return: (F x C) float64 array
+    """
+    ends = np.asarray(ends, dtype=np.int64)
+    # Windows shorter than window_len are zero-padded, so the divisor is always window_len
+    return range_sums(values, np.maximum(ends - window_len + 1, 0), ends + 1, block_transform) / window_len
+
+
+def _trailing_mean(values: np.ndarray, width: int) -> np.ndarray:
+    """
+    Mean over the current and previous `width`-1 rows with zeros before the first row.
+    Equivalent to the shift-register buffers in the MATLAB extractors.
+    """
+    cumsum = np.cumsum(values, axis=0, dtype=np.float64)
+    lagged = np.zeros_like(cumsum)
+    lagged[width:] = cumsum[:-width]
+    return (cumsum - lagged) / width
+
+
+def detect_spikes(
+        data: np.ndarray,
+        thresholds: np.ndarray,
+        starts: np.ndarray,
+        stops: np.ndarray,
+        refractory: int = SPIKE_REFRACTORY_SAMPLES,
+        block_size: int = CHANNEL_BLOCK_SIZE
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Vectorized port of findSpikesRealTimeMex applied frame by frame.
+    A negative threshold detects samples <= threshold, a positive one samples >= threshold and a zero
+    threshold disables the channel. After each crossing the next `refractory` samples are skipped, and
+    the skip carries across frame boundaries exactly like the `previousts` argument of the MEX file.
+    :param data: (T x C) filtered neural data
+    :param thresholds: (C, ) detection thresholds
+    :param starts: (F, ) frame starts from compute_loop_frames
+    :param stops: (F, ) frame stops from compute_loop_frames
+    :param refractory: samples skipped after each crossing
+    :param block_size: number of channels thresholded at once
+    :return: tuple of (channel_idxs, frame_idxs) for every detected spike, sorted by channel
+    """
+    thresholds = np.asarray(thresholds, dtype=np.float64).flatten()
+    channel_list, sample_list = [], []
+    for chan_start in range(0, data.shape[1], block_size):
+        chans = slice(chan_start, chan_start + block_size)
+        block_thresh = thresholds[chans]
+        block = data[:, chans]
+        crossings = np.where(block_thresh < 0, block <= block_thresh, block >= block_thresh)
+        crossings &= block_thresh != 0
+        block_chans, block_samples = np.nonzero(crossings.T)
+        channel_list.append(block_chans + chan_start)
+        sample_list.append(block_samples)
+    return frame_crossings(np.concatenate(channel_list), np.concatenate(sample_list), starts, stops, refractory)
+
+
+def frame_crossings(
+        channels: np.ndarray,
+        samples: np.ndarray,
+        starts: np.ndarray,
+        stops: np.ndarray,
+        refractory: int = SPIKE_REFRACTORY_SAMPLES
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Assigns threshold crossings to loop frames and applies the refractory period (second half of detect_spikes).
+    :param channels: (S, ) channel of each crossing
+    :param samples: (S, ) sample index of each crossing, sorted by (channel, sample)
+    :param starts: (F, ) frame starts
+    :param stops: (F, ) frame stops
+    :param refractory: samples skipped after each crossing
+    :return: tuple of (channel_idxs, frame_idxs) for every detected spike, sorted by channel
+    """
+    # Drop crossings outside the frames. The MEX function sees the frames back to back, so the
+    # refractory period is measured on the concatenation of the frames, not on the raw sample index.
+    frames = np.searchsorted(stops, samples, side='right')
+    in_frame = frames < len(stops)
+    in_frame[in_frame] = samples[in_frame] >= starts[frames[in_frame]]
+    channels, samples, frames = channels[in_frame], samples[in_frame], frames[in_frame]
+    frame_offsets = np.concatenate([[0], np.cumsum(stops - starts)])
+    stream_samples = samples - starts[frames] + frame_offsets[frames]
+
+    accepted = _apply_refractory(channels, stream_samples, refractory, int(frame_offsets[-1]))
+    return channels[accepted], frames[accepted]
+
+
+def _apply_refractory(
+        channels: np.ndarray,
+        samples: np.ndarray,
+        refractory: int,
+        n_samples: int
+) -> np.ndarray:
+    """
+    Greedy dead-time selection of threshold crossings sorted by (channel, sample).
+    A crossing at least `refractory` samples after the previous crossing is always accepted, so only
+    clusters of closely spaced crossings need to follow the skip chain. The chain is followed for all
+    clusters at once, and the number of iterations is the longest chain in any cluster.
+    """
+    n_crossings = len(samples)
+    cluster_starts = np.ones(n_crossings, dtype=bool)
+    cluster_starts[1:] = (channels[1:] != channels[:-1]) | (np.diff(samples) >= refractory)
+    accepted = cluster_starts.copy()
+    if accepted.all():
+        return accepted
+
+    cluster_ids = np.cumsum(cluster_starts)
+    keys = channels.astype(np.int64) * (n_samples + refractory + 1) + samples
+    next_idxs = np.searchsorted(keys, keys + refractory, side='left')
+    frontier = np.flatnonzero(cluster_starts)
+    while frontier.size:
+        candidates = next_idxs[frontier]
+        valid = candidates < n_crossings
+        frontier, candidates = frontier[valid], candidates[valid]
+        candidates = candidates[cluster_ids[candidates] == cluster_ids[frontier]]
+        accepted[candidates] = True
+        frontier = candidates
+    return accepted
+
+
+def _smoothed_firing_rates(
+        data: np.ndarray,
+        thresholds: np.ndarray,
+        kdf_nip_time: np.ndarray
+) -> np.ndarray:
+    """
+    Firing rates averaged over the NFR kernel for every loop frame.
+    :return: (N-1 x C) array of smoothed rates, one row per frame
+    """
+    starts, stops = compute_loop_frames(kdf_nip_time, len(data))
+    channels, frames = detect_spikes(data, thresholds, starts, stops)
+    return binned_firing_rates(channels, frames, len(starts), data.shape[1])
+
+
+def binned_firing_rates(
+        channels: np.ndarray,
+        frames: np.ndarray,
+        n_frames: int,
+        n_chans: int,
+        bin_width_sec: float = LOOP_TIME_SECONDS,
+        kernel_width_sec: float = NFR_KERNEL_WIDTH_SECONDS
+) -> np.ndarray:
+    """Spike counts per frame as rates, averaged over the trailing smoothing kernel"""
+    spike_counts = np.bincount(frames * n_chans + channels, minlength=n_frames * n_chans)
+    firing_rates = spike_counts.reshape(n_frames, n_chans) / bin_width_sec
+    kernel_frames = max(int(np.floor(kernel_width_sec / bin_width_sec)), 1)
+    return _trailing_mean(firing_rates, kernel_frames)
+
+
+def _shared_intermediate(intermediates: dict | None, key: str, compute):
+    """Returns intermediates[key], computing and storing it on first use. Computes without caching if None"""
+    if intermediates is None:
+        return compute()
+    if key not in intermediates:
+        intermediates[key] = compute()
+    return intermediates[key]
+
+
+def spike_highpass(data: np.ndarray) -> np.ndarray:
+    """750 Hz high-pass shared by the NFR and MAV extractors"""
+    b, a = signal.butter(SPIKE_HPF_ORDER, SPIKE_HPF_CUTOFF_HZ / (FS_NS5 / 2), 'high')
+    return filtfilt_channels(b, a, data)
+
+
+def _nfr_baseline_rates(
+        baseline_data: np.ndarray,
+        baseline_nip_time: np.ndarray,
+        threshold_std: float,
+        intermediates: dict | None
+) -> np.ndarray:
+    """Mean smoothed firing rate of each channel over the baseline recording"""
+    # The MATLAB baseline threshold is computed on the baseline before it is filtered
+    baseline_std = _shared_intermediate(
+        intermediates, 'baseline_std', lambda: np.std(baseline_data, axis=0, ddof=1, dtype=np.float64))
+    baseline_filtered = _shared_intermediate(
+        intermediates, 'spike_hpf_baseline', lambda: spike_highpass(baseline_data))
+    return _smoothed_firing_rates(baseline_filtered, baseline_std * threshold_std, baseline_nip_time).mean(axis=0)
+
+
+def compute_nfr_features(
+        neural_data: np.ndarray,
+        kdf_nip_time: np.ndarray,
+        baseline_data: np.ndarray,
+        baseline_nip_time: np.ndarray,
+        feature_params: dict,
+        intermediates: dict | None = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Neural firing rate features. Port of bhm_nfr.makeNeuralFeatures_NS5.
+    :param neural_data: (T x C) scaled 30 kHz training data
+    :param kdf_nip_time: (N, ) KDF NIP timestamps of the training data
+    :param baseline_data: (Tb x C) scaled 30 kHz baseline data
+    :param baseline_nip_time: (Nb, ) KDF NIP timestamps of the baseline data
+    :param feature_params: 'nfr' section of feature_extraction_params
+    :param intermediates: optional dict shared between extractors (see extract_feature_sets)
+    :return: tuple of (N x C) features and (N-1, ) per-frame computation times
+    """
+    threshold_std = feature_params['spike_threshold_std']
+    neural_baseline = _shared_intermediate(intermediates, 'nfr_baseline', lambda: _nfr_baseline_rates(
+        baseline_data, baseline_nip_time, threshold_std, intermediates))
+
+    neural_filtered = _shared_intermediate(intermediates, 'spike_hpf_neural', lambda: spike_highpass(neural_data))
+    thresholds = np.std(neural_filtered, axis=0, ddof=1, dtype=np.float64) * threshold_std
+    timer = time.perf_counter()
+    rates = _smoothed_firing_rates(neural_filtered, thresholds, kdf_nip_time)
+    features = np.zeros((len(kdf_nip_time.flatten()), neural_data.shape[1]))
+    features[:len(rates)] = rates - neural_baseline
+    return features, _amortized_times(timer, len(rates))
+
+
+def common_average_reference(block: np.ndarray, array_channels: int | None = None) -> np.ndarray:
+    """
+    Subtracts the common average reference from a block in place: the mean over all channels, or over each
+    consecutive group of `array_channels` channels (one reference per USEA).
+    :param block: (T x C) C-contiguous float array, modified in place
+    :param array_channels: channels per array. None references all channels together
+    :return: block
+    """
+    n_chans = block.shape[1]
+    array_channels = array_channels or n_chans
+    if n_chans % array_channels:
+        raise ValueError(f"{n_chans} channels cannot be split into arrays of {array_channels} channels")
+    arrays = block.reshape(len(block), n_chans // array_channels, array_channels)
+    arrays -= arrays.mean(axis=2, keepdims=True)
+    return block
+
+
+def sbp_bandpass_2k(neural_data: np.ndarray, feature_params: dict) -> np.ndarray:
+    """
+    :param neural_data: (T x C) scaled 30 kHz data
+    :param feature_params: 'sbp' section of feature_extraction_params
+    :return: (T2k x C) float32 zero-phase band-passed signal decimated to 2 kHz, before rectification
+    """
+    # butter() doubles the order of band-pass designs, so bpf_order is the order of the final filter
+    b, a = signal.butter(
+        feature_params['bpf_order'] // 2,
+        [feature_params['hpf_cutoff_hz'] / (FS_NS5 / 2), feature_params['lpf_cutoff_hz'] / (FS_NS5 / 2)],
+        'bandpass'
+    )
+    return filtfilt_channels(b, a, neural_data, decimate=SBP_DOWNSAMPLE_30KHZ_TO_2KHZ)
+
+
+def compute_sbp_features(
+        neural_data: np.ndarray,
+        kdf_nip_time: np.ndarray,
+        feature_params: dict,
+        car: bool = False,
+        intermediates: dict | None = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Spiking-band power features (Nason et al. 2020). Port of frm_sbp.compute_sbp_features.
+    SBP-RAW and SBP-CAR share the band-passed 2 kHz signal, so both come from one filtering pass over the raw
+    data. The band-pass, the odd extension and the decimation are linear, so the common average reference is
+    subtracted after them, one row block at a time while the windows are summed.
+    :param neural_data: (T x C) scaled 30 kHz training data
+    :param kdf_nip_time: (N, ) KDF NIP timestamps of the training data
+    :param feature_params: 'sbp' section of feature_extraction_params
+    :param car: re-reference to the common average (per array of `car_array_channels` channels if set)
+    :param intermediates: optional dict shared between extractors (see extract_feature_sets)
+    :return: tuple of (N x C) features and per-frame computation times
+    """
+    bandpassed_2k = _shared_intermediate(
+        intermediates, 'sbp_bandpass_2k', lambda: sbp_bandpass_2k(neural_data, feature_params))
+    array_channels = feature_params.get('car_array_channels')
+    # Re-referencing works on a float64 copy of each row block, the only extra buffer
+    rectify = (lambda block: np.abs(common_average_reference(np.array(block, dtype=np.float64), array_channels))) \
+        if car else np.abs
+    timer = time.perf_counter()
+    features = sbp_from_rectified(bandpassed_2k, len(kdf_nip_time.flatten()), feature_params['window_length_sec'],
+                                  block_transform=rectify)
+    return features, _amortized_times(timer, len(range(0, len(bandpassed_2k), SBP_DOWNSAMPLE_2KHZ_TO_30HZ)))
+
+
+def sbp_from_rectified(
+        rectified_2k: np.ndarray,
+        n_frames_kdf: int,
+        window_length_sec: float,
+        frame_step: int = SBP_DOWNSAMPLE_2KHZ_TO_30HZ,
+        block_transform=None
+) -> np.ndarray:
+    """
+    SBP frames from the rectified, band-passed 2 kHz signal (e.g. a memory-mapped filtered-signal cache).
+    :param rectified_2k: (T2k x C) |band-passed signal| at 2 kHz
+    :param n_frames_kdf: number of KDF frames to match
+    :param window_length_sec: sliding window length
+    :param frame_step: 2 kHz samples between frames (66 for the 30 Hz loop)
+    :param block_transform: optional row-wise transform applied block by block, e.g. to rectify (and
+           re-reference) a band-passed signal passed as rectified_2k
+    :return: (n_frames_kdf x C) features
+    """
+    frame_idxs = np.arange(0, len(rectified_2k), frame_step)
+    features = windowed_means(rectified_2k, frame_idxs, round(window_length_sec * SBP_FS), block_transform)
+    # Match the KDF frame count by replicating the last frame or truncating
+    if len(features) < n_frames_kdf:
+        features = np.pad(features, ((0, n_frames_kdf - len(features)), (0, 0)), mode='edge')
+    return features[:n_frames_kdf]
+
+
+def rolling_buffer_mav(
+        abs_data: np.ndarray,
+        kdf_nip_time: np.ndarray,
+        initial_width: int
+) -> np.ndarray:
+    """
+    Mean absolute value of the rolling sample buffer in zmh_mav.makeRollingPowerFeatures_zmh.
+    The MATLAB buffer starts `initial_width` columns wide, grows to the longest frame seen so far and
+    keeps the leading columns of the previous buffer when a frame is shorter than the buffer. Only the
+    buffer bookkeeping is done per frame; the sample ranges it holds are summed with range_sums, so the
+    cost does not depend on the buffer width.
+    :param abs_data: (T x C) rectified signal, e.g. a memory-mapped filtered-signal cache
+    :return: (N-1 x C) array, one row per frame
+    """
+    starts, stops = compute_loop_frames(kdf_nip_time, len(abs_data))
+
+    # The buffer is a list of (start, length) sample ranges in column order; None marks zero columns
+    buffer = [(None, initial_width)]
+    width = initial_width
+    widths = np.empty(len(starts))
+    range_frames, range_starts, range_stops = [], [], []
+    for frame, (frame_start, frame_stop) in enumerate(zip(starts, stops)):
+        frame_len = frame_stop - frame_start
+        kept, n_kept = [], max(width - frame_len, 0)
+        for seg_start, seg_len in buffer:
+            if n_kept == 0:
+                break
+            take = min(seg_len, n_kept)
+            kept.append((seg_start, take))
+            n_kept -= take
+        buffer = [(frame_start, frame_len)] + kept
+        width = max(width, frame_len)
+        widths[frame] = width
+        for seg_start, seg_len in buffer:
+            if seg_start is not None and seg_len > 0:
+                range_frames.append(frame)
+                range_starts.append(seg_start)
+                range_stops.append(seg_start + seg_len)
+
+    totals = np.zeros((len(starts), abs_data.shape[1]))
+    np.add.at(totals, np.array(range_frames, dtype=np.int64),
+              range_sums(abs_data, np.array(range_starts, dtype=np.int64), np.array(range_stops, dtype=np.int64)))
+    return totals / widths[:, None]
+
+
+def _mav_baseline(
+        baseline_data: np.ndarray,
+        baseline_nip_time: np.ndarray,
+        initial_width: int,
+        intermediates: dict | None
+) -> np.ndarray:
+    """Mean rolling-buffer MAV of each channel over the baseline recording"""
+    baseline_abs = np.abs(_shared_intermediate(
+        intermediates, 'spike_hpf_baseline', lambda: spike_highpass(baseline_data)))
+    return rolling_buffer_mav(baseline_abs, baseline_nip_time, initial_width).mean(axis=0)
+
+
+def compute_mav_features(
+        neural_data: np.ndarray,
+        kdf_nip_time: np.ndarray,
+        baseline_data: np.ndarray,
+        baseline_nip_time: np.ndarray,
+        feature_params: dict,
+        intermediates: dict | None = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Mean absolute value features. Port of zmh_mav.makeRollingPowerFeatures_zmh.
+    :param neural_data: (T x C) scaled 30 kHz training data
+    :param kdf_nip_time: (N, ) KDF NIP timestamps of the training data
+    :param baseline_data: (Tb x C) scaled 30 kHz baseline data
+    :param baseline_nip_time: (Nb, ) KDF NIP timestamps of the baseline data
+    :param feature_params: 'mav' section of feature_extraction_params
+    :param intermediates: optional dict shared between extractors (see extract_feature_sets)
+    :return: tuple of (N x C) features and (N-1, ) per-frame computation times
+    """
+    initial_width = int(np.floor(feature_params['window_length_sec'] / LOOP_TIME_SECONDS))
+
+    neural_baseline = _shared_intermediate(intermediates, 'mav_baseline', lambda: _mav_baseline(
+        baseline_data, baseline_nip_time, initial_width, intermediates))
+
+    neural_abs = np.abs(_shared_intermediate(intermediates, 'spike_hpf_neural', lambda: spike_highpass(neural_data)))
+    timer = time.perf_counter()
+    mav = rolling_buffer_mav(neural_abs, kdf_nip_time, initial_width)
+    features = np.zeros((len(kdf_nip_time.flatten()), neural_data.shape[1]))
+    features[:len(mav)] = mav - neural_baseline
+    return features, _amortized_times(timer, len(mav))
+
+
+def _wavelet_filters(wavelet: str) -> tuple[np.ndarray, np.ndarray]:
+    if wavelet not in WAVELET_DEC_LO:
+        raise ValueError(f"Unsupported wavelet '{wavelet}'. Choose from {list(WAVELET_DEC_LO)}")
+    dec_lo = WAVELET_DEC_LO[wavelet]
+    signs = np.where(np.arange(len(dec_lo)) % 2 == 0, -1.0, 1.0)
+    dec_hi = signs * dec_lo[::-1]
+    return dec_lo, dec_hi
+
+
+def _dwt_step(x: np.ndarray, dec_lo: np.ndarray, dec_hi: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Single-level DWT along the last axis with half-point symmetric extension.
+    Matches MATLAB dwt with dwtmode('sym') and pywt.dwt(mode='symmetric').
+    """
+    filt_len = len(dec_lo)
+    n_out = (x.shape[-1] + filt_len - 1) // 2
+    pad_width = [(0, 0)] * (x.ndim - 1) + [(filt_len - 1, filt_len - 1)]
+    extended = np.pad(x, pad_width, mode='symmetric')
+    approx = np.zeros(x.shape[:-1] + (n_out,))
+    detail = np.zeros(x.shape[:-1] + (n_out,))
+    # Only the decimated outputs of the 'valid' convolution are evaluated
+    for k in range(filt_len):
+        taps = extended[..., filt_len - k:filt_len - k + 2 * n_out:2]
+        approx += dec_lo[k] * taps
+        detail += dec_hi[k] * taps
+    return approx, detail
+
+
+def _wavedec(x: np.ndarray, wavelet: str, levels: int) -> tuple[list[np.ndarray], np.ndarray]:
+    """:return: detail coefficients for levels 1..levels and the final approximation"""
+    dec_lo, dec_hi = _wavelet_filters(wavelet)
+    approx = np.asarray(x, dtype=np.float64)
+    details = []
+    for _ in range(levels):
+        approx, detail = _dwt_step(approx, dec_lo, dec_hi)
+        details.append(detail)
+    return details, approx
+
+
+def wavedec_details(x: np.ndarray, wavelet: str, levels: int) -> list[np.ndarray]:
+    """
+    Multi-level wavelet decomposition along the last axis, batched over the leading axes.
+    :param x: (..., T) array
+    :param wavelet: wavelet name, 'db1' or 'db4'
+    :param levels: number of decomposition levels
+    :return: list of detail coefficients for levels 1..levels
+    """
+    return _wavedec(x, wavelet, levels)[0]
+
+
+def compute_dwt_thresholds(
+        baseline_data: np.ndarray,
+        wavelet: str,
+        levels: int,
+        block_size: int = CHANNEL_BLOCK_SIZE
+) -> np.ndarray:
+    """
+    Per-channel, per-level hard thresholds from the baseline recording.
+    Port of frm_wavedec.compute_dwt_thresholds (universal threshold with Han et al. level scaling).
+    :param baseline_data: (Tb x C) scaled 30 kHz baseline data
+    :param wavelet: wavelet name
+    :param levels: number of decomposition levels
+    :param block_size: number of channels decomposed at once
+    :return: (C x levels) array of thresholds
+    """
+    n_chans = baseline_data.shape[1]
+    thresholds = np.zeros((n_chans, levels))
+    for chan_start in range(0, n_chans, block_size):
+        chans = slice(chan_start, chan_start + block_size)
+        details = wavedec_details(baseline_data[:, chans].T, wavelet, levels)
+        for level, det_coefs in enumerate(details, start=1):
+            sigma = np.median(np.abs(det_coefs), axis=-1) / 0.6745  # Noise intensity for each level
+            base_thresh = sigma * np.sqrt(np.log(det_coefs.shape[-1]))  # Donoho et al. 1994
+            if level == 1:
+                thresholds[chans, level - 1] = base_thresh
+            elif level == levels:
+                thresholds[chans, level - 1] = base_thresh / np.sqrt(level)
+            else:
+                thresholds[chans, level - 1] = base_thresh / np.log(level + 1)
+    return thresholds
+
+
+def _thresholded_energy(det_coefs: np.ndarray, thresholds: np.ndarray) -> np.ndarray:
+    """Energy of the coefficients (last axis) whose magnitude exceeds `thresholds` (broadcast over the rest)"""
+    kept = np.abs(det_coefs) > thresholds[..., None]
+    return np.sum(np.where(kept, det_coefs, 0.0) ** 2, axis=-1)
+
+
+def dwt_frame_energies(
+        frames: np.ndarray,
+        thresholds: np.ndarray,
+        wavelet: str,
+        levels: int
+) -> np.ndarray:
+    """
+    Energy of the hard-thresholded detail coefficients of each frame.
+    :param frames: (F x C x frame_len) array of frames
+    :param thresholds: (C x levels) array from compute_dwt_thresholds
+    :param wavelet: wavelet name
+    :param levels: number of decomposition levels
+    :return: (F x C*levels) array ordered as [chan 1 levels 1..L, chan 2 levels 1..L, ...]
+    """
+    details = wavedec_details(frames, wavelet, levels)
+    energies = np.empty(frames.shape[:2] + (levels,))
+    for level, det_coefs in enumerate(details):
+        energies[..., level] = _thresholded_energy(det_coefs, thresholds[None, :, level])
+    return energies.reshape(frames.shape[0], -1)
+
+
+def _dwt_interior_bounds(level: int, filt_len: int, frame_len: int) -> tuple[int, int]:
+    """
+    First and last index of the level's coefficients that only depend on samples inside the frame, i.e. are
+    untouched by the symmetric extension. Coefficient i depends on frame samples
+    [2^level (i+1) - 1 - (2^level - 1)(filt_len - 1), 2^level (i+1) - 1].
+    """
+    step = 2 ** level
+    reach = (step - 1) * (filt_len - 1)
+    return max(-(-(reach + 1 - step) // step), 0), frame_len // step - 1
+
+
+def plan_shared_dwt_levels(frame_len: int, filt_len: int, levels: int, frame_step: float) -> int:
+    """
+    Number of leading levels that dwt_stream_energies takes from the shared stream decomposition.
+    A shared level costs about `frame_step` filter outputs per frame, plus as much again for the prefix sums,
+    against frame_len / 2^(level-1) for a frame-by-frame decomposition, so levels are shared while the frames
+    overlap enough to pay for it.
+    :param frame_len: DWT frame length
+    :param filt_len: wavelet filter length
+    :param levels: number of decomposition levels
+    :param frame_step: typical number of samples between consecutive frame ends
+    :return: number of shared levels, 0 to decompose every frame on its own
+    """
+    n_shared = 0
+    for level in range(1, levels + 1):
+        first, last = _dwt_interior_bounds(level, filt_len, frame_len)
+        if first > last or frame_len / 2 ** (level - 1) <= 2 * frame_step:
+            break
+        n_shared = level
+    return n_shared
+
+
+def _atrous_step(
+        approx: np.ndarray,
+        dec_lo: np.ndarray,
+        dec_hi: np.ndarray,
+        dilation: int
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Undecimated (a trous) DWT level along the last axis: out[t] = sum_k filt[k] approx[t - dilation k].
+    The taps are accumulated in the order of _dwt_step, so decimating the output reproduces its
+    interior coefficients bit for bit. The first dilation * (filt_len - 1) outputs lack history.
+    """
+    n_out = approx.shape[-1]
+    new_approx = np.zeros(approx.shape)
+    detail = np.zeros(approx.shape)
+    for k in range(len(dec_lo)):
+        shift = min(dilation * k, n_out)
+        taps = approx[..., :n_out - shift]
+        new_approx[..., shift:] += dec_lo[k] * taps
+        detail[..., shift:] += dec_hi[k] * taps
+    return new_approx, detail
+
+
+def dwt_stream_energies(
+        neural_data: np.ndarray,
+        frame_stops: np.ndarray,
+        thresholds: np.ndarray,
+        wavelet: str,
+        levels: int,
+        frame_len: int,
+        n_shared: int | None = None,
+        block_frames: int = DWT_STREAM_BLOCK_FRAMES,
+        block_size: int = CHANNEL_BLOCK_SIZE
+) -> np.ndarray:
+    """
+    dwt_frame_energies of every frame, reusing the coefficients that overlapping frames share.
+    Frame f is the `frame_len` samples ending at frame_stops[f], zero-padded at the start of the recording.
+    Its level-j coefficients away from the frame edges are the undecimated (a trous) decomposition of the
+    stream sampled every 2^j samples from the frame start, so the first `n_shared` levels are computed once
+    for a stretch of frames, and their thresholded energies are summed with phase-strided prefix sums.
+    Only the few edge coefficients affected by the symmetric extension are decomposed per frame, from short
+    segments at both frame edges. The remaining levels continue frame by frame from the level-n_shared
+    approximation, which is 2^n_shared times shorter than the frame.
+    :param neural_data: (T x C) scaled 30 kHz data
+    :param frame_stops: (F, ) non-decreasing 0-based exclusive frame stops
+    :param thresholds: (C x levels) array from compute_dwt_thresholds
+    :param wavelet: wavelet name
+    :param levels: number of decomposition levels
+    :param frame_len: DWT frame length
+    :param n_shared: number of shared levels. Defaults to plan_shared_dwt_levels for the median frame step
+    :param block_frames: number of frames per stretch of stream decomposed at once
+    :param block_size: number of channels decomposed at once
+    :return: (F x C*levels) array ordered as dwt_frame_energies
+    """
+    dec_lo, dec_hi = _wavelet_filters(wavelet)
+    filt_len = len(dec_lo)
+    frame_stops = np.asarray(frame_stops, dtype=np.int64)
+    if n_shared is None:
+        frame_step = np.median(np.diff(frame_stops)) if len(frame_stops) > 1 else np.inf
+        n_shared = plan_shared_dwt_levels(frame_len, filt_len, levels, frame_step)
+    bounds = [_dwt_interior_bounds(level, filt_len, frame_len) for level in range(1, n_shared + 1)]
+    if n_shared > levels or any(first > last for first, last in bounds):
+        raise ValueError(f"Cannot share {n_shared} of {levels} levels with {frame_len}-sample {wavelet} frames")
+
+    n_chans = neural_data.shape[1]
+    features = np.empty((len(frame_stops), n_chans * levels))
+    if n_shared == 0:
+        for block_start in range(0, len(frame_stops), DWT_FRAME_BLOCK_SIZE):
+            block_stops = frame_stops[block_start:block_start + DWT_FRAME_BLOCK_SIZE]
+            frames = np.zeros((len(block_stops), n_chans, frame_len))
+            for i, stop in enumerate(block_stops):
+                start = max(stop - frame_len, 0)
+                frames[i, :, frame_len - (stop - start):] = neural_data[start:stop].T
+            features[block_start:block_start + len(block_stops)] = dwt_frame_energies(
+                frames, thresholds, wavelet, levels)
+        return features
+
+    # Edge segments: the left one holds every coefficient left of the interior, the right one every
+    # coefficient right of it. The right segment starts on a multiple of 2^n_shared so its levels stay aligned.
+    shared_step = 2 ** n_shared
+    left_len = max(2 ** level * first for level, (first, _) in enumerate(bounds, start=1))
+    right_start = min(2 ** level * (last + 2) - 1 - (2 ** level - 1) * (filt_len - 1)
+                      for level, (_, last) in enumerate(bounds, start=1))
+    right_start = max(min(right_start, frame_len - 1) // shared_step * shared_step, 0)
+    left_offsets, right_offsets = np.arange(max(left_len, 1)), np.arange(right_start, frame_len)
+
+    # Frame f covers [frame_stops[f], frame_stops[f] + frame_len) of the stream padded with frame_len zeros
+    for block_start in range(0, len(frame_stops), block_frames):
+        block_rows = slice(block_start, block_start + block_frames)
+        frame_starts = frame_stops[block_rows]
+        stretch_start, stretch_stop = frame_starts[0], frame_starts[-1] + frame_len
+        offsets = frame_starts - stretch_start
+        for chan_start in range(0, n_chans, block_size):
+            chans = slice(chan_start, min(chan_start + block_size, n_chans))
+            data_start = max(stretch_start - frame_len, 0)
+            stretch = np.zeros((chans.stop - chans.start, stretch_stop - stretch_start))
+            stretch[:, data_start + frame_len - stretch_start:] = neural_data[data_start:stretch_stop - frame_len,
+                                                                              chans].T
+            left_details, left_approx = _wavedec(stretch[:, offsets[:, None] + left_offsets], wavelet, n_shared)
+            right_details, right_approx = _wavedec(stretch[:, offsets[:, None] + right_offsets], wavelet, n_shared)
+
+            energies = np.empty(stretch.shape[:1] + (len(offsets), levels))
+            approx = stretch
+            for level, (first, last) in enumerate(bounds, start=1):
+                step = 2 ** level
+                approx, detail = _atrous_step(approx, dec_lo, dec_hi, step // 2)
+                level_thresholds = thresholds[chans, level - 1]
+                kept = np.abs(detail) > level_thresholds[:, None]
+                detail_energy = np.where(kept, detail, 0.0) ** 2
+                n_rows = -(-detail_energy.shape[1] // step)
+                padded = np.zeros((len(detail_energy), n_rows * step))
+                padded[:, :detail_energy.shape[1]] = detail_energy
+                cumulative = np.cumsum(padded.reshape(len(padded), n_rows, step), axis=1).reshape(len(padded), -1)
+                interior_stop = offsets + step * (last + 1) - 1
+                interior_before = offsets + step * first - 1
+                energies[..., level - 1] = cumulative[:, interior_stop] - np.where(
+                    interior_before >= 0, cumulative[:, np.maximum(interior_before, 0)], 0.0)
+                right_first = last + 1 - right_start // step
+                energies[..., level - 1] += _thresholded_energy(left_details[level - 1][..., :first],
+                                                                level_thresholds[:, None])
+                energies[..., level - 1] += _thresholded_energy(right_details[level - 1][..., right_first:],
+                                                                level_thresholds[:, None])
+
+            if levels > n_shared:
+                first, last = bounds[-1]
+                interior = offsets[:, None] + shared_step * (np.arange(first, last + 1) + 1) - 1
+                frame_approx = np.concatenate([left_approx[..., :first], approx[:, interior],
+                                               right_approx[..., last + 1 - right_start // shared_step:]], axis=-1)
+                deep_details, _ = _wavedec(frame_approx, wavelet, levels - n_shared)
+                for level, det_coefs in enumerate(deep_details, start=n_shared):
+                    energies[..., level] = _thresholded_energy(det_coefs, thresholds[chans, level, None])
+            features[block_rows, chans.start * levels:chans.stop * levels] = (
+                energies.transpose(1, 0, 2).reshape(len(offsets), -1))
+    return features
+
+
+def compute_dwt_features(
+        neural_data: np.ndarray,
+        kdf_nip_time: np.ndarray,
+        baseline_data: np.ndarray,
+        feature_params: dict,
+        wavelet_key: str,
+        frame_block_size: int = DWT_STREAM_BLOCK_FRAMES,
+        intermediates: dict | None = None,
+        n_shared: int | None = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Thresholded DWT energy features. Port of frm_wavedec.compute_dwt_features_timed.
+    Each KDF frame is the `frame_len` samples ending at the KDF timestamp, zero-padded at the start of
+    the recording. The overlapping frames are decomposed together with dwt_stream_energies.
+    :param neural_data: (T x C) scaled 30 kHz training data
+    :param kdf_nip_time: (N, ) KDF NIP timestamps of the training data
+    :param baseline_data: (Tb x C) scaled 30 kHz baseline data
+    :param feature_params: 'dwt' section of feature_extraction_params
+    :param wavelet_key: 'db1' or 'db4', selects `{key}_name` and `{key}_levels` from feature_params
+    :param frame_block_size: number of frames decomposed at once
+    :param intermediates: optional dict shared between extractors (see extract_feature_sets)
+    :param n_shared: number of levels shared between overlapping frames, 0 decomposes every frame on its own.
+           Defaults to plan_shared_dwt_levels
+    :return: tuple of (N x C*levels) features and (N, ) per-frame computation times
+    """
+    wavelet = feature_params[f'{wavelet_key}_name']
+    levels = feature_params[f'{wavelet_key}_levels']
+    frame_len = feature_params['frame_len']
+    thresholds = _shared_intermediate(intermediates, f'dwt_thresholds_{wavelet_key}',
+                                      lambda: compute_dwt_thresholds(baseline_data, wavelet, levels))
+
+    n_samples = len(neural_data)
+    kdf_nip_time = kdf_nip_time.flatten()
+    # 0-based exclusive stop of each frame: the MATLAB 1-based index of the KDF sample
+    frame_stops = np.minimum(np.ceil(kdf_nip_time - kdf_nip_time[0]).astype(np.int64) + 1, n_samples)
+
+    timer = time.perf_counter()
+    features = dwt_stream_energies(neural_data, frame_stops, thresholds, wavelet, levels, frame_len, n_shared,
+                                   frame_block_size)
+    return features, _amortized_times(timer, len(frame_stops))
+
+
+def _amortized_times(timer: float, n_frames: int) -> np.ndarray:
+    """
+    Per-frame computation times for the vectorized extractors: the elapsed time since `timer`
+    spread evenly over `n_frames`.
+    """
+    return np.full(n_frames, (time.perf_counter() - timer) / max(n_frames, 1))
+
+
+FEATURE_EXTRACTORS = {
+    'NFR': lambda d, t, bd, bt, p, c: compute_nfr_features(d, t, bd, bt, p['nfr'], c),
+    'SBP-RAW': lambda d, t, bd, bt, p, c: compute_sbp_features(d, t, p['sbp'], intermediates=c),
+    'SBP-CAR': lambda d, t, bd, bt, p, c: compute_sbp_features(d, t, p['sbp'], car=True, intermediates=c),
+    'MAV': lambda d, t, bd, bt, p, c: compute_mav_features(d, t, bd, bt, p['mav'], c),
+    'DWT-DB1': lambda d, t, bd, bt, p, c: compute_dwt_features(d, t, bd, p['dwt'], 'db1', intermediates=c),
+    'DWT-DB4': lambda d, t, bd, bt, p, c: compute_dwt_features(d, t, bd, p['dwt'], 'db4', intermediates=c),
+}
+# Intermediates each extractor reads from/stores in the shared dict (see extract_feature_sets)
+FEATURE_INTERMEDIATES = {
+    'NFR': ('spike_hpf_neural', 'spike_hpf_baseline', 'baseline_std', 'nfr_baseline'),
+    'MAV': ('spike_hpf_neural', 'spike_hpf_baseline', 'mav_baseline'),
+    'SBP-RAW': ('sbp_bandpass_2k',),
+    'SBP-CAR': ('sbp_bandpass_2k',),
+    'DWT-DB1': ('dwt_thresholds_db1',),
+    'DWT-DB4': ('dwt_thresholds_db4',),
+}
+# Baseline-derived intermediates that are cached in baseline_stats.h5, with the parameters they depend on
+BASELINE_STATS_FILENAME = "baseline_stats.h5"
+BASELINE_STAT_PARAMS = {
+    'NFR': lambda p: {'baseline_std': {}, 'nfr_baseline': p['nfr']},
+    'MAV': lambda p: {'mav_baseline': p['mav']},
+    'DWT-DB1': lambda p: {'dwt_thresholds_db1': {'wavelet': p['dwt']['db1_name'], 'levels': p['dwt']['db1_levels']}},
+    'DWT-DB4': lambda p: {'dwt_thresholds_db4': {'wavelet': p['dwt']['db4_name'], 'levels': p['dwt']['db4_levels']}},
+}
+
+
+def extract_features(
+        feature_set_id: str,
+        neural_data: np.ndarray,
+        kdf_nip_time: np.ndarray,
+        baseline_data: np.ndarray,
+        baseline_nip_time: np.ndarray,
+        feature_params: dict,
+        intermediates: dict | None = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Dispatches to the extractor for `feature_set_id`, mirroring the switch in extract_features.m.
+    :param feature_set_id: one of FEATURE_EXTRACTORS
+    :param neural_data: (T x C) scaled 30 kHz training data
+    :param kdf_nip_time: (N, ) KDF NIP timestamps of the training data
+    :param baseline_data: (Tb x C) scaled 30 kHz baseline data
+    :param baseline_nip_time: (Nb, ) KDF NIP timestamps of the baseline data
+    :param feature_params: feature_extraction_params section of config.yaml
+    :param intermediates: optional dict of intermediates shared between extractors
+    :return: tuple of (N x F) features and per-frame computation times
+    """
+    if feature_set_id not in FEATURE_EXTRACTORS:
+        raise ValueError(f"Unknown feature set '{feature_set_id}'. Choose from {list(FEATURE_EXTRACTORS)}")
+    logger.info(f"Commencing feature extraction for {feature_set_id}")
+    timer = time.perf_counter()
+    features, computation_times = FEATURE_EXTRACTORS[feature_set_id](
+        neural_data, kdf_nip_time, baseline_data, baseline_nip_time, feature_params, intermediates)
+    logger.info(f"Feature extraction completed in {time.perf_counter() - timer:0.2f} sec "
+                f"({features.nbytes / 1024**2:0.1f} MB, {features.shape[1]} features)")
+    return features, computation_times
+
+
+def extract_feature_sets(
+        feature_set_ids: list[str],
+        neural_data: np.ndarray,
+        kdf_nip_time: np.ndarray,
+        baseline_data: np.ndarray,
+        baseline_nip_time: np.ndarray,
+        feature_params: dict,
+        intermediates: dict | None = None
+):
+    """
+    Extracts several feature sets from one load of the raw data, sharing intermediates such as the
+    spike-band high-pass signals between extractors. Sets that share intermediates run first, and each
+    intermediate is freed as soon as no remaining set needs it.
+    :param feature_set_ids: feature sets to extract, each one of FEATURE_EXTRACTORS
+    :param intermediates: optional pre-populated intermediates, e.g. from read_baseline_stats
+    :return: generator of (feature_set_id, features, computation_times), one per feature set
+    """
+    unknown = [feature_set_id for feature_set_id in feature_set_ids if feature_set_id not in FEATURE_EXTRACTORS]
+    if unknown:
+        raise ValueError(f"Unknown feature sets {unknown}. Choose from {list(FEATURE_EXTRACTORS)}")
+
+    def shares_intermediates(feature_set_id):
+        keys = set(FEATURE_INTERMEDIATES.get(feature_set_id, ()))
+        others = [other for other in feature_set_ids if other != feature_set_id]
+        return any(keys & set(FEATURE_INTERMEDIATES.get(other, ())) for other in others)
+    ordered_ids = sorted(feature_set_ids, key=lambda feature_set_id: not shares_intermediates(feature_set_id))
+    intermediates = {} if intermediates is None else intermediates
+    for i, feature_set_id in enumerate(ordered_ids):
+        features, computation_times = extract_features(
+            feature_set_id, neural_data, kdf_nip_time, baseline_data, baseline_nip_time, feature_params, intermediates)
+        still_needed = {key for later_id in ordered_ids[i + 1:] for key in FEATURE_INTERMEDIATES.get(later_id, ())}
+        for key in set(intermediates) - still_needed:
+            del intermediates[key]
+        yield feature_set_id, features, computation_times
+
+
+def baseline_stat_params(feature_set_ids: list[str], feature_params: dict) -> dict:
+    """
+    Baseline statistics needed by a list of feature sets.
+    :param feature_set_ids: feature sets, each one of FEATURE_EXTRACTORS
+    :param feature_params: feature_extraction_params
+    :return: dict of intermediate key -> parameters its value depends on
+    """
+    stat_params = {}
+    for feature_set_id in feature_set_ids:
+        if feature_set_id in BASELINE_STAT_PARAMS:
+            stat_params.update(BASELINE_STAT_PARAMS[feature_set_id](feature_params))
+    return stat_params
+
+
+def _stat_dataset_name(key: str, params: dict) -> str:
+    """Each statistic is stored once per parameter set, as /<key>/<hash of params>"""
+    params_hash = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+    return f"{key}/{params_hash}"
+
+
+def compute_baseline_stats(
+        feature_set_ids: list[str],
+        baseline_data: np.ndarray,
+        baseline_nip_time: np.ndarray,
+        feature_params: dict,
+        stats: dict | None = None
+) -> dict:
+    """
+    Computes the baseline-derived intermediates of the feature extractors: the raw baseline noise std,
+    the NFR and MAV baseline levels and the DWT thresholds. The baseline is high-pass filtered at most once.
+    :param feature_set_ids: feature sets, each one of FEATURE_EXTRACTORS
+    :param baseline_data: (Tb x C) scaled 30 kHz baseline data
+    :param baseline_nip_time: (Nb, ) KDF NIP timestamps of the baseline data
+    :param feature_params: feature_extraction_params
+    :param stats: already available statistics, which are not recomputed
+    :return: dict of intermediate key -> array, with the keys of baseline_stat_params
+    """
+    stat_params = baseline_stat_params(feature_set_ids, feature_params)
+    intermediates = dict(stats or {})
+    if 'nfr_baseline' in stat_params:
+        _shared_intermediate(intermediates, 'nfr_baseline', lambda: _nfr_baseline_rates(
+            baseline_data, baseline_nip_time, feature_params['nfr']['spike_threshold_std'], intermediates))
+    if 'mav_baseline' in stat_params:
+        initial_width = int(np.floor(feature_params['mav']['window_length_sec'] / LOOP_TIME_SECONDS))
+        _shared_intermediate(intermediates, 'mav_baseline', lambda: _mav_baseline(
+            baseline_data, baseline_nip_time, initial_width, intermediates))
+    for wavelet_key in ['db1', 'db4']:
+        key = f'dwt_thresholds_{wavelet_key}'
+        if key in stat_params:
+            _shared_intermediate(intermediates, key, lambda params=stat_params[key]: compute_dwt_thresholds(
+                baseline_data, params['wavelet'], params['levels']))
+    if 'baseline_std' in stat_params:
+        _shared_intermediate(intermediates, 'baseline_std', lambda: np.std(
+            baseline_data, axis=0, ddof=1, dtype=np.float64))
+    return {key: intermediates[key] for key in stat_params}
+
+
+def read_baseline_stats(filepath: Path, stat_params: dict) -> dict:
+    """
+    Reads the cached baseline statistics computed with matching parameters.
+    :param filepath: baseline_stats.h5, next to the session's kinematics.h5
+    :param stat_params: output of baseline_stat_params
+    :return: dict of intermediate key -> array. Statistics missing from the cache are left out
+    """
+    if not filepath.exists():
+        return {}
+    stats = {}
+    with h5py.File(filepath, 'r') as f:
+        for key, params in stat_params.items():
+            name = _stat_dataset_name(key, params)
+            if name in f:
+                stats[key] = f[name][()]
+    return stats
+
+
+def write_baseline_stats(filepath: Path, stats: dict, stat_params: dict):
+    """
+    Adds statistics to baseline_stats.h5, replacing entries computed with the same parameters.
+    :param filepath: baseline_stats.h5
+    :param stats: dict of intermediate key -> array, e.g. from compute_baseline_stats
+    :param stat_params: output of baseline_stat_params, covering the keys of stats
+    """
+    filepath.parent.mkdir(parents=True, exist_ok=True)
+    with h5py.File(filepath, 'a') as f:
+        for key, value in stats.items():
+            name = _stat_dataset_name(key, stat_params[key])
+            if name in f:
+                del f[name]
+            f.create_dataset(name, data=np.asarray(value, dtype=np.float64))
+            f[name].attrs['params'] = json.dumps(stat_params[key], sort_keys=True)
+    logger.info(f"Baseline statistics {sorted(stats)} written to {filepath}")
+
+
+class _FrameBuffer:
+    """Samples received since the last loop frame, keeping at most `capacity` (the MAX_DATA_LOOKBACK clip)"""
+    def __init__(self, n_chans: int, capacity: int = MAX_DATA_LOOKBACK):
+        self.data = np.zeros((capacity, n_chans), dtype=np.float32)
+        self.length = 0
+
+    def append(self, block: np.ndarray):
+        capacity, n_new = len(self.data), len(block)
+        if n_new >= capacity:
+            self.data[:] = block[-capacity:]
+            self.length = capacity
+            return
+        overflow = self.length + n_new - capacity
+        if overflow > 0:
+            self.data[:self.length - overflow] = self.data[overflow:self.length]
+            self.length -= overflow
+        self.data[self.length:self.length + n_new] = block
+        self.length += n_new
+
+    def take(self) -> np.ndarray:
+        """:return: view of the buffered samples. Valid until the next append"""
+        frame = self.data[:self.length]
+        self.length = 0
+        return frame
+
+
+class StreamingExtractor(ABC):
+    """
+    Stateful, causal extractor for the real-time 30 Hz loop. Samples can arrive in blocks of any size
+    (e.g. ~1 ms packets) through push; frame closes the current loop frame and returns its feature vector.
+    Unlike the offline extractors, filters are causal and thresholds come from the baseline only.
+    """
+    @abstractmethod
+    def push(self, block: np.ndarray):
+        """
+        Adds newly received samples.
+        :param block: (n x C) scaled 30 kHz samples
+        """
+
+    @abstractmethod
+    def frame(self) -> np.ndarray:
+        """:return: feature vector of the loop frame ending with the last pushed sample"""
+
+    def process(self, block: np.ndarray) -> np.ndarray:
+        """Pushes one loop frame (~33 ms) of samples and returns its feature vector"""
+        self.push(block)
+        return self.frame()
+
+
+class StreamingNFR(StreamingExtractor):
+    """Streaming bhm_nfr.makeNeuralFeatures_NS5: causal high-pass, spike counts, NFR kernel smoothing"""
+    def __init__(self, thresholds: np.ndarray, baseline_rates: np.ndarray):
+        """
+        :param thresholds: (C, ) spike thresholds, e.g. baseline_std * spike_threshold_std
+        :param baseline_rates: (C, ) mean smoothed baseline rates ('nfr_baseline' baseline statistic)
+        """
+        n_chans = len(thresholds)
+        self.thresholds = np.asarray(thresholds, dtype=np.float64)
+        self.baseline_rates = np.asarray(baseline_rates, dtype=np.float64)
+        self._filter = SOSFilter(
+            signal.butter(SPIKE_HPF_ORDER, SPIKE_HPF_CUTOFF_HZ / (FS_NS5 / 2), 'high', output='sos'), n_chans)
+        self._frame = _FrameBuffer(n_chans)
+        self._skip = np.zeros(n_chans, dtype=np.int64)  # refractory samples still to skip in the next frame
+        self._rates = np.zeros((int(np.floor(NFR_KERNEL_WIDTH_SECONDS / LOOP_TIME_SECONDS)), n_chans))
+        self._rate_idx = 0
+
+    def push(self, block: np.ndarray):
+        self._frame.append(self._filter(block))
+
+    def frame(self) -> np.ndarray:
+        frame = self._frame.take()
+        thresholds = self.thresholds
+        crossings = np.where(thresholds < 0, frame <= thresholds, frame >= thresholds) & (thresholds != 0)
+        channels, samples = np.nonzero(crossings.T)
+        after_skip = samples >= self._skip[channels]
+        channels, samples = channels[after_skip], samples[after_skip]
+        accepted = _apply_refractory(channels, samples, SPIKE_REFRACTORY_SAMPLES, len(frame))
+        channels, samples = channels[accepted], samples[accepted]
+
+        last_spikes = np.full(len(thresholds), -SPIKE_REFRACTORY_SAMPLES, dtype=np.int64)
+        np.maximum.at(last_spikes, channels, samples)
+        self._skip = np.maximum(last_spikes + SPIKE_REFRACTORY_SAMPLES - len(frame), 0)
+        self._rates[self._rate_idx] = np.bincount(channels, minlength=len(thresholds)) / LOOP_TIME_SECONDS
+        self._rate_idx = (self._rate_idx + 1) % len(self._rates)
+        return self._rates.mean(axis=0) - self.baseline_rates
+
+
+class StreamingMAV(StreamingExtractor):
+    """Streaming zmh_mav.makeRollingPowerFeatures_zmh: causal high-pass and the MATLAB rolling sample buffer"""
+    def __init__(self, window_length_sec: float, baseline_mav: np.ndarray):
+        """
+        :param window_length_sec: 'mav' window_length_sec parameter (initial buffer width)
+        :param baseline_mav: (C, ) mean baseline MAV ('mav_baseline' baseline statistic)
+        """
+        n_chans = len(baseline_mav)
+        self.baseline_mav = np.asarray(baseline_mav, dtype=np.float64)
+        self._filter = SOSFilter(
+            signal.butter(SPIKE_HPF_ORDER, SPIKE_HPF_CUTOFF_HZ / (FS_NS5 / 2), 'high', output='sos'), n_chans)
+        self._frame = _FrameBuffer(n_chans)
+        self._width = int(np.floor(window_length_sec / LOOP_TIME_SECONDS))
+        # Frames are clipped to MAX_DATA_LOOKBACK samples, so the buffer never grows past this
+        capacity = max(self._width, MAX_DATA_LOOKBACK)
+        self._buffer, self._spare = np.zeros((capacity, n_chans)), np.zeros((capacity, n_chans))
+
+    def push(self, block: np.ndarray):
+        self._frame.append(self._filter(block))
+
+    def frame(self) -> np.ndarray:
+        frame = self._frame.take()
+        frame_len = len(frame)
+        n_kept = max(self._width - frame_len, 0)
+        # Newest frame first, followed by the leading columns of the previous buffer (as in MATLAB)
+        np.abs(frame, out=self._spare[:frame_len])
+        self._spare[frame_len:frame_len + n_kept] = self._buffer[:n_kept]
+        self._buffer, self._spare = self._spare, self._buffer
+        self._width = max(self._width, frame_len)
+        return self._buffer[:self._width].sum(axis=0) / self._width - self.baseline_mav
+
+
+class StreamingSBP(StreamingExtractor):
+    """Streaming spiking-band power: causal band-pass, 2 kHz decimation and a sliding window of |x|"""
+    def __init__(self, n_chans: int, feature_params: dict, car: bool = False):
+        """
+        :param n_chans: number of channels
+        :param feature_params: 'sbp' section of feature_extraction_params
+        :param car: subtract the common average reference (see common_average_reference) before filtering
+        """
+        self.car, self.car_array_channels = car, feature_params.get('car_array_channels')
+        sos = signal.butter(
+            feature_params['bpf_order'] // 2,
+            [feature_params['hpf_cutoff_hz'] / (FS_NS5 / 2), feature_params['lpf_cutoff_hz'] / (FS_NS5 / 2)],
+            'bandpass', output='sos'
+        )
+        self._filter = SOSFilter(sos, n_chans)
+        self._window = np.zeros((round(feature_params['window_length_sec'] * SBP_FS), n_chans))
+        self._window_idx = 0
+        self._phase = 0  # index in the next block of the next 2 kHz sample
+
+    def push(self, block: np.ndarray):
+        if self.car:
+            block = common_average_reference(np.array(block, dtype=np.float64), self.car_array_channels)
+        downsampled = np.abs(self._filter(block)[self._phase::SBP_DOWNSAMPLE_30KHZ_TO_2KHZ])
+        self._phase = (self._phase - len(block)) % SBP_DOWNSAMPLE_30KHZ_TO_2KHZ
+        window_len = len(self._window)
+        downsampled = downsampled[-window_len:]
+        rows = (self._window_idx + np.arange(len(downsampled))) % window_len
+        self._window[rows] = downsampled
+        self._window_idx = (self._window_idx + len(downsampled)) % window_len
+
+    def frame(self) -> np.ndarray:
+        # Windows shorter than window_len are zero-padded, so the divisor is always window_len
+        return self._window.sum(axis=0) / len(self._window)
+
+
+class StreamingDWT(StreamingExtractor):
+    """Streaming frm_wavedec.compute_dwt_features_timed on a window of the last frame_len samples"""
+    def __init__(self, thresholds: np.ndarray, feature_params: dict, wavelet_key: str):
+        """
+        :param thresholds: (C x levels) thresholds ('dwt_thresholds_{wavelet_key}' baseline statistic)
+        :param feature_params: 'dwt' section of feature_extraction_params
+        :param wavelet_key: 'db1' or 'db4'
+        """
+        self.thresholds = thresholds
+        self.wavelet = feature_params[f'{wavelet_key}_name']
+        self.levels = feature_params[f'{wavelet_key}_levels']
+        # Zero-padded until frame_len samples have been received, as offline
+        self._window = np.zeros((1, len(thresholds), feature_params['frame_len']))
+
+    def push(self, block: np.ndarray):
+        n_new = min(len(block), self._window.shape[-1])
+        if n_new == 0:
+            return
+        self._window[0, :, :-n_new] = self._window[0, :, n_new:]
+        self._window[0, :, -n_new:] = block[-n_new:].T
+
+    def frame(self) -> np.ndarray:
+        return dwt_frame_energies(self._window, self.thresholds, self.wavelet, self.levels)[0]
+
+
+# Constructors taking (n_chans, feature_extraction_params, baseline stats from compute_baseline_stats)
+STREAMING_EXTRACTORS = {
+    'NFR': lambda n, p, s: StreamingNFR(s['baseline_std'] * p['nfr']['spike_threshold_std'], s['nfr_baseline']),
+    'SBP-RAW': lambda n, p, s: StreamingSBP(n, p['sbp']),
+    'SBP-CAR': lambda n, p, s: StreamingSBP(n, p['sbp'], car=True),
+    'MAV': lambda n, p, s: StreamingMAV(p['mav']['window_length_sec'], s['mav_baseline']),
+    'DWT-DB1': lambda n, p, s: StreamingDWT(s['dwt_thresholds_db1'], p['dwt'], 'db1'),
+    'DWT-DB4': lambda n, p, s: StreamingDWT(s['dwt_thresholds_db4'], p['dwt'], 'db4'),
+}
+
+
+def make_streaming_extractor(
+        feature_set_id: str,
+        n_chans: int,
+        feature_params: dict,
+        baseline_stats: dict
+) -> StreamingExtractor:
+    """
+    :param feature_set_id: one of STREAMING_EXTRACTORS
+    :param n_chans: number of channels
+    :param feature_params: feature_extraction_params
+    :param baseline_stats: output of compute_baseline_stats or read_baseline_stats for this feature set
+    :return: streaming extractor
+    """
+    if feature_set_id not in STREAMING_EXTRACTORS:
+        raise ValueError(f"No streaming extractor for {feature_set_id}. Choose from {list(STREAMING_EXTRACTORS)}")
+    return STREAMING_EXTRACTORS[feature_set_id](n_chans, feature_params, baseline_stats)
+
+
+def benchmark_streaming(
+        extractor: StreamingExtractor,
+        blocks: list[np.ndarray],
+        n_warmup: int = 10,
+        budget_sec: float = LOOP_TIME_SECONDS
+) -> dict:
+    """
+    Per-frame latency and allocations of a streaming extractor.
+    Allocations are measured with tracemalloc in a second pass, so tracing does not inflate the latencies.
+    :param extractor: streaming extractor
+    :param blocks: loop frames of (n x C) samples. The first n_warmup are only used for warm-up
+    :param n_warmup: frames processed before measuring
+    :param budget_sec: loop budget per frame
+    :return: dict of latency percentiles [ms], frames over budget and allocated bytes per frame
+    """
+    for block in blocks[:n_warmup]:
+        extractor.process(block)
+    latencies = np.empty(len(blocks) - n_warmup)
+    for i, block in enumerate(blocks[n_warmup:]):
+        timer = time.perf_counter()
+        extractor.process(block)
+        latencies[i] = time.perf_counter() - timer
+
+    allocations = np.empty(len(latencies), dtype=np.int64)
+    tracemalloc.start()
+    for i, block in enumerate(blocks[n_warmup:]):
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        extractor.process(block)
+        allocations[i] = tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+
+    latencies_ms = latencies * 1e3
+    return {
+        'p50_ms': float(np.percentile(latencies_ms, 50)),
+        'p99_ms': float(np.percentile(latencies_ms, 99)),
+        'max_ms': float(np.max(latencies_ms)),
+        'budget_ms': budget_sec * 1e3,
+        'frames_over_budget': int(np.sum(latencies > budget_sec)),
+        'alloc_p50_bytes': int(np.percentile(allocations, 50)),
+        'alloc_max_bytes': int(np.max(allocations)),
+        'deployable': bool(np.max(latencies) <= budget_sec),
+    }
+
+
+def make_benchmark_blocks(
+        n_chans: int,
+        n_frames: int,
+        seed: int = 0
+) -> tuple[list[np.ndarray], np.ndarray]:
+    """
+    Synthetic loop frames of Gaussian noise with ~33 ms jitter, plus a 3 s baseline recording.
+    :return: tuple of (list of (n x C) float32 frames, (T x C) float32 baseline)
+    """
+    rng = np.random.default_rng(seed)
+    frame_lens = rng.integers(985, 1015, size=n_frames)
+    blocks = [rng.standard_normal((frame_len, n_chans), dtype=np.float32) for frame_len in frame_lens]
+    return blocks, rng.standard_normal((3 * FS_NS5, n_chans), dtype=np.float32)
+
+
+def write_feature_file(
+        output_filepath: Path,
+        features: np.ndarray,
+        computation_times: np.ndarray,
+        dtype: str = 'float32',
+        compression: str = 'gzip',
+        chunk_rows: int | None = None
+):
+    """
+    Writes features in the feature store layout: (N x F) rows of samples, chunked along time, shuffled and
+    compressed, with a version attribute. Readers (dataset_utils.read_feature_file, load_session_data) also
+    accept the column-major (F x N) files of extract_features.m.
+    :param output_filepath: destination HDF5 file
+    :param features: (N x F) feature array
+    :param computation_times: (N, ) per-frame computation times
+    :param dtype: 'float64', 'float32' or 'float16' (quantized with a stored scale, ~3 significant digits)
+    :param compression: 'gzip', 'lzf' or 'none'
+    :param chunk_rows: samples per chunk. Defaults to FEATURE_STORE_CHUNK_BYTES worth of rows
+    """
+    if dtype not in FEATURE_STORE_DTYPES:
+        raise ValueError(f"Unsupported feature store dtype '{dtype}'. Choose from {FEATURE_STORE_DTYPES}")
+    if compression not in FEATURE_STORE_COMPRESSIONS:
+        raise ValueError(f"Unsupported compression '{compression}'. Choose from {FEATURE_STORE_COMPRESSIONS}")
+    features = np.asarray(features)
+    n_samples, n_features = features.shape
+    scale = None
+    if dtype == 'float16':
+        # The largest magnitude maps to 2**15, leaving headroom below the float16 maximum (65504)
+        max_abs = np.nanmax(np.abs(features), initial=0.0) if features.size else 0.0
+        scale = np.float32(max_abs / 2 ** 15 if np.isfinite(max_abs) and max_abs > 0 else 1.0)
+        features = features / scale
+    if chunk_rows is None:
+        chunk_rows = FEATURE_STORE_CHUNK_BYTES // (max(n_features, 1) * np.dtype(dtype).itemsize)
+    chunks = (int(np.clip(chunk_rows, 1, max(n_samples, 1))), max(n_features, 1)) if features.size else None
+    filters = {} if compression == 'none' or chunks is None else {'compression': compression, 'shuffle': True}
+
+    output_filepath.parent.mkdir(parents=True, exist_ok=True)
+    with h5py.File(output_filepath, 'w') as f:
+        f.attrs[FEATURE_STORE_VERSION_ATTR] = FEATURE_STORE_VERSION
+        dataset = f.create_dataset('features', data=np.ascontiguousarray(features, dtype=dtype), chunks=chunks,
+                                   **filters)
+        if scale is not None:
+            dataset.attrs[FEATURE_STORE_SCALE_ATTR] = scale
+        f.create_dataset('computation_times', data=np.asarray(computation_times, dtype=np.float64).reshape(1, -1))
+    logger.info(f"HDF5 file successfully written to {output_filepath}")
+
+
+def convert_feature_file(
+        filepath: Path,
+        output_filepath: Path | None = None,
+        dtype: str = 'float32',
+        compression: str = 'gzip'
+) -> bool:
+    """
+    Rewrites a MATLAB-layout feature file in the feature store layout. In place (through a temporary file)
+    unless output_filepath is given.
+    :return: False if the file already is a feature store file and was left untouched
+    """
+    if feature_store_version(filepath) is not None:
+        return False
+    output_filepath = filepath if output_filepath is None else output_filepath
+    features = read_feature_file(filepath)
+    computation_times = read_hdf_dataset(filepath, ['computation_times']).get('computation_times', np.zeros(0))
+    tmp_filepath = output_filepath.with_name(f".{output_filepath.name}.tmp")
+    write_feature_file(tmp_filepath, features, computation_times.flatten(), dtype, compression)
+    os.replace(tmp_filepath, output_filepath)
+    return True
+
+
+def load_session_raw_data(
+        data_root: Path,
+        session_dir: str,
+        full_stream_filename: str,
+        baseline_filename: str,
+        kinematics_filepath: Path,
+        load_baseline: bool = True,
+        session_clock_filepath: Path | None = None
+) -> tuple[np.ndarray, np.ndarray, np.ndarray | None, np.ndarray | None]:
+    """
+    Loads the scaled training and baseline ranges of a session's NS5 file, as in extract_features.m.
+    :param data_root: root dir of the raw data
+    :param session_dir: session directory relative to data_root
+    :param full_stream_filename: NS5 filename
+    :param baseline_filename: baseline KDF filename
+    :param kinematics_filepath: kinematics.h5 written by preprocess_session
+    :param load_baseline: if False, the baseline is not read (e.g. all baseline statistics are cached)
+    :param session_clock_filepath: session_clock.h5 holding the NIP offset. Read from the NS2 file if None
+    :return: tuple of (training data, training KDF NIP times, baseline data, baseline KDF NIP times).
+             The baseline entries are None if load_baseline is False
+    """
+    session_path = data_root / session_dir
+    ns5_filepath = session_path / full_stream_filename
+    nip_offset = session_nip_offset(session_path, full_stream_filename, session_clock_filepath)
+
+    kdf_nip_time = read_hdf_dataset(kinematics_filepath, ['nip_time'])['nip_time'].flatten()
+    neural_data = read_nsx_range(ns5_filepath, (kdf_nip_time[0] + nip_offset, kdf_nip_time[-1] + nip_offset))
+    if not load_baseline:
+        return neural_data, kdf_nip_time, None, None
+    return neural_data, kdf_nip_time, *load_session_baseline(data_root, session_dir, full_stream_filename,
+                                                             baseline_filename, nip_offset)
+
+
+def load_session_baseline(
+        data_root: Path,
+        session_dir: str,
+        full_stream_filename: str,
+        baseline_filename: str,
+        nip_offset: float | None = None
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Loads the scaled baseline range of a session's NS5 file.
+    :param nip_offset: NS5 NIP offset. Computed from the session if None
+    :return: tuple of (baseline data, baseline KDF NIP times)
+    """
+    session_path = data_root / session_dir
+    if nip_offset is None:
+        nip_offset = session_nip_offset(session_path, full_stream_filename)
+    baseline_nip_time = read_kdf(session_path / baseline_filename)['nip_time'].flatten().astype(np.float64)
+    baseline_data = read_nsx_range(
+        session_path / full_stream_filename, (baseline_nip_time[0] + nip_offset, baseline_nip_time[-1] + nip_offset))
+    return baseline_data, baseline_nip_time
+
+
+def _load_with_baseline_stats(
+        data_root: Path,
+        session_dir: str,
+        full_stream_filename: str,
+        baseline_filename: str,
+        kinematics_filepath: Path,
+        feature_set_ids: list[str],
+        feature_params: dict,
+        baseline_stats_filepath: Path | None,
+        session_clock_filepath: Path | None = None
+) -> tuple[tuple, dict]:
+    """
+    Loads the raw data, skipping the baseline when every baseline statistic the feature sets need is
+    cached. Statistics missing from an existing or new baseline_stats_filepath are computed and added.
+    :return: tuple of (load_session_raw_data output, intermediates to pass to the extractors)
+    """
+    stat_params = baseline_stat_params(feature_set_ids, feature_params)
+    intermediates = read_baseline_stats(baseline_stats_filepath, stat_params) if baseline_stats_filepath else {}
+    missing = [key for key in stat_params if key not in intermediates]
+    if stat_params and not missing:
+        logger.info(f"Using cached baseline statistics from {baseline_stats_filepath}")
+    raw_data = load_session_raw_data(data_root, session_dir, full_stream_filename, baseline_filename,
+                                     kinematics_filepath, load_baseline=bool(missing),
+                                     session_clock_filepath=session_clock_filepath)
+    if missing and baseline_stats_filepath:
+        stats = compute_baseline_stats(feature_set_ids, raw_data[2], raw_data[3], feature_params, intermediates)
+        write_baseline_stats(baseline_stats_filepath, {key: stats[key] for key in missing}, stat_params)
+        intermediates.update(stats)
+    return raw_data, intermediates
+
+
+def compare_feature_arrays(
+        candidate: np.ndarray,
+        reference: np.ndarray,
+        rtol: float = 1e-4,
+        atol: float = 1e-6
+) -> dict:
+    """
+    Numerical parity metrics between two (N x F) feature arrays.
+    :param candidate: features under test
+    :param reference: reference features, e.g. from the MATLAB pipeline
+    :param rtol: relative tolerance for the pass/fail check
+    :param atol: absolute tolerance for the pass/fail check
+    :return: dict with shape match, error statistics, the minimum per-feature correlation and 'passed'
+    """
+    report = {'candidate_shape': candidate.shape, 'reference_shape': reference.shape,
+              'shape_match': candidate.shape == reference.shape}
+    if not report['shape_match']:
+        report['passed'] = False
+        return report
+    abs_error = np.abs(candidate - reference)
+    finite = np.isfinite(reference) & np.isfinite(candidate)
+    report['nan_mismatch_count'] = int(np.sum(np.isnan(candidate) != np.isnan(reference)))
+    report['max_abs_error'] = float(np.max(abs_error[finite], initial=0.0))
+    report['max_rel_error'] = float(np.max(
+        abs_error[finite] / np.maximum(np.abs(reference[finite]), atol), initial=0.0))
+    centered_c = candidate - np.nanmean(candidate, axis=0)
+    centered_r = reference - np.nanmean(reference, axis=0)
+    norms = np.sqrt(np.nansum(centered_c ** 2, axis=0) * np.nansum(centered_r ** 2, axis=0))
+    varying = norms > 0
+    correlations = np.nansum(centered_c * centered_r, axis=0)[varying] / norms[varying]
+    report['min_feature_correlation'] = float(np.min(correlations, initial=1.0))
+    report['passed'] = bool(np.allclose(candidate, reference, rtol=rtol, atol=atol, equal_nan=True))
+    return report
+
+
+def check_feature_parity(
+        candidate_filepath: Path,
+        reference_filepath: Path,
+        rtol: float = 1e-4,
+        atol: float = 1e-6
+) -> dict:
+    """
+    Compares two feature HDF5 files written by write_feature_file or extract_features.m, in either layout.
+    :return: report from compare_feature_arrays
+    """
+    candidate = read_feature_file(candidate_filepath)
+    reference = read_feature_file(reference_filepath)
+    report = compare_feature_arrays(candidate, reference, rtol=rtol, atol=atol)
+    for key, val in report.items():
+        logger.info(f"{key}: {val}")
+    return report
+
 
 @app.command()
-def main(
-    # ---- REPLACE DEFAULT PATHS AS APPROPRIATE ----
-    input_path: Path = PROCESSED_DATA_DIR / "dataset.csv",
-    output_path: Path = PROCESSED_DATA_DIR / "features.csv",
-    # -----------------------------------------
-):
-    # ---- REPLACE THIS WITH YOUR OWN CODE ----
-    logger.info("Generating features from dataset...")
-    for i in tqdm(range(10), total=10):
-        if i == 5:
-            logger.info("Something happened for iteration 5.")
-    logger.success("Features generation complete.")
-    # -----------------------------------------
+def extract(
+    data_root: Path,
+    session_dir: str,
+    full_stream_filename: str,
+    baseline_filename: str,
+    kinematics_filepath: Path,
+    feature_set_id: str,
+    output_filepath: Path,
+    config_filepath: Path = Path("config.yaml"),
+    baseline_stats_filepath: Path | None = None,
+    session_clock_filepath: Path | None = None,
+):
+    """Extract one feature set for a session. Drop-in replacement for extract_features.m."""
+    timer = time.perf_counter()
+    logger.info(f"Feature extraction process started for {session_dir} ({feature_set_id})")
+    # Accepts config.yaml or the JSON params written for MATLAB (JSON is valid YAML)
+    config = load_project_config(config_filepath)
+    feature_params = config.get('feature_extraction_params', config)
+    raw_data, intermediates = _load_with_baseline_stats(
+        data_root, session_dir, full_stream_filename, baseline_filename, kinematics_filepath,
+        [feature_set_id], feature_params, baseline_stats_filepath, session_clock_filepath)
+    features, computation_times = extract_features(feature_set_id, *raw_data, feature_params, intermediates)
+    write_feature_file(output_filepath, features, computation_times)
+    logger.success(f"Feature extraction process finished in {time.perf_counter() - timer:0.1f} sec")
+
+
+@app.command()
+def extract_sets(
+    data_root: Path,
+    session_dir: str,
+    full_stream_filename: str,
+    baseline_filename: str,
+    kinematics_filepath: Path,
+    feature_set_ids: str,
+    output_dirpath: Path,
+    config_filepath: Path = Path("config.yaml"),
+    baseline_stats_filepath: Path | None = None,
+    session_clock_filepath: Path | None = None,
+):
+    """Extract several comma-separated feature sets for a session, loading the raw data once."""
+    timer = time.perf_counter()
+    feature_set_ids = [name.strip() for name in feature_set_ids.split(',') if name.strip()]
+    logger.info(f"Feature extraction process started for {session_dir} ({', '.join(feature_set_ids)})")
+    config = load_project_config(config_filepath)
+    feature_params = config.get('feature_extraction_params', config)
+    raw_data, intermediates = _load_with_baseline_stats(
+        data_root, session_dir, full_stream_filename, baseline_filename, kinematics_filepath,
+        feature_set_ids, feature_params, baseline_stats_filepath, session_clock_filepath)
+    extracted = extract_feature_sets(feature_set_ids, *raw_data, feature_params, intermediates)
+    for feature_set_id, features, computation_times in extracted:
+        write_feature_file(output_dirpath / f"{feature_set_id}.h5", features, computation_times)
+    logger.success(f"Feature extraction process finished in {time.perf_counter() - timer:0.1f} sec")
+
+
+@app.command()
+def baseline_stats(
+    data_root: Path,
+    session_dir: str,
+    full_stream_filename: str,
+    baseline_filename: str,
+    feature_set_ids: str,
+    output_filepath: Path,
+    config_filepath: Path = Path("config.yaml"),
+    session_clock_filepath: Path | None = None,
+):
+    """Compute the baseline statistics of comma-separated feature sets and cache them in baseline_stats.h5."""
+    timer = time.perf_counter()
+    feature_set_ids = [name.strip() for name in feature_set_ids.split(',') if name.strip()]
+    config = load_project_config(config_filepath)
+    feature_params = config.get('feature_extraction_params', config)
+    stat_params = baseline_stat_params(feature_set_ids, feature_params)
+    cached = read_baseline_stats(output_filepath, stat_params)
+    if any(key not in cached for key in stat_params):
+        baseline_data, baseline_nip_time = load_session_baseline(
+            data_root, session_dir, full_stream_filename, baseline_filename,
+            session_nip_offset(data_root / session_dir, full_stream_filename, session_clock_filepath))
+        stats = compute_baseline_stats(feature_set_ids, baseline_data, baseline_nip_time, feature_params, cached)
+        missing = {key: val for key, val in stats.items() if key not in cached}
+        write_baseline_stats(output_filepath, missing, stat_params)
+    elif not output_filepath.exists():
+        # Feature sets without baseline statistics still get a (empty) file for the workflow
+        output_filepath.parent.mkdir(parents=True, exist_ok=True)
+        h5py.File(output_filepath, 'w').close()
+    logger.success(f"Baseline statistics finished in {time.perf_counter() - timer:0.1f} sec")
+
+
+@app.command()
+def benchmark(
+    feature_set_ids: str = "",
+    n_chans: int = 192,
+    n_frames: int = 300,
+    config_filepath: Path = Path("config.yaml"),
+    output_filepath: Path | None = None,
+):
+    """Report per-frame latency and allocations of the streaming extractors against the 33 ms loop budget."""
+    config = load_project_config(config_filepath)
+    feature_params = config['feature_extraction_params']
+    feature_set_ids = [name.strip() for name in feature_set_ids.split(',') if name.strip()] or \
+        [name for name in config['analysis']['feature_sets'] if name in STREAMING_EXTRACTORS]
+    blocks, baseline_data = make_benchmark_blocks(n_chans, n_frames)
+    baseline_nip_time = np.arange(0, len(baseline_data), FS_NS5 * LOOP_TIME_SECONDS)
+    baseline_stats = compute_baseline_stats(feature_set_ids, baseline_data, baseline_nip_time, feature_params)
+
+    report = {}
+    for feature_set_id in feature_set_ids:
+        extractor = make_streaming_extractor(feature_set_id, n_chans, feature_params, baseline_stats)
+        report[feature_set_id] = benchmark_streaming(extractor, blocks)
+        result = report[feature_set_id]
+        logger.info(f"{feature_set_id}: p50 {result['p50_ms']:.2f} ms, p99 {result['p99_ms']:.2f} ms, "
+                    f"max {result['max_ms']:.2f} ms, {result['alloc_p50_bytes'] / 1024:.0f} KiB/frame, "
+                    f"{'deployable' if result['deployable'] else 'over budget'}")
+    if output_filepath is not None:
+        output_filepath.parent.mkdir(parents=True, exist_ok=True)
+        output_filepath.write_text(json.dumps({'n_chans': n_chans, 'n_frames': n_frames, 'results': report}, indent=2))
+        logger.success(f"Benchmark report written to {output_filepath}")
+
+
+@app.command()
+def parity(
+    candidate_path: Path,
+    reference_path: Path,
+    rtol: float = 1e-4,
+    atol: float = 1e-6,
+):
+    """Check a Python feature file against a reference feature file."""
+    report = check_feature_parity(candidate_path, reference_path, rtol=rtol, atol=atol)
+    if not report['passed']:
+        logger.error("Feature parity check failed")
+        raise typer.Exit(code=1)
+    logger.success("Feature parity check passed")
+
+
+@app.command()
+def convert_features(
+    scratch_root: Path,
+    dtype: str = 'float32',
+    compression: str = 'gzip',
+    max_workers: int = 4,
+):
+    """Rewrite every scratch_root/*/features/*.h5 file still in the MATLAB layout in the feature store layout."""
+    timer = time.perf_counter()
+    filepaths = sorted(scratch_root.glob("*/features/*.h5"))
+    size_before = sum(filepath.stat().st_size for filepath in filepaths)
+    n_converted = 0
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(convert_feature_file, filepath, None, dtype, compression): filepath
+                   for filepath in filepaths}
+        for future in as_completed(futures):
+            try:
+                n_converted += future.result()
+            except (OSError, KeyError) as e:
+                logger.warning(f"Could not convert {futures[future]}: {e}")
+    size_after = sum(filepath.stat().st_size for filepath in filepaths)
+    logger.success(f"Converted {n_converted}/{len(filepaths)} feature files ({size_before / 2 ** 20:.1f} MiB -> "
+                   f"{size_after / 2 ** 20:.1f} MiB) in {time.perf_counter() - timer:0.1f} sec")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,198 @@
+import hashlib
+import json
+from pathlib import Path
+import time
+
+from loguru import logger
+import numpy as np
+from scipy import signal
+import typer
+
+from neural_feature_identification.dataset_utils import load_project_config, read_hdf_dataset
+from neural_feature_identification.features import (
+    CHANNEL_BLOCK_SIZE,
+    FS_NS5,
+    LOOP_TIME_SECONDS,
+    PREFIX_BLOCK_ROWS,
+    SBP_DOWNSAMPLE_2KHZ_TO_30HZ,
+    SBP_DOWNSAMPLE_30KHZ_TO_2KHZ,
+    SPIKE_HPF_CUTOFF_HZ,
+    SPIKE_HPF_ORDER,
+    load_session_raw_data,
+    rolling_buffer_mav,
+    sbp_from_rectified,
+    write_feature_file,
+)
+from neural_feature_identification.filtering import sosfiltfilt_blocks
+
+app = typer.Typer()
+
+# Rectified, filtered signals cached as .npy files (memory-mappable, samples x channels) in the job directory.
+# SBP: |band-pass| decimated to 2 kHz. MAV: |750 Hz high-pass| at 30 kHz for the training and baseline data.
+# Window-length and frame-rate sweeps read these instead of re-filtering the NS5 stream.
+FILTERED_CACHE_KINDS = ['SBP', 'MAV']
+FILTERED_CACHE_DTYPES = ['float32', 'float16']
+
+
+def _filter_params(kind: str, feature_params: dict) -> dict:
+    """Parameters the cached signal depends on (window lengths and frame rates are not among them)"""
+    if kind == 'SBP':
+        sbp_params = feature_params['sbp']
+        return {key: sbp_params[key] for key in ['bpf_order', 'hpf_cutoff_hz', 'lpf_cutoff_hz']}
+    if kind == 'MAV':
+        return {'hpf_order': SPIKE_HPF_ORDER, 'hpf_cutoff_hz': SPIKE_HPF_CUTOFF_HZ}
+    raise ValueError(f"Unknown filtered cache kind '{kind}'. Choose from {FILTERED_CACHE_KINDS}")
+
+
+def filtered_cache_filepath(cache_dirpath: Path, kind: str, feature_params: dict, stream: str = 'neural') -> Path:
+    """
+    :param cache_dirpath: cache directory, usually {job dir}/filtered_cache
+    :param kind: 'SBP' or 'MAV'
+    :param feature_params: feature_extraction_params
+    :param stream: 'neural' (training data) or 'baseline'
+    :return: path of the .npy cache, keyed by the filter parameters
+    """
+    params_hash = hashlib.sha1(json.dumps(_filter_params(kind, feature_params), sort_keys=True).encode()).hexdigest()
+    return cache_dirpath / f"{kind}_{stream}_{params_hash[:12]}.npy"
+
+
+def write_filtered_cache(
+        filepath: Path,
+        data: np.ndarray,
+        kind: str,
+        feature_params: dict,
+        dtype: str = 'float32',
+        block_size: int = CHANNEL_BLOCK_SIZE
+):
+    """
+    Filters, rectifies (and for SBP decimates) a recording chunk by chunk straight into a memory-mapped
+    .npy file, with channel blocks spread over threads.
+    :param filepath: destination, see filtered_cache_filepath
+    :param data: (T x C) scaled 30 kHz data
+    :param kind: 'SBP' or 'MAV'
+    :param feature_params: feature_extraction_params
+    :param dtype: 'float32' or 'float16' (half the size, ~3 significant digits)
+    :param block_size: number of channels filtered at once by a thread
+    """
+    if dtype not in FILTERED_CACHE_DTYPES:
+        raise ValueError(f"Unsupported cache dtype '{dtype}'. Choose from {FILTERED_CACHE_DTYPES}")
+    params = _filter_params(kind, feature_params)
+    if kind == 'SBP':
+        # butter() doubles the order of band-pass designs, so bpf_order is the order of the final filter
+        b, a = signal.butter(params['bpf_order'] // 2,
+                             [params['hpf_cutoff_hz'] / (FS_NS5 / 2), params['lpf_cutoff_hz'] / (FS_NS5 / 2)],
+                             'bandpass')
+        step = SBP_DOWNSAMPLE_30KHZ_TO_2KHZ
+    else:
+        b, a = signal.butter(SPIKE_HPF_ORDER, SPIKE_HPF_CUTOFF_HZ / (FS_NS5 / 2), 'high')
+        step = 1
+
+    filepath.parent.mkdir(parents=True, exist_ok=True)
+    n_rows = len(range(0, len(data), step))
+    cache = np.lib.format.open_memmap(filepath, mode='w+', dtype=dtype, shape=(n_rows, data.shape[1]))
+    padlen = 3 * (max(len(a), len(b)) - 1)  # as filtfilt_channels
+    sosfiltfilt_blocks(signal.tf2sos(b, a), data, out=cache, padlen=padlen, decimate=step, block_size=block_size)
+    for row_start in range(0, n_rows, PREFIX_BLOCK_ROWS):
+        rows = slice(row_start, row_start + PREFIX_BLOCK_ROWS)
+        cache[rows] = np.abs(cache[rows])
+    cache.flush()
+    del cache
+    logger.info(f"{kind} filtered cache ({n_rows} x {data.shape[1]} {dtype}) written to {filepath}")
+
+
+def open_filtered_cache(filepath: Path) -> np.ndarray:
+    """:return: read-only memory map of a filtered cache"""
+    return np.load(filepath, mmap_mode='r')
+
+
+def mav_from_cache(
+        cache: np.ndarray,
+        kdf_nip_time: np.ndarray,
+        baseline_cache: np.ndarray,
+        baseline_nip_time: np.ndarray,
+        window_length_sec: float
+) -> np.ndarray:
+    """
+    MAV features from the MAV caches. Equal to compute_mav_features for float32 caches.
+    SBP features come from features.sbp_from_rectified applied to the SBP cache.
+    :param cache: (T x C) rectified 30 kHz cache of the training data
+    :param kdf_nip_time: (N, ) KDF NIP timestamps of the training data
+    :param baseline_cache: (Tb x C) rectified 30 kHz cache of the baseline data
+    :param baseline_nip_time: (Nb, ) KDF NIP timestamps of the baseline data
+    :param window_length_sec: 'mav' window_length_sec (initial buffer width)
+    :return: (N x C) features
+    """
+    initial_width = int(np.floor(window_length_sec / LOOP_TIME_SECONDS))
+    neural_baseline = rolling_buffer_mav(baseline_cache, baseline_nip_time, initial_width).mean(axis=0)
+    mav = rolling_buffer_mav(cache, kdf_nip_time, initial_width)
+    features = np.zeros((len(kdf_nip_time.flatten()), cache.shape[1]))
+    features[:len(mav)] = mav - neural_baseline
+    return features
+
+
+@app.command()
+def build(
+    data_root: Path,
+    session_dir: str,
+    full_stream_filename: str,
+    baseline_filename: str,
+    kinematics_filepath: Path,
+    cache_dirpath: Path,
+    kinds: str = "SBP,MAV",
+    dtype: str = 'float32',
+    config_filepath: Path = Path("config.yaml"),
+    session_clock_filepath: Path | None = None,
+):
+    """Write the rectified, filtered signal caches of a session for window-length sweeps."""
+    timer = time.perf_counter()
+    config = load_project_config(config_filepath)
+    feature_params = config.get('feature_extraction_params', config)
+    kinds = [kind.strip() for kind in kinds.split(',') if kind.strip()]
+    unknown = [kind for kind in kinds if kind not in FILTERED_CACHE_KINDS]
+    if unknown:
+        raise ValueError(f"Unknown filtered cache kinds {unknown}. Choose from {FILTERED_CACHE_KINDS}")
+    neural_data, _, baseline_data, baseline_nip_time = load_session_raw_data(
+        data_root, session_dir, full_stream_filename, baseline_filename, kinematics_filepath,
+        load_baseline='MAV' in kinds, session_clock_filepath=session_clock_filepath)
+    for kind in kinds:
+        write_filtered_cache(filtered_cache_filepath(cache_dirpath, kind, feature_params), neural_data, kind,
+                             feature_params, dtype)
+    if 'MAV' in kinds:
+        write_filtered_cache(filtered_cache_filepath(cache_dirpath, 'MAV', feature_params, 'baseline'),
+                             baseline_data, 'MAV', feature_params, dtype)
+        np.save(cache_dirpath / "baseline_nip_time.npy", baseline_nip_time)
+    logger.success(f"Filtered caches finished in {time.perf_counter() - timer:0.1f} sec")
+
+
+@app.command()
+def sweep(
+    cache_dirpath: Path,
+    kinematics_filepath: Path,
+    kind: str,
+    window_lengths_sec: str,
+    output_dirpath: Path,
+    config_filepath: Path = Path("config.yaml"),
+    sbp_frame_step: int = SBP_DOWNSAMPLE_2KHZ_TO_30HZ,
+):
+    """Write SBP-RAW or MAV features for each comma-separated window length, reading only the cache."""
+    timer = time.perf_counter()
+    config = load_project_config(config_filepath)
+    feature_params = config.get('feature_extraction_params', config)
+    kdf_nip_time = read_hdf_dataset(kinematics_filepath, ['nip_time'])['nip_time'].flatten()
+    cache = open_filtered_cache(filtered_cache_filepath(cache_dirpath, kind, feature_params))
+    if kind == 'MAV':
+        baseline_cache = open_filtered_cache(filtered_cache_filepath(cache_dirpath, kind, feature_params, 'baseline'))
+        baseline_nip_time = np.load(cache_dirpath / "baseline_nip_time.npy")
+    feature_set_id = 'SBP-RAW' if kind == 'SBP' else 'MAV'
+    for window_length_sec in [float(val) for val in window_lengths_sec.split(',') if val.strip()]:
+        if kind == 'SBP':
+            features = sbp_from_rectified(cache, len(kdf_nip_time), window_length_sec, sbp_frame_step)
+        else:
+            features = mav_from_cache(cache, kdf_nip_time, baseline_cache, baseline_nip_time, window_length_sec)
+        write_feature_file(output_dirpath / f"{feature_set_id}_window{window_length_sec:g}s.h5", features,
+                           np.zeros(len(features)))
+    logger.success(f"Window sweep finished in {time.perf_counter() - timer:0.1f} sec")
+
+
+if __name__ == "__main__":
+    app()
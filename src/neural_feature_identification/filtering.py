@@ -0,0 +1,182 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+from pathlib import Path
+
+import numpy as np
+from scipy import signal
+from scipy.io import loadmat
+
+# SciPy's filters release the GIL, so channel blocks are filtered in parallel threads sharing the input
+# and output arrays. Time is processed in chunks: the forward pass carries its state from chunk to chunk
+# and the backward pass of each chunk starts `overlap` samples later, where the error of its approximate
+# initial state has decayed below tolerance. Memory is bounded by (chunk + overlap) x block_size x threads.
+DEFAULT_CHUNK_SAMPLES = 2 ** 18  # [samples] ~8.7 sec at 30 kHz
+DEFAULT_BLOCK_CHANNELS = 16
+DEFAULT_SETTLING_RTOL = 1e-12  # backward-pass transient left at the edge of the overlap, relative to its peak
+
+
+def default_thread_count() -> int:
+    """:return: number of CPUs this process may run on (the SLURM allocation on the cluster)"""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def map_channel_blocks(func, n_chans: int, block_size: int = DEFAULT_BLOCK_CHANNELS, n_threads: int | None = None):
+    """
+    Calls func(chans) for consecutive channel slices of at most `block_size` channels in a thread pool.
+    :param func: callable taking a channel slice. It should write its results in place
+    :param n_chans: number of channels
+    :param block_size: channels per call
+    :param n_threads: worker threads. Defaults to default_thread_count
+    :return: list of the return values, in channel order
+    """
+    blocks = [slice(start, min(start + block_size, n_chans)) for start in range(0, n_chans, block_size)]
+    n_threads = min(n_threads or default_thread_count(), len(blocks))
+    if n_threads <= 1:
+        return [func(chans) for chans in blocks]
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        return list(executor.map(func, blocks))
+
+
+def read_sos_mat(filepath: Path) -> np.ndarray:
+    """
+    Reads a second-order-sections filter saved from MATLAB, e.g. zmh_mav/lfpSOSfilter20180417.mat.
+    :param filepath: .mat file holding a single (n_sections x 6) matrix
+    :return: (n_sections x 6) SOS matrix in the scipy.signal layout [b0 b1 b2 1 a1 a2]
+    """
+    matrices = [val for key, val in loadmat(filepath).items() if not key.startswith('__')]
+    if len(matrices) != 1 or np.ndim(matrices[0]) != 2 or np.shape(matrices[0])[1] != 6:
+        raise ValueError(f"{filepath} does not hold a single (n_sections x 6) SOS matrix")
+    return np.ascontiguousarray(matrices[0], dtype=np.float64)
+
+
+def sos_order(sos: np.ndarray) -> int:
+    """:return: order of the filter, not counting sections padded with trailing zeros"""
+    n_trailing_zeros = min(np.sum(sos[:, 2] == 0), np.sum(sos[:, 5] == 0))
+    return 2 * len(sos) - int(n_trailing_zeros)
+
+
+def filtfiltm_padlen(sos: np.ndarray) -> int:
+    """:return: odd-extension length of project_utils.FiltFiltM and features.filtfilt_channels (3 x order)"""
+    return 3 * sos_order(sos)
+
+
+def settling_samples(sos: np.ndarray, rtol: float = DEFAULT_SETTLING_RTOL) -> int:
+    """
+    Samples until the zero-input response of the filter stays below `rtol` of its peak, i.e. until a
+    wrong initial state is forgotten.
+    :param sos: (n_sections x 6) SOS matrix
+    :param rtol: remaining fraction of the transient
+    :return: number of samples
+    """
+    poles = np.concatenate([np.roots(section[3:]) for section in sos])
+    max_radius = np.max(np.abs(poles)) if len(poles) else 0.0
+    if max_radius >= 1:
+        raise ValueError("Unstable filter: a pole lies on or outside the unit circle")
+    if max_radius == 0:
+        return len(sos) * 2
+    # Repeated poles stretch the tail, so the impulse response is evaluated well past the single-pole estimate
+    n_eval = 2 * int(np.ceil(np.log(rtol) / np.log(max_radius))) + 64 * len(sos)
+    all_pole = np.hstack([np.tile([1.0, 0.0, 0.0], (len(sos), 1)), sos[:, 3:]])
+    impulse = np.zeros(n_eval)
+    impulse[0] = 1
+    response = np.abs(signal.sosfilt(all_pole, impulse))
+    return int(np.flatnonzero(response > rtol * response.max())[-1]) + 1
+
+
+class SOSFilter:
+    """Causal second-order-sections filter that carries its state from one block to the next"""
+    def __init__(self, sos: np.ndarray, n_chans: int, zi: np.ndarray | None = None):
+        """
+        :param sos: (n_sections x 6) SOS matrix
+        :param n_chans: number of columns of the blocks
+        :param zi: (n_sections x 2 x n_chans) initial state. Defaults to rest
+        """
+        self.sos = sos
+        self.zi = np.zeros((len(sos), 2, n_chans)) if zi is None else zi
+
+    def __call__(self, block: np.ndarray) -> np.ndarray:
+        """:return: filtered (T x n_chans) block"""
+        filtered, self.zi = signal.sosfilt(self.sos, block, axis=0, zi=self.zi)
+        return filtered
+
+
+def _odd_extended_rows(data: np.ndarray, chans: slice, start: int, stop: int, padlen: int) -> np.ndarray:
+    """Rows [start, stop) of the odd extension of data[:, chans] by `padlen` samples at both ends, as float64"""
+    n_samples = len(data)
+    data_start, data_stop = max(start - padlen, 0), min(stop - padlen, n_samples)
+    rows = np.asarray(data[data_start:data_stop, chans], dtype=np.float64)
+    if start < padlen:
+        idxs = padlen - np.arange(start, min(stop, padlen))
+        first = np.asarray(data[0, chans], dtype=np.float64)
+        rows = np.concatenate([2 * first - np.asarray(data[idxs, chans], dtype=np.float64), rows])
+    if stop > n_samples + padlen:
+        idxs = 2 * (n_samples - 1) - (np.arange(max(start, n_samples + padlen), stop) - padlen)
+        last = np.asarray(data[-1, chans], dtype=np.float64)
+        rows = np.concatenate([rows, 2 * last - np.asarray(data[idxs, chans], dtype=np.float64)])
+    return rows
+
+
+def sosfiltfilt_blocks(
+        sos: np.ndarray,
+        data: np.ndarray,
+        out: np.ndarray | None = None,
+        padlen: int | None = None,
+        decimate: int = 1,
+        chunk_samples: int = DEFAULT_CHUNK_SAMPLES,
+        overlap: int | None = None,
+        block_size: int = DEFAULT_BLOCK_CHANNELS,
+        n_threads: int | None = None
+) -> np.ndarray:
+    """
+    Zero-phase SOS filtering of each column, one time chunk at a time.
+    Equals scipy.signal.sosfiltfilt(sos, data, axis=0, padtype='odd', padlen=padlen) to within the settling
+    tolerance of `overlap`, without holding more than a chunk of float64 temporaries per thread. The input
+    and output can be memory maps, so whole recordings are filtered straight into a file.
+    :param sos: (n_sections x 6) SOS matrix
+    :param data: (T x C) array or memory map
+    :param out: (ceil(T / decimate) x C) destination. Defaults to a new float32 array
+    :param padlen: odd extension at both ends. Defaults to filtfiltm_padlen
+    :param decimate: keep every `decimate`-th filtered sample
+    :param chunk_samples: samples filtered at once
+    :param overlap: backward-pass run-in after each chunk. Defaults to settling_samples
+    :param block_size: channels per thread task
+    :param n_threads: worker threads. Defaults to default_thread_count
+    :return: out
+    """
+    n_samples, n_chans = data.shape
+    padlen = filtfiltm_padlen(sos) if padlen is None else padlen
+    if n_samples <= padlen:
+        raise ValueError(f"The input must be longer than padlen ({padlen} samples), got {n_samples}")
+    overlap = settling_samples(sos) if overlap is None else overlap
+    chunk_samples = max(chunk_samples // decimate, 1) * decimate
+    if out is None:
+        out = np.empty((len(range(0, n_samples, decimate)), n_chans), dtype=np.float32)
+    zi_steady = signal.sosfilt_zi(sos)[:, :, None]
+    n_extended = n_samples + 2 * padlen
+
+    def filter_block(chans: slice):
+        first_row = _odd_extended_rows(data, chans, 0, 1, padlen)[0]
+        forward = SOSFilter(sos, chans.stop - chans.start, zi_steady * first_row)
+        # Forward-filtered extended samples [buffer_start, buffer_start + len(buffer))
+        buffer, buffer_start = np.empty((0, chans.stop - chans.start)), 0
+        for chunk_start in range(0, n_samples, chunk_samples):
+            chunk_stop = min(chunk_start + chunk_samples, n_samples)
+            run_in_stop = min(chunk_stop + padlen + overlap, n_extended)
+            if chunk_stop == n_samples:
+                run_in_stop = n_extended
+            buffer_stop = buffer_start + len(buffer)
+            if run_in_stop > buffer_stop:
+                new_rows = forward(_odd_extended_rows(data, chans, buffer_stop, run_in_stop, padlen))
+                buffer = np.concatenate([buffer, new_rows])
+            # The backward pass starts from the steady state of its first sample, like sosfiltfilt at the end
+            rows = buffer[chunk_start + padlen - buffer_start:run_in_stop - buffer_start][::-1]
+            backward, _ = signal.sosfilt(sos, rows, axis=0, zi=zi_steady * rows[0])
+            filtered = backward[::-1][:chunk_stop - chunk_start]
+            out[-(-chunk_start // decimate):-(-chunk_stop // decimate), chans] = filtered[::decimate]
+            buffer = buffer[chunk_stop + padlen - buffer_start:]
+            buffer_start = chunk_stop + padlen
+
+    map_channel_blocks(filter_block, n_chans, block_size, n_threads)
+    return out
@@ -0,0 +1,220 @@
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import os
+from pathlib import Path
+import time
+
+import h5py
+from loguru import logger
+import numpy as np
+import polars as pl
+import typer
+
+from neural_feature_identification.dataset_utils import (
+    feature_file_shape,
+    load_project_config,
+    read_feature_file,
+)
+
+app = typer.Typer()
+
+# Persistent index of the feature files under scratch_root, one row per file. A file is re-inspected only
+# when its size or mtime, or the size or mtime of its session's kinematics.h5, differ from the index.
+INTEGRITY_INDEX_FILENAME = "feature_integrity_index.parquet"
+INTEGRITY_REPORT_FILENAME = "corrupted_file_list.txt"
+INTEGRITY_BLOCK_ROWS = 65536  # samples validated at once
+# kinematics_error: the feature file is readable but its session's kinematics.h5 is not
+INTEGRITY_STATUSES = ['ok', 'corrupt', 'missing_keys', 'shape_mismatch', 'non_finite', 'kinematics_error']
+REQUIRED_FEATURE_KEYS = {'features', 'computation_times'}
+INDEX_SCHEMA = {
+    'path': pl.Utf8,
+    'size': pl.Int64,
+    'mtime_ns': pl.Int64,
+    'kinematics_size': pl.Int64,
+    'kinematics_mtime_ns': pl.Int64,
+    'checksum': pl.Utf8,
+    'n_samples': pl.Int64,
+    'n_features': pl.Int64,
+    'kinematics_samples': pl.Int64,
+    'nan_count': pl.Int64,
+    'inf_count': pl.Int64,
+    'status': pl.Utf8,
+    'message': pl.Utf8,
+}
+
+
+def _stat(filepath: Path) -> tuple[int, int]:
+    """:return: (size, mtime_ns), or (-1, -1) if the file does not exist"""
+    try:
+        stat = filepath.stat()
+    except FileNotFoundError:
+        return -1, -1
+    return stat.st_size, stat.st_mtime_ns
+
+
+def list_feature_files(scratch_root: Path) -> dict[str, dict]:
+    """
+    Lists scratch_root/<job_id>/features/*.h5 with os.scandir, two directory levels deep, instead of
+    walking the whole scratch tree.
+    :return: dict of {path: stat fields of the file and of its session's kinematics.h5}
+    """
+    entries = {}
+    with os.scandir(scratch_root) as job_dirs:
+        for job_dir in job_dirs:
+            features_dirpath = Path(job_dir.path) / "features"
+            if not job_dir.is_dir() or not features_dirpath.is_dir():
+                continue
+            kinematics_size, kinematics_mtime_ns = _stat(Path(job_dir.path) / "kinematics.h5")
+            with os.scandir(features_dirpath) as files:
+                for file in files:
+                    if not file.name.endswith(".h5") or not file.is_file():
+                        continue
+                    stat = file.stat()
+                    entries[file.path] = {
+                        'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                        'kinematics_size': kinematics_size, 'kinematics_mtime_ns': kinematics_mtime_ns,
+                    }
+    return entries
+
+
+def inspect_feature_file(filepath: Path, block_rows: int = INTEGRITY_BLOCK_ROWS) -> dict:
+    """
+    Validates one feature file. The features are streamed in row blocks, so memory stays bounded.
+    :param filepath: feature HDF5 file in either layout (see dataset_utils.read_feature_file)
+    :param block_rows: samples read at once
+    :return: dict with the checksum of the feature values, the shape, NaN/Inf counts, the number of
+             kinematics samples of the session (-1 if missing), a status from INTEGRITY_STATUSES and a message
+    """
+    result = {'checksum': '', 'n_samples': -1, 'n_features': -1, 'kinematics_samples': -1,
+              'nan_count': 0, 'inf_count': 0, 'status': 'ok', 'message': ''}
+    kinematics_filepath = filepath.parents[1] / "kinematics.h5"
+    try:
+        with h5py.File(filepath, 'r') as f:
+            missing = REQUIRED_FEATURE_KEYS - set(f.keys())
+        if missing:
+            return {**result, 'status': 'missing_keys', 'message': f"missing {sorted(missing)}"}
+        result['n_samples'], result['n_features'] = feature_file_shape(filepath)
+        features = read_feature_file(filepath, lazy=True)
+        digest = hashlib.blake2b(digest_size=16)
+        for start in range(0, result['n_samples'], block_rows):
+            block = np.ascontiguousarray(features[start:start + block_rows])
+            digest.update(block.tobytes())
+            result['nan_count'] += int(np.count_nonzero(np.isnan(block)))
+            result['inf_count'] += int(np.count_nonzero(np.isinf(block)))
+        result['checksum'] = digest.hexdigest()
+    except (OSError, KeyError, ValueError) as e:
+        return {**result, 'status': 'corrupt', 'message': str(e)}
+
+    if kinematics_filepath.exists():
+        try:
+            with h5py.File(kinematics_filepath, 'r') as f:
+                # kinematics.h5 is written by MATLAB as (kinematics x samples)
+                result['kinematics_samples'] = int(f['kinematics'].shape[-1])
+        except (OSError, KeyError, ValueError) as e:
+            return {**result, 'status': 'kinematics_error', 'message': f"{kinematics_filepath}: {e}"}
+    if result['kinematics_samples'] >= 0 and result['n_samples'] != result['kinematics_samples']:
+        result['status'] = 'shape_mismatch'
+        result['message'] = f"{result['n_samples']} samples, kinematics has {result['kinematics_samples']}"
+    elif result['nan_count'] or result['inf_count']:
+        result['status'] = 'non_finite'
+        result['message'] = f"{result['nan_count']} NaN, {result['inf_count']} Inf values"
+    return result
+
+
+def _inspect_worker(args: tuple) -> dict:
+    filepath, block_rows = args
+    return inspect_feature_file(Path(filepath), block_rows)
+
+
+def read_integrity_index(index_filepath: Path) -> pl.DataFrame:
+    """:return: the integrity index, or an empty index if it does not exist"""
+    if not index_filepath.exists():
+        return pl.DataFrame(schema=INDEX_SCHEMA)
+    return pl.read_parquet(index_filepath)
+
+
+def scan_feature_files(
+        scratch_root: Path,
+        index_filepath: Path | None = None,
+        max_workers: int = 4,
+        block_rows: int = INTEGRITY_BLOCK_ROWS,
+        full: bool = False
+) -> pl.DataFrame:
+    """
+    Brings the integrity index of scratch_root up to date. New and changed files are inspected in a process
+    pool, unchanged files keep their index rows and files that disappeared are dropped.
+    :param scratch_root: scratch_root containing one directory per job_id
+    :param index_filepath: index file. Defaults to scratch_root/INTEGRITY_INDEX_FILENAME
+    :param max_workers: number of worker processes
+    :param block_rows: samples read at once per file
+    :param full: re-inspect every file
+    :return: updated index, sorted by path
+    """
+    timer = time.perf_counter()
+    index_filepath = scratch_root / INTEGRITY_INDEX_FILENAME if index_filepath is None else index_filepath
+    entries = list_feature_files(scratch_root)
+    index = read_integrity_index(index_filepath).filter(pl.col('path').is_in(list(entries)))
+    stat_columns = ['size', 'mtime_ns', 'kinematics_size', 'kinematics_mtime_ns']
+    unchanged = set() if full else {
+        row['path'] for row in index.select(['path', *stat_columns]).iter_rows(named=True)
+        if all(row[column] == entries[row['path']][column] for column in stat_columns)
+    }
+    to_inspect = sorted(path for path in entries if path not in unchanged)
+    logger.info(f"{len(entries)} feature files, {len(to_inspect)} new or changed")
+
+    rows = []
+    if to_inspect:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = executor.map(_inspect_worker, [(path, block_rows) for path in to_inspect],
+                                   chunksize=max(1, len(to_inspect) // (4 * max_workers)))
+            rows = [{'path': path, **entries[path], **result} for path, result in zip(to_inspect, results)]
+    index = pl.concat([index.filter(pl.col('path').is_in(list(unchanged))),
+                       pl.DataFrame(rows, schema=INDEX_SCHEMA)]).sort('path')
+    index_filepath.parent.mkdir(parents=True, exist_ok=True)
+    tmp_filepath = index_filepath.with_name(f".{index_filepath.name}.tmp")
+    index.write_parquet(tmp_filepath)
+    os.replace(tmp_filepath, index_filepath)
+    logger.info(f"Integrity index updated in {time.perf_counter() - timer:0.1f} sec")
+    return index
+
+
+@app.command()
+def scan(
+    scratch_root: Path | None = None,
+    report_filepath: Path | None = None,
+    index_filepath: Path | None = None,
+    config_filepath: Path = Path("config.yaml"),
+    max_workers: int = 4,
+    full: bool = False,
+):
+    """Check the feature files under scratch_root and list the bad ones in results_root/corrupted_file_list.txt."""
+    config = load_project_config(config_filepath)
+    scratch_root = Path(config['paths']['scratch_root']) if scratch_root is None else scratch_root
+    if report_filepath is None:
+        report_filepath = Path(config['paths']['results_root']) / INTEGRITY_REPORT_FILENAME
+    index = scan_feature_files(scratch_root, index_filepath, max_workers, full=full)
+    bad = index.filter(pl.col('status') != 'ok')
+    for status, count in bad.group_by('status').len().sort('status').iter_rows():
+        logger.warning(f"{count} feature files with status '{status}'")
+    report_filepath.parent.mkdir(parents=True, exist_ok=True)
+    report_filepath.write_text("".join(f"{path}\n" for path in bad['path']))
+    if len(bad):
+        logger.warning(f"{len(bad)}/{len(index)} bad feature files listed in {report_filepath}")
+    else:
+        logger.success(f"All {len(index)} feature files passed")
+
+
+@app.command()
+def show(index_filepath: Path, status: str = ""):
+    """List the indexed feature files with a given status (all files that are not 'ok' by default)."""
+    if status and status not in INTEGRITY_STATUSES:
+        raise ValueError(f"Unknown status '{status}'. Choose from {INTEGRITY_STATUSES}")
+    index = read_integrity_index(index_filepath)
+    selected = index.filter(pl.col('status') == status if status else pl.col('status') != 'ok')
+    for path, file_status, message in selected.select(['path', 'status', 'message']).iter_rows():
+        logger.info(f"{file_status}: {path} {message}")
+    logger.info(f"{len(selected)}/{len(index)} indexed feature files")
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,241 @@
+from contextlib import closing
+import hashlib
+from pathlib import Path
+import sqlite3
+
+from loguru import logger
+import polars as pl
+import typer
+import yaml
+
+app = typer.Typer()
+
+# manifest.tsv and manifest_annotations.yaml compiled into one SQLite file. The YAML is only parsed when
+# its hash (or the manifest's) differs from the one stored in the index.
+# Tables:
+#   meta(key, value): source hashes and the index version
+#   jobs(job_id, training_filename, dof_mask, bidirectional_mask, independent_bidirectional_mask)
+#   kinematics(job_id, name, type, n_gestures, min_trials): one row per annotated kinematic
+#   job_categories(job_id, mode, category): category membership per kinematics mode
+#   manifest: manifest.tsv as is (when it exists)
+MANIFEST_INDEX_VERSION = 1
+MANIFEST_INDEX_FILENAME = "manifest_index.db"
+
+# Single-DOF kinematics are named d<N>; bit N - 1 of a DOF mask is set when d<N> is present
+FINGERS_DOFS = ['d1', 'd2', 'd3', 'd4', 'd5', 'd6']
+WRIST_ROTATOR_DOF = 'd10'
+WRIST_FLEXOR_DOF = 'd12'
+TASKA_8_DOFS = FINGERS_DOFS + [WRIST_ROTATOR_DOF, WRIST_FLEXOR_DOF]
+DEKA_6_DOFS = ['d1', 'd2', 'd3', 'd6', WRIST_ROTATOR_DOF, WRIST_FLEXOR_DOF]
+# Categories are inclusive: a TASKA session also counts as DEKA, ETD-RF, ETD-R and ETD
+DOF_CATEGORIES = ['8DOF-TASKA', '6DOF-DEKA', '3DOF-ETDRF', '2DOF-ETDR', '1DOF-ETD']
+OTHER_CATEGORY = 'OTHER'
+# Which kinematics of a job count for its categories
+KINEMATICS_MODES = ['all', 'bidirectional', 'independent_bidirectional']
+
+
+def dof_mask(names) -> int:
+    """:return: bitmask of the single-DOF kinematics (d<N>) among names. Combined kinematics are ignored"""
+    mask = 0
+    for name in names:
+        if name.startswith('d') and name[1:].isdigit():
+            mask |= 1 << (int(name[1:]) - 1)
+    return mask
+
+
+FINGERS_MASK = dof_mask(FINGERS_DOFS)
+TASKA_8_MASK = dof_mask(TASKA_8_DOFS)
+DEKA_6_MASK = dof_mask(DEKA_6_DOFS)
+WRIST_ROTATOR_MASK = dof_mask([WRIST_ROTATOR_DOF])
+WRIST_FLEXOR_MASK = dof_mask([WRIST_FLEXOR_DOF])
+
+
+def classify_dof_mask(mask: int) -> list[str]:
+    """:return: the DOF_CATEGORIES a set of kinematics falls in, or [OTHER_CATEGORY]"""
+    has_fingers = bool(mask & FINGERS_MASK)
+    membership = {
+        '8DOF-TASKA': mask & TASKA_8_MASK == TASKA_8_MASK,
+        '6DOF-DEKA': mask & DEKA_6_MASK == DEKA_6_MASK,
+        '3DOF-ETDRF': has_fingers and bool(mask & WRIST_ROTATOR_MASK) and bool(mask & WRIST_FLEXOR_MASK),
+        '2DOF-ETDR': has_fingers and bool(mask & WRIST_FLEXOR_MASK),
+        '1DOF-ETD': has_fingers,
+    }
+    return [category for category in DOF_CATEGORIES if membership[category]] or [OTHER_CATEGORY]
+
+
+def _file_hash(filepath: Path) -> str:
+    return hashlib.sha256(filepath.read_bytes()).hexdigest() if filepath.exists() else ''
+
+
+def _source_hashes(annotations_filepath: Path, manifest_filepath: Path | None) -> dict:
+    return {
+        'version': str(MANIFEST_INDEX_VERSION),
+        'annotations_sha256': _file_hash(annotations_filepath),
+        'manifest_sha256': _file_hash(manifest_filepath) if manifest_filepath is not None else '',
+    }
+
+
+def _stored_hashes(index_filepath: Path) -> dict:
+    if not index_filepath.exists():
+        return {}
+    with closing(sqlite3.connect(index_filepath)) as conn, conn:
+        try:
+            return dict(conn.execute("SELECT key, value FROM meta").fetchall())
+        except sqlite3.DatabaseError:
+            return {}
+
+
+def _job_rows(annotations: dict) -> tuple[list, list, list]:
+    """:return: rows of the jobs, kinematics and job_categories tables"""
+    jobs, kinematics, categories = [], [], []
+    for job_id, job_data in annotations.items():
+        job_kinematics = job_data.get('kinematics') or {}
+        bidirectional, independent_bidirectional = [], []
+        for name, info in job_kinematics.items():
+            gestures = info.get('gestures') or {}
+            kinematic_type = info.get('type') or ''
+            kinematics.append((job_id, name, kinematic_type, len(gestures),
+                               min((count or 0 for count in gestures.values()), default=0)))
+            # Bidirectional kinematics have two gestures: flexion and extension
+            if len(gestures) >= 2:
+                bidirectional.append(name)
+                if kinematic_type == 'independent':
+                    independent_bidirectional.append(name)
+        masks = {'all': dof_mask(job_kinematics), 'bidirectional': dof_mask(bidirectional),
+                 'independent_bidirectional': dof_mask(independent_bidirectional)}
+        jobs.append((job_id, job_data.get('training_filename'), *masks.values()))
+        categories.extend((job_id, mode, category)
+                          for mode, mask in masks.items() for category in classify_dof_mask(mask))
+    return jobs, kinematics, categories
+
+
+def compile_manifest_index(
+        annotations_filepath: Path,
+        manifest_filepath: Path | None,
+        index_filepath: Path,
+        force: bool = False
+) -> bool:
+    """
+    Compiles manifest_annotations.yaml (and manifest.tsv) into the SQLite index, unless the index was
+    already compiled from the same files.
+    :param annotations_filepath: manifest_annotations.yaml
+    :param manifest_filepath: manifest.tsv. Optional: summaries only need the annotations
+    :param index_filepath: SQLite index file
+    :param force: rebuild even if the sources did not change
+    :return: True if the index was (re)built
+    """
+    if not annotations_filepath.exists():
+        raise FileNotFoundError(f"Could not find '{annotations_filepath}'")
+    hashes = _source_hashes(annotations_filepath, manifest_filepath)
+    if not force and _stored_hashes(index_filepath) == hashes:
+        return False
+
+    with open(annotations_filepath, 'r') as f:
+        annotations = yaml.safe_load(f) or {}
+    jobs, kinematics, categories = _job_rows(annotations)
+    index_filepath.parent.mkdir(parents=True, exist_ok=True)
+    tmp_filepath = index_filepath.with_name(f".{index_filepath.name}.tmp")
+    tmp_filepath.unlink(missing_ok=True)
+    with closing(sqlite3.connect(tmp_filepath)) as conn, conn:
+        conn.executescript("""
+            CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE jobs (job_id INTEGER PRIMARY KEY, training_filename TEXT, dof_mask INTEGER,
+                               bidirectional_mask INTEGER, independent_bidirectional_mask INTEGER);
+            CREATE TABLE kinematics (job_id INTEGER, name TEXT, type TEXT, n_gestures INTEGER, min_trials INTEGER);
+            CREATE TABLE job_categories (job_id INTEGER, mode TEXT, category TEXT);
+            CREATE INDEX job_categories_mode ON job_categories (mode, category);
+        """)
+        conn.executemany("INSERT INTO meta VALUES (?, ?)", hashes.items())
+        conn.executemany("INSERT INTO jobs VALUES (?, ?, ?, ?, ?)", jobs)
+        conn.executemany("INSERT INTO kinematics VALUES (?, ?, ?, ?, ?)", kinematics)
+        conn.executemany("INSERT INTO job_categories VALUES (?, ?, ?)", categories)
+        if manifest_filepath is not None and manifest_filepath.exists():
+            manifest = pl.read_csv(manifest_filepath, separator='\t', infer_schema_length=0)
+            columns = ", ".join(f'"{column}" TEXT' for column in manifest.columns)
+            conn.execute(f"CREATE TABLE manifest ({columns})")
+            conn.executemany(f"INSERT INTO manifest VALUES ({', '.join('?' * len(manifest.columns))})",
+                             manifest.iter_rows())
+            conn.execute("CREATE INDEX manifest_job_id ON manifest (job_id)")
+    tmp_filepath.replace(index_filepath)
+    logger.info(f"Manifest index ({len(jobs)} jobs) compiled to {index_filepath}")
+    return True
+
+
+def _query(index_filepath: Path, sql: str, params: tuple = ()) -> list[tuple]:
+    with closing(sqlite3.connect(index_filepath)) as conn, conn:
+        return conn.execute(sql, params).fetchall()
+
+
+def _check_mode(mode: str):
+    if mode not in KINEMATICS_MODES:
+        raise ValueError(f"Unknown kinematics mode '{mode}'. Choose from {KINEMATICS_MODES}")
+
+
+def category_job_ids(index_filepath: Path, mode: str = 'all') -> dict[str, list[int]]:
+    """:return: {category: sorted job_ids} for DOF_CATEGORIES and OTHER_CATEGORY"""
+    _check_mode(mode)
+    job_ids = {category: [] for category in DOF_CATEGORIES + [OTHER_CATEGORY]}
+    for category, job_id in _query(index_filepath, "SELECT category, job_id FROM job_categories WHERE mode = ? "
+                                                   "ORDER BY job_id", (mode,)):
+        job_ids[category].append(job_id)
+    return job_ids
+
+
+def kinematics_summary(index_filepath: Path) -> dict:
+    """
+    Number of annotated kinematics and their total trials (the fewest trials over their gestures) by type
+    (Combined, Independent) and directionality (Unidirectional, Bidirectional).
+    :return: dict with 'datasets' and 'trials', each {type: {directionality: count}}
+    """
+    summary = {key: {kinematic_type: {'Unidirectional': 0, 'Bidirectional': 0}
+                     for kinematic_type in ['Combined', 'Independent']} for key in ['datasets', 'trials']}
+    rows = _query(index_filepath, """
+        SELECT type, n_gestures >= 2, COUNT(*), SUM(min_trials) FROM kinematics
+        WHERE type IN ('combined', 'independent') GROUP BY type, n_gestures >= 2""")
+    for kinematic_type, bidirectional, n_datasets, n_trials in rows:
+        directionality = 'Bidirectional' if bidirectional else 'Unidirectional'
+        summary['datasets'][kinematic_type.capitalize()][directionality] += n_datasets
+        summary['trials'][kinematic_type.capitalize()][directionality] += n_trials
+    return summary
+
+
+def category_manifest(index_filepath: Path, category: str, mode: str = 'bidirectional') -> pl.DataFrame:
+    """:return: manifest.tsv rows of the jobs in a category, in manifest order, with the values as written in the TSV"""
+    _check_mode(mode)
+    with closing(sqlite3.connect(index_filepath)) as conn, conn:
+        if not conn.execute("SELECT name FROM sqlite_master WHERE name = 'manifest'").fetchall():
+            raise ValueError(f"{index_filepath} was compiled without manifest.tsv")
+        cursor = conn.execute("""
+            SELECT manifest.* FROM manifest JOIN job_categories
+            ON CAST(manifest.job_id AS INTEGER) = job_categories.job_id
+            WHERE job_categories.mode = ? AND job_categories.category = ? ORDER BY manifest.rowid""",
+                              (mode, category))
+        columns = [column[0] for column in cursor.description]
+        rows = cursor.fetchall()
+    return pl.DataFrame(rows, schema={column: pl.Utf8 for column in columns}, orient='row')
+
+
+@app.command()
+def build(
+    annotations_filepath: Path = Path("reports/manifest_annotations.yaml"),
+    manifest_filepath: Path = Path("reports/manifest.tsv"),
+    index_filepath: Path = Path("reports") / MANIFEST_INDEX_FILENAME,
+    force: bool = False,
+):
+    """Compile manifest.tsv and manifest_annotations.yaml into the manifest index if either changed."""
+    if not compile_manifest_index(annotations_filepath, manifest_filepath, index_filepath, force):
+        logger.info(f"{index_filepath} is up to date")
+
+
+@app.command()
+def categories(
+    index_filepath: Path = Path("reports") / MANIFEST_INDEX_FILENAME,
+    mode: str = 'all',
+):
+    """Print the number of jobs in each DOF category."""
+    for category, job_ids in category_job_ids(index_filepath, mode).items():
+        logger.info(f"{category}: {len(job_ids)} jobs")
+
+
+if __name__ == "__main__":
+    app()
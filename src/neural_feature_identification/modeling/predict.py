@@ -1,29 +1,165 @@
 from pathlib import Path
 
+import h5py
 from loguru import logger
-from tqdm import tqdm
+import numpy as np
+from scipy import signal
 import typer
 
 from neural_feature_identification.config import MODELS_DIR, PROCESSED_DATA_DIR
+from neural_feature_identification.dataset_utils import load_decoding_data, load_project_config
 
 app = typer.Typer()
 
+KALMAN_MODEL_KEYS = ['A', 'W', 'H', 'Q']
+# Above this eigenvector condition number the steady-state recursion is run sample by sample
+MAX_MODAL_CONDITION = 1e8
+
+
+def load_kalman_model(model_path: Path) -> dict:
+    with h5py.File(model_path, 'r') as f:
+        model = {key: f[key][()] for key in KALMAN_MODEL_KEYS}
+        model['feature_sets'] = [str(name) for name in f.attrs['feature_sets']]
+    return model
+
+
+def _iter_kalman_gains(model: dict, steady_state_tol: float | None = 1e-10):
+    """
+    Yields (K, converged) for each step of kalman_test.m (xhat and P start at zero), keeping only the current
+    covariance. converged is True, and the generator stops, once max|K[t] - K[t-1]| <= tol * max|K[t]|.
+    With steady_state_tol None the gains are computed forever.
+    """
+    A, W, H, Q = model['A'], model['W'], model['H'], model['Q']
+    identity = np.eye(len(A))
+    P = np.zeros_like(A)
+    previous = None
+    while True:
+        Pm = A @ P @ A.T + W
+        K = Pm @ H.T @ np.linalg.pinv(H @ Pm @ H.T + Q)
+        P = (identity - K @ H) @ Pm
+        converged = steady_state_tol is not None and previous is not None and \
+            np.max(np.abs(K - previous)) <= steady_state_tol * np.max(np.abs(K))
+        yield K, converged
+        if converged:
+            return
+        previous = K
+
+
+def compute_kalman_gains(model: dict, n_steps: int, steady_state_tol: float | None = 1e-10) -> np.ndarray:
+    """
+    Kalman gains of kalman_test.m (xhat and P start at zero). The covariance recursion does not depend on the
+    measurements, so the gains are computed up front and stop once they have converged.
+    :param model: model dict with A, W, H and Q
+    :param n_steps: maximum number of steps
+    :param steady_state_tol: stop when max|K[t] - K[t-1]| <= tol * max|K[t]|. None computes all n_steps gains
+    :return: (T, D, F) gains, T <= n_steps. Steps after T - 1 use the last gain.
+    """
+    gains = []
+    for _, (K, converged) in zip(range(n_steps), _iter_kalman_gains(model, steady_state_tol)):
+        if converged:
+            break
+        gains.append(K)
+    return np.array(gains).reshape(len(gains), *model['H'].T.shape)
+
+
+def _run_linear_recursion(transition: np.ndarray, drive: np.ndarray, initial_state: np.ndarray) -> np.ndarray:
+    """
+    x[t] = transition @ x[t-1] + drive[t].
+    Decoupled into eigenmodes and run as first-order IIR filters when the eigenvectors are well conditioned.
+    """
+    eigvals, eigvecs = np.linalg.eig(transition)
+    if np.linalg.cond(eigvecs) > MAX_MODAL_CONDITION:
+        states = np.empty_like(drive)
+        state = initial_state
+        for t in range(len(drive)):
+            state = transition @ state + drive[t]
+            states[t] = state
+        return states
+    inv_eigvecs = np.linalg.inv(eigvecs)
+    modal_drive = drive @ inv_eigvecs.T
+    modal_initial = inv_eigvecs @ initial_state
+    modal_states = np.empty_like(modal_drive)
+    for j, eigval in enumerate(eigvals):
+        modal_states[:, j] = signal.lfilter(
+            [1.0], [1.0, -eigval], modal_drive[:, j], zi=[eigval * modal_initial[j]])[0]
+    return (modal_states @ eigvecs.T).real
+
+
+def kalman_predict(
+        z: np.ndarray,
+        model: dict,
+        klim: np.ndarray | None = None,
+        steady_state_tol: float | None = 1e-10
+) -> np.ndarray:
+    """
+    Runs kalman_test.m over a feature stream.
+    :param z: (NxF) features, samples as rows
+    :param model: model dict with A, W, H and Q
+    :param klim: optional (Dx2) min/max limits applied to the state after each update
+    :param steady_state_tol: see compute_kalman_gains. None recomputes the gain every step, as in MATLAB.
+           Only the current gain and covariance are kept, so memory does not grow with the number of steps
+    :return: (NxD) decoded kinematics
+    """
+    z = np.asarray(z, dtype=np.float64)
+    A, H = model['A'], model['H']
+    x_hat = np.zeros((len(z), len(A)))
+    if len(z) == 0:
+        return x_hat
+    identity = np.eye(len(A))
+
+    # Transient: time-varying gains
+    state = np.zeros(len(A))
+    for t, (gain, converged) in zip(range(len(z)), _iter_kalman_gains(model, steady_state_tol)):
+        if converged:
+            n_transient = t
+            break
+        state = (identity - gain @ H) @ A @ state + gain @ z[t]
+        if klim is not None:
+            state = np.clip(state, klim[:, 0], klim[:, 1])
+        x_hat[t] = state
+    else:
+        return x_hat
+
+    # Steady state: x[t] = (I - K H) A x[t-1] + K z[t]
+    transition = (identity - gain @ H) @ A
+    drive = z[n_transient:] @ gain.T
+    if klim is None:
+        x_hat[n_transient:] = _run_linear_recursion(transition, drive, state)
+        return x_hat
+    for t in range(len(drive)):
+        state = np.clip(transition @ state + drive[t], klim[:, 0], klim[:, 1])
+        x_hat[n_transient + t] = state
+    return x_hat
+
 
 @app.command()
 def main(
-    # ---- REPLACE DEFAULT PATHS AS APPROPRIATE ----
-    features_path: Path = PROCESSED_DATA_DIR / "test_features.csv",
-    model_path: Path = MODELS_DIR / "model.pkl",
-    predictions_path: Path = PROCESSED_DATA_DIR / "test_predictions.csv",
-    # -----------------------------------------
+    session_dirpath: Path,
+    model_path: Path = MODELS_DIR / "model.h5",
+    config_filepath: Path = Path("config.yaml"),
+    predictions_path: Path = PROCESSED_DATA_DIR / "test_predictions.h5",
 ):
-    # ---- REPLACE THIS WITH YOUR OWN CODE ----
-    logger.info("Performing inference for model...")
-    for i in tqdm(range(10), total=10):
-        if i == 5:
-            logger.info("Something happened for iteration 5.")
-    logger.success("Inference complete.")
-    # -----------------------------------------
+    """Decode the test trials of a session with a trained model."""
+    project_config = load_project_config(config_filepath)
+    model = load_kalman_model(model_path)
+    if model['feature_sets'] != project_config['analysis']['feature_sets']:
+        raise ValueError(f"Model was trained on {model['feature_sets']}, "
+                         f"config has {project_config['analysis']['feature_sets']}")
+
+    x, z, (_, test_idxs, _, _) = load_decoding_data(session_dirpath, project_config)
+    logger.info(f"Performing inference on {len(test_idxs)} samples...")
+    x_hat = kalman_predict(z[test_idxs], model)
+    x_test = x[test_idxs]
+    for d in range(x.shape[1]):
+        logger.info(f"DOF {d + 1}: correlation {np.corrcoef(x_hat[:, d], x_test[:, d])[0, 1]:.3f}")
+
+    predictions_path.parent.mkdir(parents=True, exist_ok=True)
+    # Same (features x samples) layout as the MATLAB-written files
+    with h5py.File(predictions_path, 'w') as f:
+        f['predictions'] = x_hat.T
+        f['kinematics'] = x_test.T
+        f['test_idxs'] = test_idxs
+    logger.success(f"Inference complete. Predictions saved to {predictions_path}")
 
 
 if __name__ == "__main__":
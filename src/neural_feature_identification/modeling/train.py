@@ -1,29 +1,169 @@
 from pathlib import Path
 
+import h5py
 from loguru import logger
+import numpy as np
 from tqdm import tqdm
 import typer
 
-from neural_feature_identification.config import MODELS_DIR, PROCESSED_DATA_DIR
+from neural_feature_identification.config import MODELS_DIR
+from neural_feature_identification.dataset_utils import load_decoding_data, load_project_config
+from neural_feature_identification.modeling.predict import KALMAN_MODEL_KEYS, kalman_predict
 
 app = typer.Typer()
 
+SUPPORTED_DECODERS = ['mkf_1st_order']
+
+
+def compute_fold_statistics(x: np.ndarray, z: np.ndarray, fold_ids: np.ndarray | None = None) -> dict:
+    """
+    Sufficient statistics of the first-order Kalman filter (the products used in kalman_train.m) for each fold.
+    Statistics are additive over folds, so a model for any union of folds is fitted from their sum.
+    State transitions are only counted between consecutive samples of the same fold.
+    :param x: (NxD) kinematics, samples as rows
+    :param z: (NxF) features, samples as rows
+    :param fold_ids: (N, ) fold index of each sample (0..K-1). Samples with a negative id are ignored.
+           Defaults to a single fold.
+    :return: dict of stacked (K, ...) arrays
+             - 'Rxx': sum x xᵀ, 'Pzx': sum z xᵀ, 'Rzz': sum z zᵀ, 'n_samples'
+             - 'A1': sum x[t+1] x[t]ᵀ, 'A2': sum x[t] x[t]ᵀ, 'W1': sum x[t+1] x[t+1]ᵀ, 'n_transitions'
+    """
+    x, z = np.asarray(x, dtype=np.float64), np.asarray(z, dtype=np.float64)
+    if len(x) != len(z):
+        raise ValueError(f"x has {len(x)} samples, z has {len(z)}")
+    if fold_ids is None:
+        fold_ids = np.zeros(len(x), dtype=np.int64)
+    fold_ids = np.asarray(fold_ids)
+    if fold_ids.shape != (len(x),):
+        raise ValueError(f"fold_ids must have shape ({len(x)}, ), got {fold_ids.shape}")
+    if not np.any(fold_ids >= 0):
+        raise ValueError("fold_ids has no sample with a non-negative fold index")
+    n_folds = int(fold_ids.max()) + 1
+    n_dofs, n_features = x.shape[1], z.shape[1]
+    stats = {
+        'Rxx': np.zeros((n_folds, n_dofs, n_dofs)),
+        'Pzx': np.zeros((n_folds, n_features, n_dofs)),
+        'Rzz': np.zeros((n_folds, n_features, n_features)),
+        'A1': np.zeros((n_folds, n_dofs, n_dofs)),
+        'A2': np.zeros((n_folds, n_dofs, n_dofs)),
+        'W1': np.zeros((n_folds, n_dofs, n_dofs)),
+        'n_samples': np.zeros(n_folds, dtype=np.int64),
+        'n_transitions': np.zeros(n_folds, dtype=np.int64),
+    }
+    for k in range(n_folds):
+        in_fold = fold_ids == k
+        x_k, z_k = x[in_fold], z[in_fold]
+        stats['Rxx'][k], stats['Pzx'][k], stats['Rzz'][k] = x_k.T @ x_k, z_k.T @ x_k, z_k.T @ z_k
+        stats['n_samples'][k] = len(x_k)
+        transitions = np.flatnonzero(in_fold[:-1] & in_fold[1:])
+        x_prev, x_next = x[transitions], x[transitions + 1]
+        stats['A1'][k], stats['A2'][k], stats['W1'][k] = x_next.T @ x_prev, x_prev.T @ x_prev, x_next.T @ x_next
+        stats['n_transitions'][k] = len(transitions)
+    return stats
+
+
+def fit_kalman_from_statistics(stats: dict, folds: np.ndarray | list[int] | None = None) -> dict:
+    """
+    Fits a first-order Kalman filter (kalman_train.m) from summed sufficient statistics.
+    :param stats: output of compute_fold_statistics
+    :param folds: folds to train on. Defaults to all folds
+    :return: model dict with A (DxD), W (DxD), H (FxD) and Q (FxF), as the TRAIN struct in MATLAB
+    """
+    folds = slice(None) if folds is None else np.asarray(folds)
+    summed = {key: val[folds].sum(axis=0) for key, val in stats.items()}
+    A = summed['A1'] @ np.linalg.pinv(summed['A2'])
+    W = (summed['W1'] - A @ summed['A1'].T) / summed['n_transitions']
+    H = summed['Pzx'] @ np.linalg.pinv(summed['Rxx'])
+    Q = (summed['Rzz'] - H @ summed['Pzx'].T) / summed['n_samples']
+    return {'A': A, 'W': W, 'H': H, 'Q': Q}
+
+
+def fit_kalman_folds(stats: dict) -> list[dict]:
+    """
+    Leave-one-fold-out models: model k is trained on every fold except k.
+    :param stats: output of compute_fold_statistics
+    :return: list of K model dicts
+    """
+    n_folds = len(stats['n_samples'])
+    return [fit_kalman_from_statistics(stats, np.delete(np.arange(n_folds), k)) for k in range(n_folds)]
+
+
+def select_kalman_features(model: dict, feature_idxs: np.ndarray | list[int]) -> dict:
+    """
+    Model restricted to a feature subset.
+    Rows of H and the matching block of Q do not depend on the other features, so this is identical to
+    training on the subset and lets many subsets share one fit.
+    :param model: model dict from fit_kalman_from_statistics
+    :param feature_idxs: columns of z to keep
+    :return: model dict
+    """
+    feature_idxs = np.asarray(feature_idxs)
+    return {'A': model['A'], 'W': model['W'], 'H': model['H'][feature_idxs],
+            'Q': model['Q'][np.ix_(feature_idxs, feature_idxs)]}
+
+
+def kalman_train(x: np.ndarray, z: np.ndarray) -> dict:
+    """
+    Port of kalman_train.m.
+    :param x: (NxD) kinematics, samples as rows
+    :param z: (NxF) features, samples as rows
+    :return: model dict with A, W, H and Q
+    """
+    return fit_kalman_from_statistics(compute_fold_statistics(x, z))
+
+
+def make_trial_folds(trials_info: list[dict], n_samples: int, n_folds: int) -> np.ndarray:
+    """
+    Assigns contiguous groups of trials to folds.
+    :param trials_info: trial infos from generate_train_test_split (relative indices into the stitched arrays)
+    :param n_samples: length of the stitched arrays
+    :param n_folds: number of folds
+    :return: (n_samples, ) fold index of each sample
+    """
+    fold_ids = np.full(n_samples, -1, dtype=np.int64)
+    for k, fold_trials in enumerate(np.array_split(np.arange(len(trials_info)), n_folds)):
+        for trial_idx in fold_trials:
+            trial = trials_info[trial_idx]
+            fold_ids[trial['relative_start_idx']:trial['relative_stop_idx']] = k
+    return fold_ids
+
+
+def save_kalman_model(model_path: Path, model: dict, feature_sets: list[str], decoder: str = 'mkf_1st_order'):
+    model_path.parent.mkdir(parents=True, exist_ok=True)
+    with h5py.File(model_path, 'w') as f:
+        f.attrs['decoder'] = decoder
+        f.attrs['feature_sets'] = feature_sets
+        for key in KALMAN_MODEL_KEYS:
+            f[key] = model[key]
+
 
 @app.command()
 def main(
-    # ---- REPLACE DEFAULT PATHS AS APPROPRIATE ----
-    features_path: Path = PROCESSED_DATA_DIR / "features.csv",
-    labels_path: Path = PROCESSED_DATA_DIR / "labels.csv",
-    model_path: Path = MODELS_DIR / "model.pkl",
-    # -----------------------------------------
+    session_dirpath: Path,
+    config_filepath: Path = Path("config.yaml"),
+    model_path: Path = MODELS_DIR / "model.h5",
+    n_folds: int = 1,
 ):
-    # ---- REPLACE THIS WITH YOUR OWN CODE ----
-    logger.info("Training some model...")
-    for i in tqdm(range(10), total=10):
-        if i == 5:
-            logger.info("Something happened for iteration 5.")
-    logger.success("Modeling training complete.")
-    # -----------------------------------------
+    """Train the decoder in algorithms.decoder on the training trials of a session."""
+    project_config = load_project_config(config_filepath)
+    decoder = project_config['algorithms']['decoder']
+    if decoder not in SUPPORTED_DECODERS:
+        raise ValueError(f"Unsupported decoder: {decoder}")
+
+    x, z, (train_idxs, _, train_trials_info, _) = load_decoding_data(session_dirpath, project_config)
+    x_train, z_train = x[train_idxs], z[train_idxs]
+    logger.info(f"Training {decoder} on {len(train_idxs)} samples and {z.shape[1]} features...")
+    fold_ids = make_trial_folds(train_trials_info, len(train_idxs), n_folds)
+    stats = compute_fold_statistics(x_train, z_train, fold_ids)
+    if n_folds > 1:
+        for k, model in enumerate(tqdm(fit_kalman_folds(stats), desc='Cross-validating')):
+            held_out = fold_ids == k
+            x_hat = kalman_predict(z_train[held_out], model)
+            correlations = [np.corrcoef(x_hat[:, d], x_train[held_out, d])[0, 1] for d in range(x.shape[1])]
+            logger.info(f"Fold {k}: mean correlation {np.nanmean(correlations):.3f}")
+    feature_sets = project_config['analysis']['feature_sets']
+    save_kalman_model(model_path, fit_kalman_from_statistics(stats), feature_sets, decoder)
+    logger.success(f"Model saved to {model_path}")
 
 
 if __name__ == "__main__":
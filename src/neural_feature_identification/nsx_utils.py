@@ -0,0 +1,235 @@
+from collections.abc import Iterator
+from pathlib import Path
+
+from loguru import logger
+import numpy as np
+import scipy.io
+
+NSX_SAMPLING_RATES = {'.ns2': 1_000, '.ns3': 2_000, '.ns4': 10_000, '.ns5': 30_000, '.ns6': 30_000}
+NUM_CHANS = 192  # 3x(8x8) USEA channels, the remaining channels are EMG/analog inputs
+DEFAULT_BLOCK_SAMPLES = 30_000 * 10  # 10 s of 30 kHz data per block
+
+_CHANNEL_HEADER_DTYPE = np.dtype([
+    ('Type', 'S2'), ('ChannelID', '<u2'), ('ChannelLabel', 'S16'), ('PhysConnector', 'u1'),
+    ('ConnectorPin', 'u1'), ('MinDigVal', '<i2'), ('MaxDigVal', '<i2'), ('MinAnlgVal', '<i2'),
+    ('MaxAnlgVal', '<i2'), ('Units', 'S16'), ('HighFreqCorner', '<u4'), ('HighFreqOrder', '<u4'),
+    ('HighFiltType', '<u2'), ('LowFreqCorner', '<u4'), ('LowFreqOrder', '<u4'), ('LowFiltType', '<u2'),
+])
+
+
+def read_nsx_header(filepath: Path) -> dict:
+    """
+    Reads the basic and extended headers of an NSx file and locates its data segment.
+    Port of the header logic in unrl_utils.fastNSxRead2022, including its handling of paused recordings
+    and of the single-sample segment written when firmware 6.03 splits a file.
+    :param filepath: path to a .ns2-.ns6 file
+    :return: dict with the header fields, 'data_offset' (bytes) and 'channel_samples'
+    """
+    if not filepath.exists():
+        raise FileNotFoundError(f"Could not find '{filepath}'")
+    suffix = filepath.suffix.lower()
+    if suffix not in NSX_SAMPLING_RATES:
+        raise ValueError(f"'{filepath.name}' is not an NSx file")
+    header = {'Fs': NSX_SAMPLING_RATES[suffix]}
+    file_size = filepath.stat().st_size
+
+    with open(filepath, 'rb') as f:
+        header['FileID'] = f.read(8).decode('latin-1')
+        if header['FileID'] == 'NEURALSG':  # v2.1
+            header['FsStr'] = f.read(16).decode('latin-1').rstrip('\x00')
+            header['Period'], header['ChannelCount'] = np.fromfile(f, '<u4', 2).tolist()
+            header['ChannelID'] = np.fromfile(f, '<u4', header['ChannelCount'])
+            header['data_offset'] = f.tell()
+            header['channel_samples'] = (file_size - f.tell()) // (header['ChannelCount'] * 2)
+            return header
+
+        # v2.2 or v2.3 (NEURALCD)
+        header['FileSpec'] = tuple(np.fromfile(f, 'u1', 2).tolist())
+        header['HeaderBytes'] = int(np.fromfile(f, '<u4', 1)[0])
+        header['FsStr'] = f.read(16).decode('latin-1').rstrip('\x00')
+        header['Comment'] = f.read(252).decode('latin-1').rstrip('\x00')
+        header['NIPStart'], header['Period'], header['Resolution'] = np.fromfile(f, '<u4', 3).tolist()
+        header['TimeOrigin'] = np.fromfile(f, '<u2', 8)
+        header['ChannelCount'] = int(np.fromfile(f, '<u4', 1)[0])
+        channels = np.fromfile(f, _CHANNEL_HEADER_DTYPE, header['ChannelCount'])
+        for field in _CHANNEL_HEADER_DTYPE.names:
+            header[field] = channels[field]
+
+        # Walk the data segments. Each one starts with 0x01, a uint32 timestamp and a uint32 sample count
+        bytes_per_sample = header['ChannelCount'] * 2
+        segments = []
+        while f.tell() < file_size:
+            segment_header = np.fromfile(f, np.dtype([('id', 'u1'), ('ts', '<u4'), ('n', '<u4')]), 1)
+            if len(segment_header) == 0 or segment_header['id'][0] != 1:
+                raise ValueError(f"Error reading data headers in '{filepath.name}'")
+            data_offset, n_samples = f.tell(), int(segment_header['n'][0])
+            available = (file_size - data_offset) // bytes_per_sample
+            if n_samples == 0 or n_samples > available:  # Zero length or ran out of disk space
+                segments.append((int(segment_header['ts'][0]), data_offset, available))
+                break
+            segments.append((int(segment_header['ts'][0]), data_offset, n_samples))
+            f.seek(n_samples * bytes_per_sample, 1)
+
+    if not segments:
+        raise ValueError(f"No data segments found in '{filepath.name}'")
+    if len(segments) > 2 or (len(segments) == 2 and segments[0][2] != 1):
+        logger.warning(f"Pauses exist in '{filepath.name}'. Will only use data before the pause")
+        segments = segments[:1]
+    header['DataTimestamp'], header['data_offset'], header['channel_samples'] = segments[-1]
+    return header
+
+
+def get_scaling_factor(header: dict) -> float:
+    """
+    Digital to analog scaling factor of the first channel, as computed in extract_features.m
+    """
+    return (float(header['MaxAnlgVal'][0]) - float(header['MinAnlgVal'][0])) / \
+           (float(header['MaxDigVal'][0]) - float(header['MinDigVal'][0]))
+
+
+def open_nsx_data(filepath: Path, header: dict | None = None) -> np.memmap:
+    """
+    Memory-maps the data segment of an NSx file without reading it.
+    :param filepath: path to the NSx file
+    :param header: header from read_nsx_header, read from the file if not provided
+    :return: read-only (samples x channels) int16 memmap
+    """
+    header = header or read_nsx_header(filepath)
+    return np.memmap(filepath, dtype='<i2', mode='r', offset=header['data_offset'],
+                     shape=(header['channel_samples'], header['ChannelCount']))
+
+
+def _nip_range_to_samples(header: dict, nip_range: tuple[float, float]) -> tuple[int, int]:
+    """
+    Converts an inclusive, 1-based [first, last] sample range (fastNSxRead2022 'Range' convention)
+    to a 0-based half-open range, clipped to the data segment.
+    """
+    first, last = int(np.round(nip_range[0])), int(np.round(nip_range[1]))
+    if first < 1 or last < first:
+        raise ValueError(f"Invalid NSx range {nip_range}")
+    start, stop = first - 1, min(last, header['channel_samples'])
+    if stop < last:
+        logger.warning(f"Requested range {nip_range} extends past the last sample "
+                       f"({header['channel_samples']}). Truncating")
+    return start, stop
+
+
+def iter_nsx_blocks(
+        filepath: Path,
+        nip_range: tuple[float, float] | None = None,
+        block_samples: int = DEFAULT_BLOCK_SAMPLES,
+        overlap_samples: int = 0,
+        num_chans: int = NUM_CHANS,
+        header: dict | None = None
+) -> Iterator[tuple[int, np.ndarray]]:
+    """
+    Streams scaled (time x channel) blocks from an NSx file.
+    Only the window of the current block is memory-mapped, and it is unmapped once the block has been
+    copied, so peak memory depends on `block_samples` and not on the length of the recording.
+    :param filepath: path to the NSx file
+    :param nip_range: inclusive [first, last] sample range (same convention as fastNSxRead2022).
+                      Defaults to the whole data segment
+    :param block_samples: number of new samples in each block
+    :param overlap_samples: number of samples from the previous block prepended to each block, e.g.
+                            for filter warm-up. The first block has no overlap
+    :param num_chans: number of leading channels to keep
+    :param header: header from read_nsx_header, read from the file if not provided
+    :return: generator of (start_idx, block) where start_idx is the index of the first row of the
+             block relative to the start of `nip_range` and block is float32 (rows x num_chans)
+    """
+    header = header or read_nsx_header(filepath)
+    start, stop = _nip_range_to_samples(header, nip_range or (1, header['channel_samples']))
+    num_chans = min(num_chans, header['ChannelCount'])
+    scaling_factor = np.float32(get_scaling_factor(header))
+    bytes_per_sample = header['ChannelCount'] * 2
+
+    for block_start in range(start, stop, block_samples):
+        read_start = max(block_start - overlap_samples, start)
+        read_stop = min(block_start + block_samples, stop)
+        window = np.memmap(filepath, dtype='<i2', mode='r',
+                           offset=header['data_offset'] + read_start * bytes_per_sample,
+                           shape=(read_stop - read_start, header['ChannelCount']))
+        block = window[:, :num_chans].astype(np.float32)
+        del window
+        block *= scaling_factor
+        yield read_start - start, block
+
+
+def read_nsx_range(
+        filepath: Path,
+        nip_range: tuple[float, float] | None = None,
+        num_chans: int = NUM_CHANS,
+        block_samples: int = DEFAULT_BLOCK_SAMPLES,
+        header: dict | None = None
+) -> np.ndarray:
+    """
+    Reads a scaled (time x channel) float32 array. Equivalent to fastNSxRead2022 followed by the
+    single(...)' .* scaling in extract_features.m, but filled block by block so the raw int16 data and
+    its transposed copy never exist in memory at full length.
+    :param filepath: path to the NSx file
+    :param nip_range: inclusive [first, last] sample range
+    :param num_chans: number of leading channels to keep
+    :param block_samples: number of samples converted at once
+    :param header: header from read_nsx_header, read from the file if not provided
+    :return: float32 (samples x num_chans) array
+    """
+    header = header or read_nsx_header(filepath)
+    start, stop = _nip_range_to_samples(header, nip_range or (1, header['channel_samples']))
+    num_chans = min(num_chans, header['ChannelCount'])
+    logger.info(f"Loading {(stop - start) * num_chans * 4 / 1e9:0.1f} GB of data from {filepath.name}")
+    data = np.empty((stop - start, num_chans), dtype=np.float32)
+    for block_start, block in iter_nsx_blocks(filepath, nip_range, block_samples, 0, num_chans, header):
+        data[block_start:block_start + len(block)] = block
+    return data
+
+
+def read_kdf(filepath: Path) -> dict:
+    """
+    Reads a *.kdf file (Kalman decode filespec) saved by FeedbackDecode.vi. Port of unrl_utils.readKDF_jag.
+    :param filepath: path to the KDF file
+    :return: dict of (N x k) float32 arrays with keys 'nip_time', 'features', 'kinematics',
+             'targets' and 'kalman'. Empty sections are (N x 0)
+    """
+    if not filepath.exists():
+        raise FileNotFoundError(f"Could not find '{filepath}'")
+    raw = np.fromfile(filepath, dtype='<f4')
+    section_lengths = raw[:5].astype(np.int64)
+    data = raw[5:].reshape(-1, section_lengths.sum())
+    bounds = np.concatenate([[0], np.cumsum(section_lengths)])
+    keys = ['nip_time', 'features', 'kinematics', 'targets', 'kalman']
+    return {key: data[:, bounds[i]:bounds[i + 1]] for i, key in enumerate(keys)}
+
+
+def compute_nip_offset(ns2_filepath: Path, rec_start_filepath: Path) -> float:
+    """
+    Number of NIP samples the NSx files lead the KDF file. Port of project_utils.CalculateNIPOffset_bhm.
+    :param ns2_filepath: NS2 file of the recording
+    :param rec_start_filepath: RecStart_*.mat or Kalman_SSStruct_*.mat file
+    :return: NIP offset
+    """
+    if not rec_start_filepath.exists():
+        raise FileNotFoundError(f"Could not find '{rec_start_filepath}'")
+    rec_start_data = scipy.io.loadmat(rec_start_filepath, squeeze_me=True, struct_as_record=False)
+    nip_start = float(read_nsx_header(ns2_filepath)['NIPStart'])
+    if 'RecStart' in rec_start_data:
+        return float(rec_start_data['RecStart']) - nip_start
+    if 'SS' in rec_start_data and hasattr(rec_start_data['SS'], 'RecStart'):
+        return float(rec_start_data['SS'].RecStart) - nip_start
+    return 0.0
+
+
+def compute_session_nip_offset(session_path: Path, ns5_filename: str) -> float:
+    """
+    NIP offset of a session, trying RecStart_*.mat first and Kalman_SSStruct_*.mat second
+    (P2015 sessions) like extract_features.m.
+    :param session_path: session directory, named after the recording (YYYYMMDD-hhmmss)
+    :param ns5_filename: NS5 filename in the session directory
+    :return: NIP offset
+    """
+    ns2_filepath = session_path / Path(ns5_filename).with_suffix('.ns2').name
+    session_name = session_path.name[-15:]
+    try:
+        return compute_nip_offset(ns2_filepath, session_path / f"RecStart_{session_name}.mat")
+    except (FileNotFoundError, ValueError) as e:
+        logger.warning(f"Failed to compute NIP offset with RecStart. Attempting SSStruct instead. {e}")
+        return compute_nip_offset(ns2_filepath, session_path / f"Kalman_SSStruct_{session_name}.mat")
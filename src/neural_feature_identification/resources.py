@@ -0,0 +1,377 @@
+import json
+import os
+from pathlib import Path
+import re
+
+import h5py
+from loguru import logger
+import numpy as np
+import polars as pl
+import typer
+
+from neural_feature_identification.data_discovery import (
+    DISCOVERY_INDEX_FILENAME,
+    file_sizes,
+    read_discovery_index,
+)
+from neural_feature_identification.dataset_utils import load_project_config
+
+app = typer.Typer()
+
+# Size-driven SLURM resources for the Snakemake rules. Memory (MB) and runtime (minutes) of a job are
+# predicted as intercept + slope * input size (GB), where the input is the raw files a rule reads (the NS5
+# file for feature extraction, the KDF/KEF files for preprocessing). The coefficients are fitted per rule and
+# feature set from finished jobs and stored in reports/resource_model.json; rules and feature sets without
+# enough finished jobs use DEFAULT_COEFFICIENTS. Each retry of a failed job multiplies both by
+# RETRY_ESCALATION, up to the caps.
+RESOURCE_MODEL_FILENAME = "resource_model.json"
+RESOURCE_TARGETS = ['mem_mb', 'runtime_min']
+RULE_INPUT_COLUMNS = {
+    'preprocess_session': ['training_filename', 'events_filename'],
+    'session_clock': ['training_filename'],
+    'detect_spikes': ['full_stream_filename'],
+    'compute_baseline_stats': ['full_stream_filename'],
+    'extract_features': ['full_stream_filename'],
+    'extract_features_session': ['full_stream_filename'],
+}
+# Priors: {rule: {target: (intercept, slope per GB of input)}}. Memory slopes assume the loaded NS5 ranges
+# are converted to double and filtered with a few full-size copies, so they err on the large side.
+DEFAULT_COEFFICIENTS = {
+    'preprocess_session': {'mem_mb': (2000, 4000), 'runtime_min': (10, 30)},
+    'session_clock': {'mem_mb': (1000, 2000), 'runtime_min': (5, 5)},
+    'detect_spikes': {'mem_mb': (4000, 6000), 'runtime_min': (10, 10)},
+    'compute_baseline_stats': {'mem_mb': (4000, 2000), 'runtime_min': (5, 5)},
+    'extract_features': {'mem_mb': (4000, 10000), 'runtime_min': (10, 15)},
+    'extract_features_session': {'mem_mb': (4000, 8000), 'runtime_min': (15, 40)},
+}
+# Used when the input size of a job is unknown (e.g. the discovery index was never built): the fixed
+# reservations the rules had before they were size-driven
+FALLBACK_RESOURCES = {
+    'preprocess_session': {'mem_mb': 4000, 'runtime_min': 60},
+    'session_clock': {'mem_mb': 4000, 'runtime_min': 10},
+    'detect_spikes': {'mem_mb': 64000, 'runtime_min': 120},
+    'compute_baseline_stats': {'mem_mb': 32000, 'runtime_min': 60},
+    'extract_features': {'mem_mb': 120000, 'runtime_min': 120},
+    'extract_features_session': {'mem_mb': 120000, 'runtime_min': 240},
+}
+ALL_FEATURE_SETS = '*'  # coefficients fitted over every feature set of a rule
+MIN_MEM_MB = 1000
+MIN_RUNTIME_MIN = 5
+MAX_MEM_MB = 250000
+MAX_RUNTIME_MIN = 72 * 60  # kingspeak wall time limit
+RETRY_ESCALATION = 1.5
+FIT_HEADROOM = 1.2  # margin over the largest observed usage
+FIT_MIN_OBSERVATIONS = 3
+OBSERVATIONS_SCHEMA = {
+    'rule': pl.Utf8,
+    'job_id': pl.Int64,
+    'feature_set': pl.Utf8,  # ALL_FEATURE_SETS for rules that are not per feature set
+    'mem_mb': pl.Float64,
+    'runtime_min': pl.Float64,
+    'source': pl.Utf8,  # 'benchmark', 'log' or 'computation_times'
+}
+# MATLAB's extract_features ends its log with this field (project_utils.write_log_message)
+LOG_DURATION_PATTERN = re.compile(r"total_duration_sec=([0-9.eE+-]+)")
+
+
+def job_input_sizes(manifest: pl.DataFrame, index: pl.DataFrame) -> dict[int, dict[str, int]]:
+    """
+    :param manifest: manifest.tsv rows
+    :param index: discovery index (data_discovery.discover_sessions) of the manifest's session directories
+    :return: {job_id: {manifest column: size in bytes}} of the raw files found in the index
+    """
+    sizes = file_sizes(index)
+    columns = sorted({column for columns in RULE_INPUT_COLUMNS.values() for column in columns} & set(manifest.columns))
+    job_sizes = {}
+    for row in manifest.select(['job_id', 'session_dir', *columns]).iter_rows(named=True):
+        job_sizes[int(row['job_id'])] = {column: sizes[(row['session_dir'], row[column])] for column in columns
+                                         if (row['session_dir'], row[column]) in sizes}
+    return job_sizes
+
+
+def load_job_input_sizes(manifest_filepath: Path, index_filepath: Path) -> dict[int, dict[str, int]]:
+    """job_input_sizes from manifest.tsv and the cached discovery index, without listing any directory"""
+    manifest = pl.read_csv(manifest_filepath, separator='\t', infer_schema_length=0)
+    return job_input_sizes(manifest, read_discovery_index(index_filepath))
+
+
+def rule_input_gb(rule: str, sizes: dict[str, int]) -> float | None:
+    """:return: size in GB of the raw files a rule reads, or None if any of them is unknown"""
+    if rule not in RULE_INPUT_COLUMNS:
+        raise ValueError(f"Unknown rule '{rule}'. Choose from {list(RULE_INPUT_COLUMNS)}")
+    if any(column not in sizes for column in RULE_INPUT_COLUMNS[rule]):
+        return None
+    return sum(sizes[column] for column in RULE_INPUT_COLUMNS[rule]) / 1024 ** 3
+
+
+def format_slurm_time(minutes: float) -> str:
+    """:return: SLURM time limit, 'HH:MM:SS' or 'D-HH:MM:SS'"""
+    minutes = int(np.ceil(minutes))
+    days, minutes = divmod(minutes, 24 * 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{days}-{hours:02d}:{minutes:02d}:00" if days else f"{hours:02d}:{minutes:02d}:00"
+
+
+class ResourceModel:
+    """
+    Predicts the memory and runtime of the jobs of a rule. mem_mb() and runtime() return callables for the
+    resources section of a rule, e.g. `mem_mb=RESOURCE_MODEL.mem_mb("extract_features")`.
+    """
+    def __init__(
+            self,
+            coefficients: dict | None = None,
+            job_sizes: dict[int, dict[str, int]] | None = None,
+            max_mem_mb: int = MAX_MEM_MB,
+            max_runtime_min: int = MAX_RUNTIME_MIN,
+            retry_escalation: float = RETRY_ESCALATION
+    ):
+        """
+        :param coefficients: fitted {rule: {feature_set: {target: [intercept, slope]}}} (fit_resource_model)
+        :param job_sizes: {job_id: {manifest column: size in bytes}} (job_input_sizes)
+        :param max_mem_mb: memory cap, including retries
+        :param max_runtime_min: runtime cap in minutes, including retries
+        :param retry_escalation: factor applied to the prediction on every retry
+        """
+        if retry_escalation < 1:
+            raise ValueError(f"retry_escalation must be at least 1, got {retry_escalation}")
+        self.coefficients = coefficients or {}
+        self.job_sizes = job_sizes or {}
+        self.limits = {'mem_mb': (MIN_MEM_MB, max_mem_mb), 'runtime_min': (MIN_RUNTIME_MIN, max_runtime_min)}
+        self.retry_escalation = retry_escalation
+
+    def _coefficients(self, rule: str, feature_set: str, target: str) -> tuple[float, float]:
+        fitted = self.coefficients.get(rule, {})
+        for group in [feature_set, ALL_FEATURE_SETS]:
+            if target in fitted.get(group, {}):
+                return tuple(fitted[group][target])
+        return DEFAULT_COEFFICIENTS[rule][target]
+
+    def predict(self, rule: str, job_id: int, feature_set: str = ALL_FEATURE_SETS, attempt: int = 1) -> dict:
+        """:return: {'mem_mb': int, 'runtime_min': int} for an attempt (1 for the first submission) of a job"""
+        input_gb = rule_input_gb(rule, self.job_sizes.get(int(job_id), {}))
+        escalation = self.retry_escalation ** (max(attempt, 1) - 1)
+        prediction = {}
+        for target in RESOURCE_TARGETS:
+            if input_gb is None:
+                value = FALLBACK_RESOURCES[rule][target]
+            else:
+                intercept, slope = self._coefficients(rule, feature_set, target)
+                value = intercept + slope * input_gb
+            low, high = self.limits[target]
+            prediction[target] = int(np.ceil(np.clip(value * escalation, low, high)))
+        return prediction
+
+    def mem_mb(self, rule: str):
+        """:return: callable(wildcards, attempt) for the mem_mb resource of a rule"""
+        def mem_mb(wildcards, attempt):
+            return self.predict(rule, wildcards.job_id, wildcards.get('feature_set', ALL_FEATURE_SETS),
+                                attempt)['mem_mb']
+        return mem_mb
+
+    def runtime(self, rule: str):
+        """
+        :return: callable(wildcards, attempt) for the runtime resource (minutes) of a rule, the SLURM time limit.
+        Snakemake adds up the runtime of the jobs a group job runs one after the other
+        """
+        def runtime(wildcards, attempt):
+            return self.predict(rule, wildcards.job_id, wildcards.get('feature_set', ALL_FEATURE_SETS),
+                                attempt)['runtime_min']
+        return runtime
+
+    def save(self, filepath: Path):
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        with open(filepath, 'w') as f:
+            json.dump(self.coefficients, f, indent=4, sort_keys=True)
+
+    @classmethod
+    def load(cls, filepath: Path, job_sizes: dict[int, dict[str, int]] | None = None, **kwargs) -> 'ResourceModel':
+        """:return: model with the coefficients of filepath, or the default coefficients if it does not exist"""
+        coefficients = {}
+        if filepath.exists():
+            with open(filepath, 'r') as f:
+                coefficients = json.load(f)
+        return cls(coefficients, job_sizes, **kwargs)
+
+
+def read_benchmark(filepath: Path) -> tuple[float | None, float | None]:
+    """:return: (max_rss in MB, runtime in minutes) of a Snakemake benchmark file. None for 'NA' values"""
+    benchmark = pl.read_csv(filepath, separator='\t', null_values=['NA', '-'], infer_schema_length=0)
+    if not len(benchmark):
+        return None, None
+    row = benchmark.row(-1, named=True)
+    max_rss = float(row['max_rss']) if row.get('max_rss') is not None else None
+    runtime = float(row['s']) / 60 if row.get('s') is not None else None
+    return max_rss, runtime
+
+
+def read_log_duration(filepath: Path) -> float | None:
+    """:return: total duration in minutes logged by MATLAB's extract_features, or None"""
+    matches = LOG_DURATION_PATTERN.findall(filepath.read_text(errors='replace'))
+    return float(matches[-1]) / 60 if matches else None
+
+
+def read_computation_minutes(filepath: Path) -> float | None:
+    """:return: sum of the per-frame computation_times of a feature file in minutes, or None"""
+    try:
+        with h5py.File(filepath, 'r') as f:
+            return float(np.sum(f['computation_times'][()])) / 60
+    except (OSError, KeyError):
+        return None
+
+
+def _split_job_name(name: str) -> tuple[int, str] | None:
+    """:return: (job_id, feature_set) of '<job_id>' or '<job_id>_<feature_set>' names, None for other names"""
+    job_id, _, feature_set = name.partition('_')
+    if not job_id.isdigit() or feature_set == 'session':
+        return None
+    return int(job_id), feature_set or ALL_FEATURE_SETS
+
+
+def collect_observations(results_root: Path, scratch_root: Path | None = None) -> pl.DataFrame:
+    """
+    Collects the memory and runtime of finished jobs, from (in order of preference) the Snakemake benchmark
+    files in results_root/benchmarks/<rule>/, the total durations in the MATLAB logs of
+    results_root/logs/extract_features/ and the summed computation_times of the feature files under
+    scratch_root. Only benchmarks record memory; the other sources only fill in missing runtimes.
+    :return: one row per (rule, job_id, feature_set), see OBSERVATIONS_SCHEMA
+    """
+    observations = {}
+    for rule in RULE_INPUT_COLUMNS:
+        benchmark_dirpath = results_root / "benchmarks" / rule
+        if not benchmark_dirpath.is_dir():
+            continue
+        for filepath in benchmark_dirpath.glob("*.tsv"):
+            key = _split_job_name(filepath.stem)
+            if key is not None:
+                observations[(rule, *key)] = (*read_benchmark(filepath), 'benchmark')
+
+    fallbacks = {}
+    log_dirpath = results_root / "logs" / "extract_features"
+    if log_dirpath.is_dir():
+        for filepath in log_dirpath.glob("*.log"):
+            key = _split_job_name(filepath.stem)
+            if key is not None and key[1] != ALL_FEATURE_SETS:
+                fallbacks[('extract_features', *key)] = (read_log_duration(filepath), 'log')
+    if scratch_root is not None and scratch_root.is_dir():
+        with os.scandir(scratch_root) as job_dirs:
+            for job_dir in job_dirs:
+                features_dirpath = Path(job_dir.path) / "features"
+                if not job_dir.name.isdigit() or not features_dirpath.is_dir():
+                    continue
+                for filepath in features_dirpath.glob("*.h5"):
+                    key = ('extract_features', int(job_dir.name), filepath.stem)
+                    if key not in fallbacks and observations.get(key, (None, None))[1] is None:
+                        fallbacks[key] = (read_computation_minutes(filepath), 'computation_times')
+
+    for key, (runtime, source) in fallbacks.items():
+        mem_mb, observed_runtime, observed_source = observations.get(key, (None, None, None))
+        if observed_runtime is None and runtime is not None:
+            observations[key] = (mem_mb, runtime, source if mem_mb is None else f"{observed_source}+{source}")
+    rows = [{'rule': rule, 'job_id': job_id, 'feature_set': feature_set, 'mem_mb': mem_mb,
+             'runtime_min': runtime, 'source': source}
+            for (rule, job_id, feature_set), (mem_mb, runtime, source) in sorted(observations.items())]
+    return pl.DataFrame(rows, schema=OBSERVATIONS_SCHEMA)
+
+
+def fit_coefficients(input_gb: np.ndarray, values: np.ndarray, headroom: float = FIT_HEADROOM) -> list[float]:
+    """
+    Fits intercept + slope * input_gb to the upper envelope of the observations: the least-squares slope
+    (at least 0) with the intercept raised until no observation is above the line, both scaled by headroom.
+    :return: [intercept, slope]
+    """
+    input_gb, values = np.asarray(input_gb, dtype=np.float64), np.asarray(values, dtype=np.float64)
+    slope = 0.0
+    if len(values) > 1 and np.ptp(input_gb) > 0:
+        slope = max(float(np.polyfit(input_gb, values, 1)[0]), 0.0)
+    intercept = float(np.max(values - slope * input_gb))
+    return [headroom * intercept, headroom * slope]
+
+
+def fit_resource_model(
+        observations: pl.DataFrame,
+        job_sizes: dict[int, dict[str, int]],
+        min_observations: int = FIT_MIN_OBSERVATIONS,
+        headroom: float = FIT_HEADROOM
+) -> dict:
+    """
+    Fits the coefficients of every rule, per feature set and over all feature sets (ALL_FEATURE_SETS).
+    Groups with fewer than min_observations jobs of known input size are left out, so they use the next
+    coefficients in line (all feature sets, then DEFAULT_COEFFICIENTS).
+    :param observations: collect_observations output
+    :param job_sizes: {job_id: {manifest column: size in bytes}} (job_input_sizes)
+    :param min_observations: minimum number of jobs per fitted group
+    :param headroom: margin over the largest observed usage
+    :return: {rule: {feature_set: {target: [intercept, slope], 'n_<target>': n}}}
+    """
+    input_gb = [rule_input_gb(rule, job_sizes.get(job_id, {})) if rule in RULE_INPUT_COLUMNS else None
+                for rule, job_id in observations.select(['rule', 'job_id']).iter_rows()]
+    observations = observations.with_columns(input_gb=pl.Series(input_gb, dtype=pl.Float64)).drop_nulls('input_gb')
+    coefficients = {}
+    for (rule, ), rule_observations in observations.group_by(['rule']):
+        groups = {ALL_FEATURE_SETS: rule_observations}
+        if rule_observations['feature_set'].n_unique() > 1:
+            groups.update({feature_set: group
+                           for (feature_set, ), group in rule_observations.group_by(['feature_set'])})
+        for feature_set, group in groups.items():
+            for target in RESOURCE_TARGETS:
+                known = group.drop_nulls(target)
+                if len(known) < min_observations:
+                    continue
+                fitted = coefficients.setdefault(rule, {}).setdefault(feature_set, {})
+                fitted[target] = fit_coefficients(known['input_gb'].to_numpy(), known[target].to_numpy(), headroom)
+                fitted[f"n_{target}"] = len(known)
+    return coefficients
+
+
+@app.command()
+def fit(
+    manifest_filepath: Path = Path("reports/manifest.tsv"),
+    index_filepath: Path = Path("reports") / DISCOVERY_INDEX_FILENAME,
+    model_filepath: Path = Path("reports") / RESOURCE_MODEL_FILENAME,
+    config_filepath: Path = Path("config.yaml"),
+    min_observations: int = FIT_MIN_OBSERVATIONS,
+    headroom: float = FIT_HEADROOM,
+):
+    """Fit the resource model to the benchmarks, logs and feature files of finished jobs."""
+    config = load_project_config(config_filepath)
+    observations = collect_observations(Path(config['paths']['results_root']), Path(config['paths']['scratch_root']))
+    logger.info(f"{len(observations)} finished jobs: "
+                f"{dict(observations.group_by('source').len().sort('source').iter_rows())}")
+    job_sizes = load_job_input_sizes(manifest_filepath, index_filepath)
+    model = ResourceModel(fit_resource_model(observations, job_sizes, min_observations, headroom), job_sizes)
+    for rule, groups in sorted(model.coefficients.items()):
+        for feature_set, fitted in sorted(groups.items()):
+            logger.info(f"{rule} [{feature_set}]: " + ", ".join(
+                f"{target} = {fitted[target][0]:.0f} + {fitted[target][1]:.0f}/GB (n={fitted[f'n_{target}']})"
+                for target in RESOURCE_TARGETS if target in fitted))
+    model.save(model_filepath)
+    logger.success(f"Resource model written to {model_filepath}")
+
+
+@app.command()
+def show(
+    manifest_filepath: Path = Path("reports/manifest.tsv"),
+    index_filepath: Path = Path("reports") / DISCOVERY_INDEX_FILENAME,
+    model_filepath: Path = Path("reports") / RESOURCE_MODEL_FILENAME,
+    feature_sets: str = "",
+):
+    """Print the predicted first-attempt reservations of the manifest jobs against the old fixed ones."""
+    job_sizes = load_job_input_sizes(manifest_filepath, index_filepath)
+    model = ResourceModel.load(model_filepath, job_sizes)
+    for rule in RULE_INPUT_COLUMNS:
+        groups = [feature_set for feature_set in feature_sets.split(',') if feature_set] \
+            if rule == 'extract_features' and feature_sets else [ALL_FEATURE_SETS]
+        predictions = [model.predict(rule, job_id, feature_set) for job_id in job_sizes for feature_set in groups]
+        if not predictions:
+            continue
+        mem_mb = np.array([prediction['mem_mb'] for prediction in predictions])
+        runtime_min = np.array([prediction['runtime_min'] for prediction in predictions])
+        logger.info(f"{rule}: {len(predictions)} jobs, memory median {np.median(mem_mb) / 1000:.1f} GB, "
+                    f"max {mem_mb.max() / 1000:.1f} GB, total {mem_mb.sum() / 1000:.0f} GB "
+                    f"(fixed: {FALLBACK_RESOURCES[rule]['mem_mb'] * len(predictions) / 1000:.0f} GB); "
+                    f"runtime median {format_slurm_time(np.median(runtime_min))}, "
+                    f"max {format_slurm_time(runtime_min.max())}")
+
+
+if __name__ == "__main__":
+    app()
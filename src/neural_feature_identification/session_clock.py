@@ -0,0 +1,207 @@
+from pathlib import Path
+
+import h5py
+from loguru import logger
+import numpy as np
+import typer
+
+from neural_feature_identification.nsx_utils import (
+    NSX_SAMPLING_RATES,
+    compute_session_nip_offset,
+    read_kdf,
+)
+
+app = typer.Typer()
+
+# Per-job record of how the clocks of a session line up, written once next to kinematics.h5 so later
+# stages never re-read NS2 headers or RecStart files to get the NIP offset.
+# Every stream maps array index i to a NIP (KDF) timestamp. Regular streams (the NSx files) are
+# origin + i * period in 30 kHz NIP ticks and convert arithmetically. Timestamp streams (KDF files,
+# 30 Hz with jitter) keep their timestamps and convert with searchsorted, unless they turn out regular.
+SESSION_CLOCK_FILENAME = "session_clock.h5"
+NIP_RATE_HZ = 30_000
+INDEX_SIDES = ['left', 'right', 'nearest']
+
+
+class SessionClock:
+    """
+    NIP-time <-> array-index conversions for the streams of a session (NS5, NS2, KDF, ...).
+    All conversions are vectorized. Index conventions follow np.searchsorted: side='left' gives the first
+    index at or after a timestamp, side='right' the first index after it.
+    """
+    def __init__(self, nip_offset: float = 0.0):
+        """:param nip_offset: number of NIP samples the NSx files lead the KDF files (compute_nip_offset)"""
+        self.nip_offset = float(nip_offset)
+        self.regular = {}  # name -> (origin, period)
+        self.timestamps = {}  # name -> sorted (N, ) float64 NIP timestamps
+
+    def add_nsx_stream(self, name: str, rate_hz: int):
+        """
+        Adds an NSx file of the recording. Sample i (0-based) of a file sampled at rate_hz is at NIP time
+        (i + 1) * period - nip_offset, i.e. the 1-based index of read_nsx_range ranges is t + nip_offset at 30 kHz.
+        """
+        period = NIP_RATE_HZ / rate_hz
+        self.add_regular_stream(name, period - self.nip_offset, period)
+
+    def add_regular_stream(self, name: str, origin: float, period: float):
+        """Adds a stream whose index i is at NIP time origin + i * period"""
+        if period <= 0:
+            raise ValueError(f"Stream '{name}' needs a positive period, got {period}")
+        self.timestamps.pop(name, None)
+        self.regular[name] = (float(origin), float(period))
+
+    def add_timestamps(self, name: str, nip_time: np.ndarray, rtol: float = 1e-9):
+        """
+        Adds a stream from its timestamps. Evenly spaced timestamps are stored as a regular stream.
+        :param name: stream name, e.g. 'kdf' or 'baseline_kdf'
+        :param nip_time: (N, ) non-decreasing NIP timestamps
+        :param rtol: tolerance on the spacing for the stream to count as regular
+        """
+        nip_time = np.asarray(nip_time, dtype=np.float64).flatten()
+        if len(nip_time) > 1 and np.any(np.diff(nip_time) < 0):
+            raise ValueError(f"Timestamps of stream '{name}' are not sorted")
+        steps = np.diff(nip_time)
+        if len(steps) and steps[0] > 0 and np.allclose(steps, steps[0], rtol=rtol, atol=0):
+            self.add_regular_stream(name, nip_time[0], steps[0])
+            return
+        self.regular.pop(name, None)
+        self.timestamps[name] = nip_time
+
+    @property
+    def streams(self) -> list[str]:
+        return list(self.regular) + list(self.timestamps)
+
+    def _check_stream(self, name: str):
+        if name not in self.regular and name not in self.timestamps:
+            raise ValueError(f"Unknown stream '{name}'. Choose from {self.streams}")
+
+    def to_nip(self, name: str, idxs: np.ndarray) -> np.ndarray:
+        """:return: NIP timestamps of (integer or fractional) indices of a stream"""
+        self._check_stream(name)
+        idxs = np.asarray(idxs)
+        if name in self.regular:
+            origin, period = self.regular[name]
+            return origin + idxs * period
+        return self.timestamps[name][idxs]
+
+    def to_index(self, name: str, nip_time: np.ndarray, side: str = 'left') -> np.ndarray:
+        """
+        Array indices of NIP timestamps in a stream. Times before the stream map to 0; regular streams
+        have no length, so times past their end are not clipped.
+        :param name: stream name
+        :param nip_time: NIP timestamps
+        :param side: 'left' (first index at or after), 'right' (first index after) or 'nearest'
+        :return: int64 indices
+        """
+        self._check_stream(name)
+        if side not in INDEX_SIDES:
+            raise ValueError(f"Unknown side '{side}'. Choose from {INDEX_SIDES}")
+        nip_time = np.asarray(nip_time, dtype=np.float64)
+        if name in self.regular:
+            origin, period = self.regular[name]
+            position = np.maximum((nip_time - origin) / period, -1)
+            if side == 'left':
+                return np.ceil(position).astype(np.int64).clip(0)
+            if side == 'right':
+                return np.floor(position).astype(np.int64) + 1
+            return np.floor(position + 0.5).astype(np.int64).clip(0)
+        timestamps = self.timestamps[name]
+        if side != 'nearest':
+            return np.searchsorted(timestamps, nip_time, side=side).astype(np.int64)
+        after = np.clip(np.searchsorted(timestamps, nip_time, side='left'), 1, max(len(timestamps) - 1, 1))
+        before = after - 1
+        closer_before = np.abs(nip_time - timestamps[before]) <= np.abs(timestamps[after] - nip_time)
+        return np.where(closer_before, before, after).astype(np.int64)
+
+    def convert(self, idxs: np.ndarray, source: str, target: str, side: str = 'left') -> np.ndarray:
+        """:return: indices in `target` of indices in `source`, e.g. KDF frames to NS5 samples"""
+        return self.to_index(target, self.to_nip(source, idxs), side)
+
+    def nsx_range(self, nip_first: float, nip_last: float) -> tuple[float, float]:
+        """:return: inclusive, 1-based 30 kHz range of read_nsx_range covering [nip_first, nip_last]"""
+        return nip_first + self.nip_offset, nip_last + self.nip_offset
+
+    def save(self, filepath: Path):
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        with h5py.File(filepath, 'w') as f:
+            f.attrs['nip_offset'] = self.nip_offset
+            f.attrs['nip_rate_hz'] = NIP_RATE_HZ
+            for name, (origin, period) in self.regular.items():
+                group = f.create_group(f"regular/{name}")
+                group.attrs['origin'], group.attrs['period'] = origin, period
+            for name, nip_time in self.timestamps.items():
+                f.create_dataset(f"timestamps/{name}", data=nip_time)
+
+    @classmethod
+    def load(cls, filepath: Path) -> 'SessionClock':
+        with h5py.File(filepath, 'r') as f:
+            clock = cls(f.attrs['nip_offset'])
+            for name, group in f.get('regular', {}).items():
+                clock.regular[name] = (float(group.attrs['origin']), float(group.attrs['period']))
+            for name, dataset in f.get('timestamps', {}).items():
+                clock.timestamps[name] = dataset[()]
+        return clock
+
+
+def build_session_clock(
+        session_path: Path,
+        full_stream_filename: str,
+        kdf_nip_time: np.ndarray | None = None,
+        baseline_filename: str | None = None
+) -> SessionClock:
+    """
+    Computes the NIP offset of a session (the only step that reads the NS2 header) and registers its streams.
+    :param session_path: session directory
+    :param full_stream_filename: NS5 filename
+    :param kdf_nip_time: optional KDF timestamps of the training data, registered as 'kdf'
+    :param baseline_filename: optional baseline KDF filename, registered as 'baseline_kdf'
+    :return: SessionClock with the 'ns5' and 'ns2' streams
+    """
+    clock = SessionClock(compute_session_nip_offset(session_path, full_stream_filename))
+    for suffix in ['.ns5', '.ns2']:
+        clock.add_nsx_stream(suffix[1:], NSX_SAMPLING_RATES[suffix])
+    if kdf_nip_time is not None:
+        clock.add_timestamps('kdf', kdf_nip_time)
+    if baseline_filename is not None:
+        clock.add_timestamps('baseline_kdf', read_kdf(session_path / baseline_filename)['nip_time'])
+    return clock
+
+
+def session_nip_offset(session_path: Path, full_stream_filename: str, clock_filepath: Path | None = None) -> float:
+    """:return: NIP offset from a saved SessionClock if given, otherwise from the session's NS2 file"""
+    if clock_filepath is not None:
+        return SessionClock.load(clock_filepath).nip_offset
+    return compute_session_nip_offset(session_path, full_stream_filename)
+
+
+@app.command()
+def build(
+    data_root: Path,
+    session_dir: str,
+    full_stream_filename: str,
+    baseline_filename: str,
+    kinematics_filepath: Path,
+    output_filepath: Path,
+):
+    """Compute the NIP offset and stream clocks of a session once and save them as session_clock.h5."""
+    with h5py.File(kinematics_filepath, 'r') as f:
+        kdf_nip_time = f['nip_time'][()].flatten()
+    clock = build_session_clock(data_root / session_dir, full_stream_filename, kdf_nip_time, baseline_filename)
+    clock.save(output_filepath)
+    logger.success(f"Session clock (NIP offset {clock.nip_offset:g}, streams {clock.streams}) "
+                   f"written to {output_filepath}")
+
+
+@app.command()
+def info(clock_filepath: Path):
+    """Print the NIP offset and the streams of a session_clock.h5 file."""
+    clock = SessionClock.load(clock_filepath)
+    logger.info(f"NIP offset: {clock.nip_offset:g}")
+    for name, (origin, period) in clock.regular.items():
+        logger.info(f"{name}: index i at NIP time {origin:g} + i * {period:g}")
+    for name, nip_time in clock.timestamps.items():
+        logger.info(f"{name}: {len(nip_time)} irregular timestamps from {nip_time[0]:g} to {nip_time[-1]:g}")
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,212 @@
+from pathlib import Path
+import time
+
+import h5py
+from loguru import logger
+import numpy as np
+import typer
+
+from neural_feature_identification.dataset_utils import load_project_config
+from neural_feature_identification.features import (
+    CHANNEL_BLOCK_SIZE,
+    FS_NS5,
+    LOOP_TIME_SECONDS,
+    NFR_KERNEL_WIDTH_SECONDS,
+    binned_firing_rates,
+    compute_loop_frames,
+    frame_crossings,
+    load_session_raw_data,
+    spike_highpass,
+    write_feature_file,
+)
+
+app = typer.Typer()
+
+# Threshold-crossing samples of the high-passed 30 kHz streams, stored per channel in CSR layout:
+# /<stream>/indptr (C+1), /<stream>/sample_idxs and /<stream>/amplitudes, with 'neural' and 'baseline' streams.
+# Every sample beyond the detection threshold is kept, so NFR at any stricter threshold is re-detected
+# exactly (same crossings, same refractory rule) without touching the raw data.
+SPIKE_STORE_FILENAME = "spikes.h5"
+DEFAULT_DETECTION_THRESHOLD_STD = -3.0
+
+
+def detect_threshold_crossings(
+        filtered: np.ndarray,
+        abs_thresholds: np.ndarray,
+        block_size: int = CHANNEL_BLOCK_SIZE
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Samples whose magnitude reaches the threshold of their channel, in CSR layout.
+    :param filtered: (T x C) high-passed data
+    :param abs_thresholds: (C, ) non-negative thresholds. Channels with a zero threshold store nothing
+    :param block_size: number of channels thresholded at once
+    :return: tuple of (C+1, ) indptr, sample indices and amplitudes. Channel c owns entries indptr[c]:indptr[c+1]
+    """
+    abs_thresholds = np.where(abs_thresholds > 0, abs_thresholds, np.inf)
+    sample_dtype = np.int32 if len(filtered) < np.iinfo(np.int32).max else np.int64
+    counts, sample_list, amplitude_list = [], [], []
+    for chan_start in range(0, filtered.shape[1], block_size):
+        chans = slice(chan_start, chan_start + block_size)
+        block = filtered[:, chans].T
+        block_chans, block_samples = np.nonzero(np.abs(block) >= abs_thresholds[chans, None])
+        counts.append(np.bincount(block_chans, minlength=len(block)))
+        sample_list.append(block_samples.astype(sample_dtype))
+        amplitude_list.append(block[block_chans, block_samples].astype(np.float32))
+    indptr = np.concatenate([[0], np.cumsum(np.concatenate(counts))]).astype(np.int64)
+    return indptr, np.concatenate(sample_list), np.concatenate(amplitude_list)
+
+
+def build_spike_stream(
+        filtered: np.ndarray,
+        noise_std: np.ndarray,
+        nip_time: np.ndarray,
+        detection_threshold_std: float = DEFAULT_DETECTION_THRESHOLD_STD
+) -> dict:
+    """
+    Spike store entry of one recording.
+    :param filtered: (T x C) high-passed data, as given to detect_spikes
+    :param noise_std: (C, ) std that NFR thresholds are multiples of (filtered std for the training data,
+           raw std for the baseline, as in compute_nfr_features)
+    :param nip_time: (N, ) KDF NIP timestamps of the recording
+    :param detection_threshold_std: most lenient threshold multiple that can be re-binned later
+    :return: dict with indptr, sample_idxs, amplitudes, noise_std, nip_time, n_samples and detection_threshold_std
+    """
+    noise_std = np.asarray(noise_std, dtype=np.float64)
+    indptr, sample_idxs, amplitudes = detect_threshold_crossings(
+        filtered, np.abs(noise_std * detection_threshold_std))
+    return {'indptr': indptr, 'sample_idxs': sample_idxs, 'amplitudes': amplitudes, 'noise_std': noise_std,
+            'nip_time': np.asarray(nip_time, dtype=np.float64).flatten(), 'n_samples': len(filtered),
+            'detection_threshold_std': abs(detection_threshold_std)}
+
+
+def write_spike_store(filepath: Path, streams: dict):
+    """
+    :param filepath: destination, usually spikes.h5 next to the session's kinematics.h5
+    :param streams: dict of stream name -> build_spike_stream output
+    """
+    filepath.parent.mkdir(parents=True, exist_ok=True)
+    with h5py.File(filepath, 'w') as f:
+        for name, stream in streams.items():
+            group = f.create_group(name)
+            for key in ['indptr', 'sample_idxs', 'amplitudes', 'noise_std', 'nip_time']:
+                # Empty datasets cannot be chunked
+                options = {'compression': 'gzip', 'shuffle': True} if len(stream[key]) else {}
+                group.create_dataset(key, data=stream[key], **options)
+            group.attrs['n_samples'] = stream['n_samples']
+            group.attrs['detection_threshold_std'] = stream['detection_threshold_std']
+    n_entries = sum(len(stream['sample_idxs']) for stream in streams.values())
+    logger.info(f"Spike store with {n_entries} crossings written to {filepath}")
+
+
+def read_spike_store(filepath: Path) -> dict:
+    """:return: dict of stream name -> dict with the keys of build_spike_stream"""
+    with h5py.File(filepath, 'r') as f:
+        return {name: {**{key: val[()] for key, val in group.items()}, **dict(group.attrs)}
+                for name, group in f.items()}
+
+
+def spike_stream_rates(
+        stream: dict,
+        threshold_std: float,
+        bin_width_sec: float | None = None,
+        kernel_width_sec: float = NFR_KERNEL_WIDTH_SECONDS
+) -> np.ndarray:
+    """
+    Smoothed firing rates re-detected from a spike store entry.
+    :param stream: build_spike_stream output
+    :param threshold_std: threshold multiple of noise_std. Its magnitude must be at least detection_threshold_std
+    :param bin_width_sec: uniform bin width. None bins by the 30 Hz loop frames of the KDF timestamps, as offline
+    :param kernel_width_sec: trailing smoothing kernel
+    :return: (n_bins x C) smoothed rates. n_bins is N-1 for loop frames
+    """
+    if abs(threshold_std) < stream['detection_threshold_std']:
+        raise ValueError(f"Threshold {threshold_std} std is more lenient than the stored "
+                         f"{stream['detection_threshold_std']} std detection threshold")
+    thresholds = stream['noise_std'] * threshold_std
+    n_chans = len(thresholds)
+    channels = np.repeat(np.arange(n_chans), np.diff(stream['indptr']))
+    amplitudes, thresholds_per_entry = stream['amplitudes'], thresholds[channels]
+    kept = np.where(thresholds_per_entry < 0, amplitudes <= thresholds_per_entry, amplitudes >= thresholds_per_entry)
+    kept &= thresholds_per_entry != 0
+    channels, samples = channels[kept], stream['sample_idxs'][kept].astype(np.int64)
+
+    if bin_width_sec is None:
+        starts, stops = compute_loop_frames(stream['nip_time'], int(stream['n_samples']))
+        bin_width_sec = LOOP_TIME_SECONDS
+    else:
+        bin_samples = round(bin_width_sec * FS_NS5)
+        starts = np.arange(0, int(stream['n_samples']) - bin_samples + 1, bin_samples)
+        stops = starts + bin_samples
+    channels, frames = frame_crossings(channels, samples, starts, stops)
+    return binned_firing_rates(channels, frames, len(starts), n_chans, bin_width_sec, kernel_width_sec)
+
+
+def compute_nfr_from_spike_store(
+        store: dict,
+        threshold_std: float,
+        bin_width_sec: float | None = None,
+        kernel_width_sec: float = NFR_KERNEL_WIDTH_SECONDS
+) -> np.ndarray:
+    """
+    NFR features from a spike store, without the raw data. With bin_width_sec None this equals compute_nfr_features.
+    :param store: read_spike_store output with 'neural' and 'baseline' streams
+    :return: (N x C) features for loop frames (last row zero, as offline), (n_bins x C) for uniform bins
+    """
+    rates = spike_stream_rates(store['neural'], threshold_std, bin_width_sec, kernel_width_sec)
+    baseline = spike_stream_rates(store['baseline'], threshold_std, bin_width_sec, kernel_width_sec).mean(axis=0)
+    if bin_width_sec is not None:
+        return rates - baseline
+    features = np.zeros((len(store['neural']['nip_time']), rates.shape[1]))
+    features[:len(rates)] = rates - baseline
+    return features
+
+
+@app.command()
+def detect(
+    data_root: Path,
+    session_dir: str,
+    full_stream_filename: str,
+    baseline_filename: str,
+    kinematics_filepath: Path,
+    output_filepath: Path,
+    detection_threshold_std: float = DEFAULT_DETECTION_THRESHOLD_STD,
+    session_clock_filepath: Path | None = None,
+):
+    """Detect threshold crossings of a session's training and baseline data and write the spike store."""
+    timer = time.perf_counter()
+    neural_data, kdf_nip_time, baseline_data, baseline_nip_time = load_session_raw_data(
+        data_root, session_dir, full_stream_filename, baseline_filename, kinematics_filepath,
+        session_clock_filepath=session_clock_filepath)
+    neural_filtered = spike_highpass(neural_data)
+    del neural_data
+    neural = build_spike_stream(neural_filtered, np.std(neural_filtered, axis=0, ddof=1, dtype=np.float64),
+                                kdf_nip_time, detection_threshold_std)
+    del neural_filtered
+    # The MATLAB baseline threshold is computed on the baseline before it is filtered
+    baseline_std = np.std(baseline_data, axis=0, ddof=1, dtype=np.float64)
+    baseline = build_spike_stream(
+        spike_highpass(baseline_data), baseline_std, baseline_nip_time, detection_threshold_std)
+    write_spike_store(output_filepath, {'neural': neural, 'baseline': baseline})
+    logger.success(f"Spike detection finished in {time.perf_counter() - timer:0.1f} sec")
+
+
+@app.command()
+def rebin(
+    spike_store_filepath: Path,
+    output_filepath: Path,
+    config_filepath: Path = Path("config.yaml"),
+    threshold_std: float | None = None,
+    bin_width_sec: float | None = None,
+):
+    """Write NFR features from a spike store. Defaults to the nfr.spike_threshold_std of the config."""
+    timer = time.perf_counter()
+    if threshold_std is None:
+        config = load_project_config(config_filepath)
+        threshold_std = config.get('feature_extraction_params', config)['nfr']['spike_threshold_std']
+    features = compute_nfr_from_spike_store(read_spike_store(spike_store_filepath), threshold_std, bin_width_sec)
+    write_feature_file(output_filepath, features, np.zeros(len(features)))
+    logger.success(f"NFR re-binned at {threshold_std} std in {time.perf_counter() - timer:0.1f} sec")
+
+
+if __name__ == "__main__":
+    app()
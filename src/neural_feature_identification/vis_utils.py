@@ -1,86 +1,84 @@
+import random
+
 import altair as alt
 import numpy as np
 import polars as pl
 
-def make_tidy_norm(session_data: dict, project_config: dict) -> pl.DataFrame:
+DWT_SUBSAMPLE_SEED = 42
+
+def _select_vis_channels(name: str, n_channels: int, project_config: dict, subsample_dwt: bool) -> np.ndarray:
+    """Channels of a feature set to plot. DWT sets are randomly subsampled to vis.dwt_subsample_count channels"""
+    subsample_count = project_config['vis']['dwt_subsample_count']
+    if subsample_dwt and name.upper().startswith('DWT') and n_channels > subsample_count:
+        return np.sort(random.Random(DWT_SUBSAMPLE_SEED).sample(range(n_channels), subsample_count))
+    return np.arange(n_channels)
+
+def _bin_means(data: np.ndarray, sort_order: np.ndarray | None, bin_starts: np.ndarray, bin_counts: np.ndarray,
+               channels: np.ndarray) -> np.ndarray:
+    """(bins x channels) mean of the selected channels of an (N x C) array over consecutive bins"""
+    selected = np.asarray(data[:, channels], dtype=np.float64)
+    if sort_order is not None:
+        selected = selected[sort_order]
+    return np.add.reduceat(selected, bin_starts, axis=0) / bin_counts[:, None]
+
+def make_tidy_norm(session_data: dict, project_config: dict, subsample_dwt: bool = True) -> pl.DataFrame:
     """
     Structures the data into a tidy, long-format DataFrame for VIS with Altair.
     Transforms the data for VIS by downsampling and applying a normalization transformation to each channel.
     Assumes kinematics, nip_time and features are in (NxM) format where N is the number of samples.
+    Binning and normalization run on the arrays, so only the binned points are ever put in a DataFrame.
     :param project_config:
     :param session_data:
+    :param subsample_dwt: keep only vis.dwt_subsample_count random channels of DWT feature sets
     :return:
     """
-    # Create initial nested DataFrame
-    df_constructor = {
-        'timestamps': session_data['kinematics']['nip_time'],
-        'kinematics': session_data['kinematics']['kinematics'],
-    }
+    arrays = {'kinematics': session_data['kinematics']['kinematics']}
     feature_names = project_config['analysis']['feature_sets']
     for name in feature_names:
         key_name = name.lower()
         if 'features' in session_data.get(key_name, {}):
-            df_constructor[name] = session_data[key_name]['features']
-    nested_df = pl.DataFrame(df_constructor)
-
-    # Flatten timestamp column
-    flat_df = nested_df.explode('timestamps')
-
-    # Dynamically create expression to unnest each array column into individual columns
-    unnested_expressions = []
-    for name in ['kinematics'] + feature_names:
-        col_name = name if name != 'kinematics' else 'kinematics'
-        if col_name in flat_df.columns:
-            list_len = flat_df.select(pl.col(col_name).arr.len().first()).item()
-            if list_len is not None:
-                unnested_expressions.extend(
-                    [pl.col(col_name).arr.get(i).alias(f"{name}_{i+1}") for i in range(list_len)]
-                )
-
-    # Build the wide DataFrame by applying the unnesting expressions
-    wide_df = flat_df.select(
-        pl.col('timestamps'),
-        *unnested_expressions
-    )
+            arrays[name] = session_data[key_name]['features']
+    timestamps = np.asarray(session_data['kinematics']['nip_time'], dtype=np.float64).flatten()
 
     # Aggregate/downsample data to prevent browser memory issues
-    print(f"Original data has {len(wide_df)} timestamps")
+    print(f"Original data has {len(timestamps)} timestamps")
     plt_point_count = project_config['vis']['num_of_x_points']
-    time_range = wide_df['timestamps'].max() - wide_df['timestamps'].min()
+    time_range = timestamps.max() - timestamps.min()
     resampling_interval = time_range / plt_point_count
-    if resampling_interval < 1: resampling_interval = 1
+    resampling_interval = max(resampling_interval, 1)
     print(f"Resampling data by averaging over {resampling_interval:0.2f} timestamp units")
-    wide_df_resampled = wide_df.group_by(
-        (pl.col("timestamps") // resampling_interval).alias("time_bin")
-    ).agg(pl.all().mean()).drop("time_bin")
-    print(f"Resampled data has {len(wide_df_resampled)} timestamps")
-
-    # Melt (wide2long/unpivot transform) the wide DataFrame into a long, tidy format
-    tidy_df = wide_df_resampled.unpivot(index=['timestamps'], variable_name='feature_id', value_name='value')
-
-    # Add a column for easy filtering ('feature_type': 'kinematics', 'nfr', ...)
-    tidy_df = tidy_df.with_columns(
-        pl.col('feature_id').str.split_exact(by='_', n=1).struct.field('field_0').alias('feature_type')
-    )
-
-    # Channel by channel normalization to improve heatmap visibility
-    kinematics_df  = tidy_df.filter(pl.col('feature_type') == 'kinematics')
-    features_df = tidy_df.filter(pl.col('feature_type') != 'kinematics')
-    features_df_normalized = features_df.with_columns(
-        min_val=pl.min('value').over('feature_id'),
-        max_val=pl.max('value').over('feature_id')
-    ).with_columns(
-        range_val=(pl.col('max_val') - pl.col('min_val'))
-    ).with_columns(
-        norm_val=pl.when(pl.col('range_val')>0)
-                 .then((pl.col('value') - pl.col('min_val')) / pl.col('range_val'))
-                 .otherwise(0.0)
-    ).with_columns(
-        value=(pl.col('norm_val') * pl.col('max_val').sqrt()).fill_nan(0)
-    ).drop('min_val', 'max_val', 'range_val', 'norm_val')
-    tidy_df_transformed = pl.concat([kinematics_df, features_df_normalized])
-
-    return tidy_df_transformed
+    time_bins = timestamps // resampling_interval
+    sort_order = None
+    if np.any(np.diff(time_bins) < 0):
+        sort_order = np.argsort(time_bins, kind='stable')
+        time_bins = time_bins[sort_order]
+    bin_starts = np.concatenate([[0], np.flatnonzero(np.diff(time_bins)) + 1])
+    bin_counts = np.diff(np.append(bin_starts, len(time_bins)))
+    binned_timestamps = np.add.reduceat(
+        timestamps if sort_order is None else timestamps[sort_order], bin_starts) / bin_counts
+    print(f"Resampled data has {len(binned_timestamps)} timestamps")
+
+    # Build the long, tidy format directly from the binned (bins x channels) arrays
+    tidy_frames = []
+    for name, data in arrays.items():
+        channels = _select_vis_channels(name, data.shape[1], project_config, subsample_dwt)
+        values = _bin_means(data, sort_order, bin_starts, bin_counts, channels)
+        if name != 'kinematics':
+            # Channel by channel normalization to improve heatmap visibility
+            with np.errstate(invalid='ignore', divide='ignore'):
+                min_val, max_val = np.nanmin(values, axis=0), np.nanmax(values, axis=0)
+                range_val = max_val - min_val
+                norm_val = np.where(range_val > 0, (values - min_val) / range_val, 0.0)
+                values = norm_val * np.sqrt(max_val)
+            # Only NaN become 0, as fill_nan(0) did in the polars version
+            values = np.where(np.isnan(values), 0.0, values)
+        tidy_frames.append(pl.DataFrame({
+            'timestamps': np.tile(binned_timestamps, len(channels)),
+            'feature_id': np.repeat([f"{name}_{i + 1}" for i in channels], len(binned_timestamps)),
+            'value': values.T.ravel(),
+            'feature_type': name,
+        }))
+    return pl.concat(tidy_frames)
 
 
 def make_kinematics_line_plot(plt_df: pl.DataFrame, project_config: dict, x_domain: list) -> alt.Chart():
@@ -124,9 +122,9 @@ def make_events_raster_plot(trial_start_stamps: np.ndarray, trial_stop_stamps: n
     )
     return plt_event_markers
 
-def make_features_heatmap(plt_df: pl.DataFrame, feature_type: str, color_scheme: str, selected_chans: list[str] = None) -> alt.Chart:
+def make_features_heatmap(plt_df: pl.DataFrame, feature_type: str, color_scheme: str, selected_chans: list[str] | None = None) -> alt.Chart:
     """
-
+    Create a heatmap of a feature set with one row per channel
     """
     feature_data = plt_df.filter(pl.col('feature_type') == feature_type)
 
@@ -143,7 +141,7 @@ def make_features_heatmap(plt_df: pl.DataFrame, feature_type: str, color_scheme:
         height=720
     )
 
-def make_features_line_plot(plt_df: pl.DataFrame, feature_type: str, selected_channels: list[str] = None, x_domain: list = None) -> alt.Chart:
+def make_features_line_plot(plt_df: pl.DataFrame, feature_type: str, selected_channels: list[str] | None = None, x_domain: list | None = None) -> alt.Chart:
     """
     Create a line chart for a given feature set with superimposed, transparent channels
     :param plt_df:
@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+
+
+def _make_session(seed: int = 2025, n_chans: int = 6, n_frames: int = 60, n_baseline_frames: int = 40) -> tuple:
+    """
+    Synthetic session: white-noise 30 kHz training and baseline data with jittered ~30 Hz KDF timestamps.
+    :return: (neural_data, kdf_nip_time, baseline_data, baseline_nip_time), as load_session_raw_data
+    """
+    rng = np.random.default_rng(seed)
+    kdf_nip_time = np.cumsum(rng.integers(985, 1015, size=n_frames)).astype(np.float64) + 0.4
+    n_samples = int(np.ceil(kdf_nip_time[-1] - kdf_nip_time[0])) + 1
+    neural_data = rng.standard_normal((n_samples, n_chans)).astype(np.float32)
+    baseline_nip_time = np.cumsum(rng.integers(985, 1015, size=n_baseline_frames)).astype(np.float64)
+    n_baseline = int(np.ceil(baseline_nip_time[-1] - baseline_nip_time[0])) + 1
+    baseline_data = rng.standard_normal((n_baseline, n_chans)).astype(np.float32)
+    return neural_data, kdf_nip_time, baseline_data, baseline_nip_time
+
+
+@pytest.fixture
+def make_session():
+    """Factory of synthetic sessions with a given seed and size (see _make_session)"""
+    return _make_session
+
+
+@pytest.fixture
+def session(make_session):
+    return make_session()
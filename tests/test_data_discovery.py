@@ -0,0 +1,64 @@
+import os
+
+import polars as pl
+
+from neural_feature_identification import data_discovery
+
+
+def _make_session(dirpath, filenames):
+    dirpath.mkdir(parents=True)
+    for filename in filenames:
+        (dirpath / filename).write_bytes(b"x" * len(filename))
+
+
+def test_discovery_is_cached_and_incremental(tmp_path):
+    data_root = tmp_path / "data"
+    _make_session(data_root / "P1" / "20150930-143221",
+                  ["Data_01.ns5", "Data_01.ns2", "Training.kdf", "Training.kef", "Baseline.kdf",
+                   "RecStart_20150930-143221.mat", "notes.txt"])
+    _make_session(data_root / "P2" / "20160101-101010", ["Training.kdf"])
+    session_dirs = ["P1/20150930-143221", "P2/20160101-101010", "P3/missing"]
+    index_filepath = tmp_path / "reports" / data_discovery.DISCOVERY_INDEX_FILENAME
+
+    index = data_discovery.discover_sessions(data_root, session_dirs, index_filepath, max_workers=4)
+    assert data_discovery.session_files(index, 'ns5') == {"P1/20150930-143221": ["Data_01.ns5"]}
+    assert sorted(index.filter(pl.col('session_dir') == session_dirs[0])['kind'].to_list()) == \
+        ['kdf', 'kdf', 'kef', 'ns2', 'ns5', 'recstart']
+    assert data_discovery.file_sizes(index)[("P2/20160101-101010", "Training.kdf")] == len("Training.kdf")
+    assert index.filter(pl.col('session_dir') == "P3/missing")['dir_mtime_ns'].to_list() == [-1]
+
+    manifest = pl.DataFrame({'job_id': [1, 2], 'session_dir': session_dirs[:2],
+                             'training_filename': ["Training.kdf"] * 2, 'baseline_filename': ["Baseline.kdf"] * 2,
+                             'full_stream_filename': ["Data_01.ns5", None]})
+    assert data_discovery.missing_manifest_files(manifest, index) == {
+        2: ["Baseline.kdf", "<full_stream_filename>"]}
+
+    # Unchanged directories keep their cached rows, changed ones are listed again
+    cached = pl.read_parquet(index_filepath).with_columns(
+        size=pl.when(pl.col('filename') == "Data_01.ns5").then(-5).otherwise(pl.col('size')))
+    cached.write_parquet(index_filepath)
+    (data_root / session_dirs[1] / "Data_02.ns5").write_bytes(b"")
+    os.utime(data_root / session_dirs[1], ns=(0, 10 ** 18))
+    index = data_discovery.discover_sessions(data_root, session_dirs, index_filepath)
+    assert data_discovery.file_sizes(index)[(session_dirs[0], "Data_01.ns5")] == -5
+    assert data_discovery.session_files(index, 'ns5')[session_dirs[1]] == ["Data_02.ns5"]
+    full = data_discovery.discover_sessions(data_root, session_dirs, index_filepath, full=True)
+    assert data_discovery.file_sizes(full)[(session_dirs[0], "Data_01.ns5")] == len("Data_01.ns5")
+
+
+def test_check_manifest_inputs_can_read_the_cache_only(tmp_path):
+    data_root = tmp_path / "data"
+    _make_session(data_root / "P1" / "s1", ["Training.kdf"])
+    manifest_filepath = tmp_path / "manifest.tsv"
+    pl.DataFrame({'job_id': [1, 2], 'session_dir': ["P1/s1", "P2/s2"],
+                  'training_filename': ["Training.kdf"] * 2}).write_csv(manifest_filepath, separator='\t')
+    index_filepath = tmp_path / "reports" / data_discovery.DISCOVERY_INDEX_FILENAME
+
+    # Without a cache nothing is known to be missing; a refresh lists the directories and writes the cache
+    assert data_discovery.check_manifest_inputs(data_root, manifest_filepath, index_filepath, refresh=False) == {}
+    assert not index_filepath.exists()
+    missing = data_discovery.check_manifest_inputs(data_root, manifest_filepath, index_filepath)
+    assert missing == {2: ["Training.kdf"]}
+    assert [p.name for p in index_filepath.parent.iterdir()] == [index_filepath.name]
+    _make_session(data_root / "P2" / "s2", ["Training.kdf"])
+    assert data_discovery.check_manifest_inputs(data_root, manifest_filepath, index_filepath, refresh=False) == missing
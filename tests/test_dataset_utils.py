@@ -0,0 +1,179 @@
+import os
+
+import h5py
+import numpy as np
+import pytest
+
+from neural_feature_identification import dataset_utils
+
+
+@pytest.fixture
+def session_dir(tmp_path):
+    rng = np.random.default_rng(3)
+    (tmp_path / "features").mkdir()
+    with h5py.File(tmp_path / "kinematics.h5", 'w') as f:
+        f['kinematics'] = rng.standard_normal((12, 400))
+        f['nip_time'] = np.arange(400, dtype=np.float64).reshape(1, -1) * 1000
+    with h5py.File(tmp_path / "events.h5", 'w') as f:
+        f['trial_start_idxs'] = np.array([[1000.0, 150000.0]])
+        f['trial_stop_idxs'] = np.array([[90000.0, 250000.0]])
+    with h5py.File(tmp_path / "features" / "NFR.h5", 'w') as f:
+        f['features'] = rng.standard_normal((8, 400))
+    with h5py.File(tmp_path / "features" / "MAV.h5", 'w') as f:
+        f.create_dataset('features', data=rng.standard_normal((8, 400)), chunks=(8, 64), compression='gzip')
+    return tmp_path
+
+
+def test_parallel_and_lazy_loading_match_serial(session_dir):
+    config = {'analysis': {'feature_sets': ['NFR', 'MAV']}}
+    serial = dataset_utils.load_session_data(session_dir, config)
+    parallel = dataset_utils.load_session_data(session_dir, config, max_workers=4)
+    lazy = dataset_utils.load_session_data(session_dir, config, max_workers=4, lazy=True)
+    assert list(parallel) == list(serial)
+    for file_name, datasets in serial.items():
+        for key, data in datasets.items():
+            np.testing.assert_array_equal(parallel[file_name][key], data)
+            np.testing.assert_array_equal(np.asarray(lazy[file_name][key]), data)
+    assert isinstance(lazy['nfr']['features'], np.memmap)
+    assert isinstance(lazy['mav']['features'], dataset_utils.LazyDataset)
+
+
+def test_lazy_dataset_indexing(session_dir):
+    filepath = session_dir / "features" / "MAV.h5"
+    expected = dataset_utils.read_hdf_dataset(filepath, ['features'])['features'].T
+    lazy = dataset_utils.read_hdf_dataset(filepath, ['features'], lazy=True)['features'].T
+    assert lazy.shape == expected.shape
+    idxs = np.concatenate([np.arange(10, 50), np.arange(120, 300), [5]])
+    np.testing.assert_array_equal(lazy[idxs], expected[idxs])
+    np.testing.assert_array_equal(lazy[idxs, 2:5], expected[idxs, 2:5])
+    np.testing.assert_array_equal(lazy[7], expected[7])
+    np.testing.assert_array_equal(lazy[:, 3], expected[:, 3])
+
+
+def test_load_cohort_data(tmp_path):
+    rng = np.random.default_rng(4)
+    lengths = {3: 50, 7: 80}
+    for job_id, n_samples in lengths.items():
+        (tmp_path / str(job_id) / "features").mkdir(parents=True)
+        with h5py.File(tmp_path / str(job_id) / "kinematics.h5", 'w') as f:
+            f['kinematics'] = np.full((12, n_samples), job_id, dtype=np.float64)
+            f['nip_time'] = np.arange(n_samples, dtype=np.float64).reshape(1, -1)
+        with h5py.File(tmp_path / str(job_id) / "events.h5", 'w') as f:
+            f['trial_start_idxs'] = np.array([[1.0, 20.0]])
+            f['trial_stop_idxs'] = np.array([[10.0, 30.0]])
+        with h5py.File(tmp_path / str(job_id) / "features" / "NFR.h5", 'w') as f:
+            f['features'] = rng.standard_normal((8, n_samples))
+    manifest_filepath = tmp_path / "manifest.tsv"
+    manifest_filepath.write_text("job_id\tparticipant_id\n3\tP1\n5\tP1\n7\tP2\n")
+
+    cohort = dataset_utils.load_cohort_data(manifest_filepath, tmp_path, ['NFR'], max_workers=2)
+    np.testing.assert_array_equal(cohort['job_ids'], [3, 7])
+    np.testing.assert_array_equal(cohort['offsets'], [0, 50, 130])
+    assert cohort['features']['NFR'].shape == (130, 8)
+    np.testing.assert_array_equal(cohort['kinematics'][cohort['session_idxs'] == 1], 7)
+    with h5py.File(tmp_path / "7" / "features" / "NFR.h5", 'r') as f:
+        np.testing.assert_allclose(cohort['features']['NFR'][50:], f['features'][:].T, rtol=1e-6)
+    np.testing.assert_array_equal(cohort['trial_offsets'], [0, 2, 4])
+
+    # A session that fails to load after the shape pass is dropped, one with another width is rejected
+    (tmp_path / "3" / "events.h5").unlink()
+    cohort = dataset_utils.load_cohort_data(manifest_filepath, tmp_path, ['NFR'], max_workers=1)
+    np.testing.assert_array_equal(cohort['job_ids'], [7])
+    np.testing.assert_array_equal(cohort['offsets'], [0, 80])
+    np.testing.assert_array_equal(cohort['session_idxs'], np.zeros(80))
+    np.testing.assert_array_equal(cohort['kinematics'], 7)
+    np.testing.assert_array_equal(cohort['trial_offsets'], [0, 2])
+    with h5py.File(tmp_path / "3" / "features" / "NFR.h5", 'w') as f:
+        f['features'] = rng.standard_normal((6, 50))
+    with pytest.raises(ValueError, match="different NFR widths"):
+        dataset_utils.load_cohort_data(manifest_filepath, tmp_path, ['NFR'])
+
+
+def _classify_trials_loop(kinematics, starts, stops, threshold):
+    """Per-trial classification loop that generate_train_test_split originally used"""
+    gesture_ids = []
+    for start, stop in zip(starts, stops):
+        if not start < stop < len(kinematics):
+            continue
+        trial_kinematics = kinematics[start:stop, :]
+        active_dofs = np.where(np.max(np.abs(trial_kinematics), axis=0) > threshold)[0]
+        dof_details = []
+        for dof in active_dofs:
+            peak_value = trial_kinematics[np.argmax(np.abs(trial_kinematics[:, dof])), dof]
+            dof_details.append(f"dof_{dof + 1}_{'pos' if peak_value > 0 else 'neg'}")
+        if len(dof_details) == 1:
+            gesture_ids.append(dof_details[0])
+        elif len(dof_details) > 1:
+            gesture_ids.append(f"combo_{'-'.join(sorted(dof_details))}")
+    return gesture_ids
+
+
+@pytest.mark.parametrize('training_type', ['train_first', 'train_last', 'train_random'])
+def test_generate_train_test_split_matches_loop(training_type):
+    rng = np.random.default_rng(11)
+    n_samples, n_dofs = 6000, 12
+    kinematics = np.zeros((n_samples, n_dofs))
+    trial_starts = np.arange(20, n_samples - 100, 120)
+    for start in trial_starts:
+        dofs = rng.choice(n_dofs, size=rng.integers(1, 3), replace=False)
+        kinematics[start + 10:start + 70, dofs] = rng.choice([-1.0, 1.0], size=len(dofs)) * rng.uniform(0.2, 1, len(dofs))
+    kinematics[trial_starts[3] + 20:trial_starts[3] + 40, 0] = 0.5  # plateau tie on argmax
+    kinematics[trial_starts[3] + 50, 0] = -0.5
+    timestamps = np.arange(n_samples, dtype=np.float64) * 1000
+    # Overlapping, inverted and out-of-range markers are all part of the input contract
+    starts = np.append(trial_starts, [trial_starts[5] + 30, 4000, n_samples - 50]) * 1000.0
+    stops = np.append(trial_starts + 90, [trial_starts[5] + 150, 3900, n_samples + 10]) * 1000.0
+
+    train_idxs, test_idxs, train_info, test_info = dataset_utils.generate_train_test_split(
+        kinematics, timestamps, starts, stops, training_type=training_type, include_combined=True)
+
+    start_idxs, stop_idxs = np.searchsorted(timestamps, starts), np.searchsorted(timestamps, stops)
+    expected_ids = _classify_trials_loop(kinematics, start_idxs, stop_idxs, 0.1)
+    info = sorted(train_info + test_info, key=lambda t: t['start_idx'])
+    expected_ids = [g for g in expected_ids if expected_ids.count(g) >= 2]  # singleton gestures are dropped
+    assert sorted(t['gesture_id'] for t in info) == sorted(expected_ids)
+    np.testing.assert_array_equal(
+        train_idxs, np.concatenate([np.arange(t['start_idx'], t['stop_idx']) for t in train_info]))
+    np.testing.assert_array_equal(
+        test_idxs, np.concatenate([np.arange(t['start_idx'], t['stop_idx']) for t in test_info]))
+    assert train_idxs.dtype == np.int64
+
+
+def test_load_train_test_split_cache(tmp_path, monkeypatch):
+    rng = np.random.default_rng(5)
+    kinematics = np.zeros((12, 3000))
+    starts = np.arange(10, 2900, 100)
+    for i, start in enumerate(starts):
+        kinematics[i % 3, start + 10:start + 60] = rng.choice([-1, 1]) * 0.8
+    timestamps = np.arange(3000, dtype=np.float64) * 1000
+    with h5py.File(tmp_path / "kinematics.h5", 'w') as f:
+        f['kinematics'], f['nip_time'] = kinematics, timestamps.reshape(1, -1)
+    with h5py.File(tmp_path / "events.h5", 'w') as f:
+        f['trial_start_idxs'], f['trial_stop_idxs'] = timestamps[starts][None], timestamps[starts + 80][None]
+
+    expected = dataset_utils.load_train_test_split(tmp_path, training_type='train_random', use_cache=False)
+    dataset_utils._get_split_plan.cache_clear()
+    first = dataset_utils.load_train_test_split(tmp_path, training_type='train_random')
+    assert len(list((tmp_path / dataset_utils.SPLIT_PLAN_DIRNAME).glob("*.h5"))) == 1
+
+    # Memory and disk hits must not touch the kinematics
+    def fail(*args, **kwargs):
+        raise AssertionError("split plan was recomputed")
+    monkeypatch.setattr(dataset_utils, 'generate_train_test_split', fail)
+    memory_hit = dataset_utils.load_train_test_split(tmp_path, training_type='train_random')
+    dataset_utils._get_split_plan.cache_clear()
+    disk_hit = dataset_utils.load_train_test_split(tmp_path, training_type='train_random')
+    for result in [first, memory_hit, disk_hit]:
+        np.testing.assert_array_equal(result[0], expected[0])
+        np.testing.assert_array_equal(result[1], expected[1])
+        assert result[2] == expected[2] and result[3] == expected[3]
+    with pytest.raises(AssertionError, match="recomputed"):
+        dataset_utils.load_train_test_split(tmp_path, train_ratio=0.5)
+
+    # Rewriting the events replaces the plan of the same parameters instead of adding one
+    monkeypatch.undo()
+    with h5py.File(tmp_path / "events.h5", 'w') as f:
+        f['trial_start_idxs'], f['trial_stop_idxs'] = timestamps[starts][None], timestamps[starts + 70][None]
+    os.utime(tmp_path / "events.h5", ns=(0, 10 ** 18))
+    dataset_utils.load_train_test_split(tmp_path, training_type='train_random')
+    assert len(list((tmp_path / dataset_utils.SPLIT_PLAN_DIRNAME).glob("*.h5"))) == 1
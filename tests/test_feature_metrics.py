@@ -0,0 +1,70 @@
+import h5py
+import numpy as np
+import pytest
+
+from neural_feature_identification import feature_metrics
+
+
+@pytest.fixture
+def feature_matrix():
+    rng = np.random.default_rng(9)
+    kinematics = rng.standard_normal((3000, 3))
+    features = 1e3 + kinematics @ rng.standard_normal((3, 8)) + rng.standard_normal((3000, 8))
+    features[:, 6] = 5.0  # flat feature
+    return features, kinematics
+
+
+def test_chunked_correlation_matches_corrcoef(feature_matrix):
+    features, kinematics = feature_matrix
+    relevance_acc = feature_metrics.CorrelationAccumulator(8, 3)
+    redundancy_acc = feature_metrics.CorrelationAccumulator(8, 8)
+    for start in range(0, len(features), 700):
+        relevance_acc.update(features[start:start + 700], kinematics[start:start + 700])
+        redundancy_acc.update(features[start:start + 700])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        expected = np.nan_to_num(np.corrcoef(features, kinematics, rowvar=False))
+    np.testing.assert_allclose(relevance_acc.correlation(), expected[:8, 8:], atol=1e-10)
+    np.testing.assert_allclose(redundancy_acc.correlation(), expected[:8, :8], atol=1e-10)
+    np.testing.assert_allclose(
+        feature_metrics.compute_relevance(relevance_acc.correlation()), np.abs(expected[:8, 8:]).sum(axis=0) / 8)
+    assert feature_metrics.compute_redundancy(redundancy_acc.correlation()) == \
+        pytest.approx(np.abs(expected[:8, :8]).sum() / 64)
+
+
+def test_nan_masking_and_merge(feature_matrix):
+    features, kinematics = feature_matrix
+    features = features.copy()
+    features[np.random.default_rng(1).random(features.shape) < 0.05] = np.nan
+    first, second = feature_metrics.CorrelationAccumulator(8, 3), feature_metrics.CorrelationAccumulator(8, 3)
+    first.update(features[:1000], kinematics[:1000])
+    second.update(features[1000:], kinematics[1000:])
+    corr = first.merge(second).correlation()
+    for i in range(8):
+        valid = ~np.isnan(features[:, i])
+        for j in range(3):
+            expected = np.corrcoef(features[valid, i], kinematics[valid, j])[0, 1] if i != 6 else 0
+            assert corr[i, j] == pytest.approx(expected, abs=1e-10)
+
+
+def test_session_streaming(tmp_path, feature_matrix):
+    features, kinematics = feature_matrix
+    for session in ["1", "2"]:
+        (tmp_path / session / "features").mkdir(parents=True)
+        with h5py.File(tmp_path / session / "kinematics.h5", 'w') as f:
+            f['kinematics'] = kinematics.T
+        with h5py.File(tmp_path / session / "features" / "MAV.h5", 'w') as f:
+            f['features'] = features.T
+    idxs = np.arange(100, 2500)
+    relevance_acc, redundancy_acc = feature_metrics.accumulate_session_correlations(
+        tmp_path / "1", "MAV", sample_idxs=idxs, block_rows=512)
+    expected = feature_metrics.CorrelationAccumulator(8, 3).update(features[idxs], kinematics[idxs])
+    np.testing.assert_allclose(relevance_acc.correlation(), expected.correlation(), atol=1e-10)
+    assert redundancy_acc.correlation().shape == (8, 8)
+
+    cohort_relevance, _ = feature_metrics.compute_cohort_correlations(
+        [tmp_path / "1", tmp_path / "2"], "MAV", max_workers=2, redundancy=False)
+    np.testing.assert_array_equal(cohort_relevance.count, 2 * len(features))
+    expected = feature_metrics.CorrelationAccumulator(8, 3).update(features, kinematics)
+    np.testing.assert_allclose(cohort_relevance.correlation(), expected.correlation(), atol=1e-10)
+    with pytest.raises(ValueError):
+        feature_metrics.compute_cohort_correlations([], "MAV")
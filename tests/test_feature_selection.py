@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+from neural_feature_identification import feature_selection
+
+
+@pytest.fixture
+def selection_data():
+    rng = np.random.default_rng(8)
+    n_samples, n_dofs = 1500, 3
+    x = np.zeros((n_samples, n_dofs))
+    for dof in range(n_dofs):
+        x[200 * dof + 100:200 * dof + 250, dof] = 1
+        x[200 * dof + 800:200 * dof + 950, dof] = -1
+    sources = np.column_stack([np.clip(x, 0, None), np.clip(-x, 0, None)])
+    z = sources @ rng.uniform(-1, 1, (2 * n_dofs, 40)) + 0.5 * rng.standard_normal((n_samples, 40))
+    z[:, 5] = 0.01 * rng.standard_normal(n_samples)  # below the correlation threshold
+    return x, z
+
+
+def _gram_schmidt_reference(x, z, max_chans, threshold, sep_mvts, stop_crit):
+    """Line-by-line port of gramSchmDarpa_jag.m + corrChanSelZeroMeanDarpa_jag.m on (rows x samples) inputs"""
+    X, Z = x.T, z.T
+    Zc = Z - Z.mean(axis=1, keepdims=True)
+    sep_x = []
+    for i in range(X.shape[0]):
+        for part in [np.where(X[i] > 0, X[i], 0), np.where(X[i] < 0, np.abs(X[i]), 0)]:
+            if np.any(part):
+                sep_x.append(part)
+    sep_x = np.array(sep_x) - np.mean(sep_x, axis=1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rzx = np.abs(Zc @ sep_x.T / np.sqrt(np.outer(np.sum(Zc ** 2, 1), np.sum(sep_x ** 2, 1))))
+    rzx[np.isnan(rzx)] = 0
+    rzx[rzx < threshold] = 0
+    poss_chans = []
+    for i in range(rzx.shape[1]):
+        for j in np.argsort(-rzx[:, i], kind='stable'):
+            if rzx[j, i] != 0 and j not in poss_chans:
+                poss_chans.append(j)
+    poss_chans = np.array(poss_chans)
+
+    full_z = Z[poss_chans] - Z[poss_chans].mean(axis=1, keepdims=True)
+    Xc = X - X.mean(axis=1, keepdims=True)
+    full_x = [Xc[[i]] for i in range(len(Xc))] if sep_mvts else [Xc]
+    chans, losses = [], []
+    for fx in full_x:
+        mu, actives = np.zeros_like(fx), []
+        with np.errstate(invalid='ignore', divide='ignore'):
+            new_z = full_z / np.sqrt(np.sum(full_z ** 2, 1, keepdims=True))
+        n_steps = min(max_chans, len(poss_chans))
+        loss = np.zeros((len(fx), n_steps + 1))
+        for j in range(n_steps):
+            resid = fx - mu
+            loss[:, j] = feature_selection.stop_criterion(np.sum(resid ** 2, 1), resid.shape[1], j, stop_crit)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                corrs = new_z @ (resid / np.sqrt(np.sum(resid ** 2, 1, keepdims=True))).T
+            corrs[np.isnan(corrs)] = 0
+            order = np.argsort(-np.abs(corrs.T.ravel()), kind='stable') % len(poss_chans)
+            ind = next(i for i in order if i not in actives)
+            actives.append(ind)
+            temp = new_z[ind].copy()
+            mu = mu + np.outer(resid @ temp, temp)
+            new_z = new_z - np.outer(new_z @ temp, temp)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                new_z = new_z / np.sqrt(np.sum(new_z ** 2, 1, keepdims=True))
+            new_z[np.isnan(new_z)] = 0  # NaN rows only ever produce zero correlations
+            new_z[ind] = 0
+        resid = fx - mu
+        loss[:, -1] = feature_selection.stop_criterion(np.sum(resid ** 2, 1), resid.shape[1], n_steps, stop_crit)
+        chans.append(poss_chans[actives])
+        losses.append(loss)
+    return chans, losses
+
+
+@pytest.mark.parametrize('per_dof', [False, True])
+def test_gram_schmidt_matches_matlab(selection_data, per_dof):
+    x, z = selection_data
+    selected, losses = feature_selection.gram_schmidt_selection(
+        x, z, max_features=12, min_correlation=0.1, per_dof=per_dof, criterion='BIC')
+    expected, expected_losses = _gram_schmidt_reference(x, z, 12, 0.1, per_dof, 'BIC')
+    assert len(selected) == (x.shape[1] if per_dof else 1)
+    for chans, loss, expected_chans, expected_loss in zip(selected, losses, expected, expected_losses):
+        np.testing.assert_array_equal(chans, expected_chans)
+        np.testing.assert_allclose(loss, expected_loss, rtol=1e-9)
+        assert 0 <= feature_selection.best_feature_count(loss) <= 12
+
+
+def test_preselect_features_order():
+    correlations = np.array([[0.5, 0.0], [0.2, 0.9], [0.7, 0.4], [0.0, 0.0]])
+    np.testing.assert_array_equal(feature_selection.preselect_features(correlations, 0.3), [2, 0, 1])
+    np.testing.assert_array_equal(feature_selection.preselect_features(correlations, 0.0), [2, 0, 1])
@@ -0,0 +1,277 @@
+import itertools
+
+import h5py
+import numpy as np
+import pytest
+from scipy import signal
+
+from neural_feature_identification import dataset_utils, features
+
+
+def _find_spikes_loop(data, thresholds, previous_ts):
+    """Line-by-line port of findSpikesRealTimeMex.cpp"""
+    counts = np.zeros(data.shape[1])
+    new_previous_ts = np.zeros(data.shape[1])
+    for ch in range(data.shape[1]):
+        sample = int(previous_ts[ch] + 0.5)
+        while sample < len(data):
+            if thresholds[ch] < 0 and data[sample, ch] <= thresholds[ch] or \
+                    thresholds[ch] > 0 and data[sample, ch] >= thresholds[ch]:
+                counts[ch] += 1
+                new_previous_ts[ch] = max(sample + 52 - len(data), 0)
+                sample += 52
+            else:
+                sample += 1
+    return counts, new_previous_ts
+
+
+def test_detect_spikes_matches_realtime_loop(session):
+    neural_data, kdf_nip_time, _, _ = session
+    thresholds = np.array([-1.5, -2.0, 1.5, 0.0, -1.0, 2.0])
+    starts, stops = features.compute_loop_frames(kdf_nip_time, len(neural_data))
+    channels, frames = features.detect_spikes(neural_data, thresholds, starts, stops)
+    counts = np.zeros((len(starts), neural_data.shape[1]))
+    np.add.at(counts, (frames, channels), 1)
+
+    previous_ts = np.zeros(neural_data.shape[1])
+    for i, (start, stop) in enumerate(zip(starts, stops)):
+        expected, previous_ts = _find_spikes_loop(neural_data[start:stop], thresholds, previous_ts)
+        np.testing.assert_array_equal(counts[i], expected)
+
+
+def test_mav_matches_rolling_buffer_loop(session):
+    neural_data, kdf_nip_time, _, _ = session
+    abs_data = np.abs(neural_data)
+    mav = features.rolling_buffer_mav(abs_data, kdf_nip_time, initial_width=9)
+
+    # Port of the circshift buffer in makeRollingPowerFeatures_zmh
+    starts, stops = features.compute_loop_frames(kdf_nip_time, len(neural_data))
+    buffer = np.zeros((neural_data.shape[1], 9))
+    for i, (start, stop) in enumerate(zip(starts, stops)):
+        frame = abs_data[start:stop].T
+        buffer = np.roll(buffer, frame.shape[1], axis=1)
+        if frame.shape[1] > buffer.shape[1]:
+            buffer = np.zeros((buffer.shape[0], frame.shape[1]))
+        buffer[:, :frame.shape[1]] = frame
+        np.testing.assert_allclose(mav[i], buffer.mean(axis=1), rtol=1e-6)
+
+
+def test_sbp_matches_frame_loop(session):
+    neural_data, kdf_nip_time, _, _ = session
+    params = {'window_length_sec': 0.05, 'bpf_order': 2, 'hpf_cutoff_hz': 300, 'lpf_cutoff_hz': 1000}
+    sbp, _ = features.compute_sbp_features(neural_data, kdf_nip_time, params)
+
+    b, a = features.signal.butter(1, [300 / 15000, 1000 / 15000], 'bandpass')
+    data_2k = features.filtfilt_channels(b, a, neural_data)[::15]
+    for i, frame_idx in enumerate(range(0, len(data_2k), 66)):
+        window = data_2k[max(frame_idx - 99, 0):frame_idx + 1]
+        np.testing.assert_allclose(sbp[i], np.abs(window).sum(axis=0) / 100, rtol=1e-5)
+    assert sbp.shape == (len(kdf_nip_time), neural_data.shape[1])
+
+
+def test_sbp_car_matches_referencing_before_filtering(session):
+    neural_data, kdf_nip_time, _, _ = session
+    params = {'window_length_sec': 0.05, 'bpf_order': 2, 'hpf_cutoff_hz': 300, 'lpf_cutoff_hz': 1000}
+    for array_channels in [None, 3]:
+        car_params = {**params, 'car_array_channels': array_channels}
+        referenced = features.common_average_reference(neural_data.astype(np.float64), array_channels)
+        expected, _ = features.compute_sbp_features(referenced, kdf_nip_time, car_params)
+        intermediates = {}
+        raw, _ = features.compute_sbp_features(neural_data, kdf_nip_time, car_params, intermediates=intermediates)
+        car, _ = features.compute_sbp_features(neural_data, kdf_nip_time, car_params, car=True,
+                                               intermediates=intermediates)
+        np.testing.assert_allclose(car, expected, rtol=1e-5)
+        assert not np.allclose(car, raw)
+
+        streaming, streaming_referenced = (features.StreamingSBP(neural_data.shape[1], car_params, car=True),
+                                           features.StreamingSBP(neural_data.shape[1], car_params))
+        for start in range(0, 5000, 990):
+            np.testing.assert_allclose(streaming.process(neural_data[start:start + 990]),
+                                       streaming_referenced.process(referenced[start:start + 990]), atol=1e-12)
+    with pytest.raises(ValueError):
+        features.common_average_reference(np.zeros((4, 6)), 4)
+
+
+def test_feature_shapes(session):
+    params = {
+        'nfr': {'spike_threshold_std': -5},
+        'mav': {'window_length_sec': 0.3},
+        'dwt': {'frame_len': 1024, 'db1_name': 'db1', 'db4_name': 'db4', 'db1_levels': 10, 'db4_levels': 7},
+    }
+    neural_data, kdf_nip_time, baseline_data, baseline_nip_time = session
+    n_frames, n_chans = len(kdf_nip_time), neural_data.shape[1]
+    for feature_set_id, n_features in [('NFR', n_chans), ('MAV', n_chans), ('DWT-DB4', n_chans * 7)]:
+        feats, _ = features.extract_features(
+            feature_set_id, neural_data, kdf_nip_time, baseline_data, baseline_nip_time, params)
+        assert feats.shape == (n_frames, n_features)
+        assert np.all(np.isfinite(feats))
+
+
+def test_wavedec_matches_pywavelets():
+    pywt = pytest.importorskip('pywt')
+    x = np.random.default_rng(0).standard_normal((3, 1000))
+    for wavelet, levels in [('db1', 9), ('db4', 6)]:
+        details = features.wavedec_details(x, wavelet, levels)
+        expected = pywt.wavedec(x, wavelet, mode='symmetric', level=levels, axis=-1)[:0:-1]
+        for detail, expected_detail in zip(details, expected):
+            np.testing.assert_allclose(detail, expected_detail, atol=1e-10)
+
+
+def test_shared_dwt_levels_match_framewise(session):
+    neural_data, kdf_nip_time, baseline_data, _ = session
+    frame_stops = np.ceil(kdf_nip_time - kdf_nip_time[0]).astype(np.int64) + 1
+    for wavelet, levels, frame_len in [('db1', 8, 2048), ('db4', 6, 2048), ('db4', 4, 300)]:
+        thresholds = features.compute_dwt_thresholds(baseline_data, wavelet, levels)
+        expected = features.dwt_stream_energies(
+            neural_data, frame_stops, thresholds, wavelet, levels, frame_len, n_shared=0)
+        for n_shared in range(1, levels + 1):
+            feats = features.dwt_stream_energies(neural_data, frame_stops, thresholds, wavelet, levels, frame_len,
+                                                 n_shared=n_shared, block_frames=7, block_size=4)
+            np.testing.assert_allclose(feats, expected, rtol=1e-10, atol=1e-12)
+    assert features.plan_shared_dwt_levels(8192, 8, 10, frame_step=1000) == 3
+    assert features.plan_shared_dwt_levels(256, 8, 3, frame_step=1000) == 0
+
+
+def test_parity_report_flags_mismatch():
+    reference = np.random.default_rng(1).standard_normal((50, 4))
+    assert features.compare_feature_arrays(reference.copy(), reference)['passed']
+    report = features.compare_feature_arrays(reference + 1e-2, reference)
+    assert not report['passed']
+    assert report['max_abs_error'] == pytest.approx(1e-2)
+
+
+def test_extract_feature_sets_matches_single_sets(session):
+    params = {'nfr': {'spike_threshold_std': -3}, 'mav': {'window_length_sec': 0.3},
+              'sbp': {'window_length_sec': 0.05, 'bpf_order': 2, 'hpf_cutoff_hz': 300, 'lpf_cutoff_hz': 1000}}
+    results = {feature_set_id: feats for feature_set_id, feats, _ in features.extract_feature_sets(
+        ['SBP-RAW', 'NFR', 'MAV'], *session, params)}
+    assert list(results) == ['NFR', 'MAV', 'SBP-RAW']  # sets sharing intermediates run first
+    for feature_set_id, feats in results.items():
+        expected, _ = features.extract_features(feature_set_id, *session, params)
+        np.testing.assert_array_equal(feats, expected)
+
+
+def test_cached_baseline_stats_match_baseline(session, tmp_path):
+    neural_data, kdf_nip_time, baseline_data, baseline_nip_time = session
+    params = {'nfr': {'spike_threshold_std': -3}, 'mav': {'window_length_sec': 0.3},
+              'dwt': {'frame_len': 256, 'db1_name': 'db1', 'db1_levels': 4, 'db4_name': 'db4', 'db4_levels': 3}}
+    feature_set_ids = ['NFR', 'MAV', 'DWT-DB1', 'DWT-DB4']
+    stat_params = features.baseline_stat_params(feature_set_ids, params)
+    stats_filepath = tmp_path / features.BASELINE_STATS_FILENAME
+    features.write_baseline_stats(stats_filepath, features.compute_baseline_stats(
+        feature_set_ids, baseline_data, baseline_nip_time, params), stat_params)
+    cached = features.read_baseline_stats(stats_filepath, stat_params)
+    assert set(cached) == set(stat_params)
+    # Statistics computed with other parameters are not returned
+    assert 'nfr_baseline' not in features.read_baseline_stats(
+        stats_filepath, features.baseline_stat_params(['NFR'], {'nfr': {'spike_threshold_std': -4}}))
+
+    # The baseline recording is not needed once its statistics are cached
+    results = features.extract_feature_sets(feature_set_ids, neural_data, kdf_nip_time, None, None, params, cached)
+    for feature_set_id, feats, _ in results:
+        expected, _ = features.extract_features(feature_set_id, *session, params)
+        np.testing.assert_array_equal(feats, expected)
+
+
+def _loop_blocks(data, kdf_nip_time):
+    """Splits data into the samples received between consecutive KDF timestamps"""
+    kdf_idxs = np.ceil(kdf_nip_time - kdf_nip_time[0]).astype(np.int64)
+    return [data[start:stop] for start, stop in itertools.pairwise(kdf_idxs)]
+
+
+def test_streaming_spike_features_match_causal_offline(session):
+    neural_data, kdf_nip_time, _, _ = session
+    n_chans = neural_data.shape[1]
+    sos = signal.butter(features.SPIKE_HPF_ORDER, features.SPIKE_HPF_CUTOFF_HZ / (features.FS_NS5 / 2), 'high',
+                        output='sos')
+    filtered = signal.sosfilt(sos, neural_data, axis=0).astype(np.float32)
+    thresholds = np.full(n_chans, -2.0)
+    expected_nfr = features._smoothed_firing_rates(filtered, thresholds, kdf_nip_time)
+    expected_mav = features.rolling_buffer_mav(np.abs(filtered), kdf_nip_time, 9)
+
+    nfr = features.StreamingNFR(thresholds, np.zeros(n_chans))
+    mav = features.StreamingMAV(0.3, np.zeros(n_chans))
+    for i, block in enumerate(_loop_blocks(neural_data, kdf_nip_time)):
+        # Samples arriving in ~1 ms packets give the same frame as one block
+        for packet in np.array_split(block, 33):
+            nfr.push(packet)
+        np.testing.assert_allclose(nfr.frame(), expected_nfr[i], atol=1e-9)
+        np.testing.assert_allclose(mav.process(block), expected_mav[i], rtol=1e-5)
+
+    class PushOnly(features.StreamingExtractor):
+        def push(self, block):
+            pass
+    with pytest.raises(TypeError):
+        PushOnly()
+
+
+def test_streaming_dwt_and_sbp_match_offline(session):
+    neural_data, kdf_nip_time, baseline_data, _ = session
+    dwt_params = {'frame_len': 256, 'db4_name': 'db4', 'db4_levels': 3}
+    thresholds = features.compute_dwt_thresholds(baseline_data, 'db4', 3)
+    expected, _ = features.compute_dwt_features(neural_data, kdf_nip_time, baseline_data, dwt_params, 'db4')
+    dwt = features.StreamingDWT(thresholds, dwt_params, 'db4')
+    stops = np.ceil(kdf_nip_time - kdf_nip_time[0]).astype(np.int64) + 1
+    for i, (start, stop) in enumerate(zip(np.concatenate([[0], stops[:-1]]), stops)):
+        np.testing.assert_array_equal(dwt.process(neural_data[start:stop]), expected[i])
+
+    sbp_params = {'window_length_sec': 0.05, 'bpf_order': 2, 'hpf_cutoff_hz': 300, 'lpf_cutoff_hz': 1000}
+    sos = signal.butter(1, [300 / (features.FS_NS5 / 2), 1000 / (features.FS_NS5 / 2)], 'bandpass', output='sos')
+    data_2k = np.abs(signal.sosfilt(sos, neural_data, axis=0)[::features.SBP_DOWNSAMPLE_30KHZ_TO_2KHZ])
+    sbp = features.StreamingSBP(neural_data.shape[1], sbp_params)
+    frame_samples = features.SBP_DOWNSAMPLE_30KHZ_TO_2KHZ * features.SBP_DOWNSAMPLE_2KHZ_TO_30HZ
+    for i, stop in enumerate(range(1, len(neural_data), frame_samples)):
+        frame_features = sbp.process(neural_data[max(stop - frame_samples, 0):stop])
+        end = i * features.SBP_DOWNSAMPLE_2KHZ_TO_30HZ + 1
+        np.testing.assert_allclose(frame_features, data_2k[max(end - 100, 0):end].sum(axis=0) / 100)
+
+
+def test_benchmark_streaming_report():
+    blocks, baseline_data = features.make_benchmark_blocks(n_chans=4, n_frames=20)
+    params = {'nfr': {'spike_threshold_std': -3}, 'mav': {'window_length_sec': 0.3}}
+    baseline_nip_time = np.arange(0, len(baseline_data), 990.0)
+    stats = features.compute_baseline_stats(['NFR'], baseline_data, baseline_nip_time, params)
+    report = features.benchmark_streaming(features.make_streaming_extractor('NFR', 4, params, stats), blocks)
+    assert report['p50_ms'] <= report['p99_ms'] <= report['max_ms']
+    assert report['alloc_max_bytes'] > 0
+
+
+def test_window_means_do_not_depend_on_block_size():
+    rng = np.random.default_rng(3)
+    values = rng.random((5000, 3)).astype(np.float32)
+    ends = np.sort(rng.choice(5000, size=40, replace=False))
+    expected = np.array([values[max(end - 299, 0):end + 1].sum(axis=0) / 300 for end in ends])
+    np.testing.assert_allclose(features.windowed_means(values, ends, 300), expected, rtol=1e-6)
+    bounds = np.array([0, 1, 700, 701, 5000])
+    np.testing.assert_allclose(features.prefix_sums_at(values, bounds, block_rows=64),
+                               features.prefix_sums_at(values, bounds), rtol=1e-10)
+
+
+def test_feature_store_roundtrip_and_conversion(tmp_path):
+    rng = np.random.default_rng(8)
+    values = rng.standard_normal((500, 7)) * 40
+    values[3, 2] = np.nan
+    (tmp_path / "features").mkdir()
+    legacy_filepath = tmp_path / "features" / "MAV.h5"
+    with h5py.File(legacy_filepath, 'w') as f:
+        f['features'] = values.T
+        f['computation_times'] = np.ones((1, len(values)))
+    assert features.convert_feature_file(legacy_filepath)
+    assert not features.convert_feature_file(legacy_filepath)
+    assert dataset_utils.feature_store_version(legacy_filepath) == dataset_utils.FEATURE_STORE_VERSION
+    np.testing.assert_allclose(dataset_utils.read_feature_file(legacy_filepath), values, rtol=1e-6)
+
+    session_data = dataset_utils.load_session_data(
+        tmp_path, {'analysis': {'feature_sets': ['MAV']}}, events_flag=False, kinematics_flag=False)
+    dataset_utils.enforce_samples_as_rows(session_data)
+    assert session_data['mav']['features'].flags['C_CONTIGUOUS']
+    np.testing.assert_allclose(session_data['mav']['features'], values, rtol=1e-6)
+
+    quantized_filepath = tmp_path / "quantized.h5"
+    features.write_feature_file(quantized_filepath, values, np.zeros(len(values)), dtype='float16', chunk_rows=64)
+    lazy = dataset_utils.read_feature_file(quantized_filepath, lazy=True)
+    assert lazy.dtype == np.float32 and lazy.shape == values.shape
+    np.testing.assert_allclose(lazy[100:200], values[100:200], rtol=1e-3, atol=1e-3)
+    np.testing.assert_allclose(dataset_utils.read_feature_file(quantized_filepath), values, rtol=1e-3, atol=1e-3)
+    with pytest.raises(ValueError):
+        features.write_feature_file(quantized_filepath, values, np.zeros(len(values)), dtype='int8')
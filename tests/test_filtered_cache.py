@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+from neural_feature_identification import features, filtered_cache
+
+FEATURE_PARAMS = {
+    'sbp': {'window_length_sec': 0.05, 'bpf_order': 2, 'hpf_cutoff_hz': 300, 'lpf_cutoff_hz': 1000},
+    'mav': {'window_length_sec': 0.3},
+}
+
+
+@pytest.fixture
+def session(make_session):
+    return make_session(seed=11, n_chans=4, n_frames=40, n_baseline_frames=20)
+
+
+def test_window_sweep_from_cache_matches_extractors(session, tmp_path):
+    neural_data, kdf_nip_time, baseline_data, baseline_nip_time = session
+    paths = {stream: filtered_cache.filtered_cache_filepath(tmp_path, 'MAV', FEATURE_PARAMS, stream)
+             for stream in ['neural', 'baseline']}
+    paths['sbp'] = filtered_cache.filtered_cache_filepath(tmp_path, 'SBP', FEATURE_PARAMS)
+    filtered_cache.write_filtered_cache(paths['neural'], neural_data, 'MAV', FEATURE_PARAMS)
+    filtered_cache.write_filtered_cache(paths['baseline'], baseline_data, 'MAV', FEATURE_PARAMS)
+    filtered_cache.write_filtered_cache(paths['sbp'], neural_data, 'SBP', FEATURE_PARAMS)
+    mav_cache, baseline_cache, sbp_cache = (filtered_cache.open_filtered_cache(paths[key])
+                                            for key in ['neural', 'baseline', 'sbp'])
+
+    for window_length_sec in [0.05, 0.3]:
+        sbp_params = {**FEATURE_PARAMS['sbp'], 'window_length_sec': window_length_sec}
+        expected, _ = features.compute_sbp_features(neural_data, kdf_nip_time, sbp_params)
+        np.testing.assert_allclose(
+            features.sbp_from_rectified(sbp_cache, len(kdf_nip_time), window_length_sec), expected, rtol=1e-6)
+
+        expected, _ = features.compute_mav_features(*session, {'window_length_sec': window_length_sec})
+        np.testing.assert_allclose(filtered_cache.mav_from_cache(
+            mav_cache, kdf_nip_time, baseline_cache, baseline_nip_time, window_length_sec), expected, atol=1e-9)
+
+
+def test_float16_cache(session, tmp_path):
+    filepath = tmp_path / "sbp16.npy"
+    filtered_cache.write_filtered_cache(filepath, session[0], 'SBP', FEATURE_PARAMS, dtype='float16')
+    cache = filtered_cache.open_filtered_cache(filepath)
+    assert cache.dtype == np.float16 and cache.shape == (len(range(0, len(session[0]), 15)), 4)
+    expected, _ = features.compute_sbp_features(session[0], session[1], FEATURE_PARAMS['sbp'])
+    np.testing.assert_allclose(features.sbp_from_rectified(cache, len(session[1]), 0.05), expected, rtol=1e-2)
+    with pytest.raises(ValueError):
+        filtered_cache.write_filtered_cache(filepath, session[0], 'SBP', FEATURE_PARAMS, dtype='int16')
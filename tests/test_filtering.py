@@ -0,0 +1,49 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+from scipy import signal
+
+from neural_feature_identification import filtering
+
+LFP_SOS_FILEPATH = Path(__file__).parents[1] / "scripts" / "matlab" / "filter_params" / "lfpSOSfilter20180417.mat"
+
+
+@pytest.fixture
+def data():
+    return np.random.default_rng(7).standard_normal((20000, 5)).astype(np.float32)
+
+
+def test_blocked_filtfilt_matches_whole_array(data, tmp_path):
+    filters = [signal.butter(4, 750 / 15000, 'high', output='sos'),
+               signal.butter(1, [300 / 15000, 1000 / 15000], 'bandpass', output='sos'),
+               filtering.read_sos_mat(LFP_SOS_FILEPATH)]
+    for sos in filters:
+        padlen = filtering.filtfiltm_padlen(sos)
+        expected = signal.sosfiltfilt(sos, data.astype(np.float64), axis=0, padtype='odd', padlen=padlen)
+        for chunk_samples, decimate in [(997, 1), (4096, 15), (10 ** 6, 1)]:
+            out = np.empty((len(range(0, len(data), decimate)), data.shape[1]))
+            filtering.sosfiltfilt_blocks(sos, data, out=out, decimate=decimate, chunk_samples=chunk_samples,
+                                         block_size=2, n_threads=2)
+            np.testing.assert_allclose(out, expected[::decimate], atol=1e-9 * np.abs(expected).max())
+
+    cache = np.lib.format.open_memmap(tmp_path / "filtered.npy", mode='w+', dtype='float32', shape=data.shape)
+    filtering.sosfiltfilt_blocks(filters[0], data, out=cache, chunk_samples=3000)
+    np.testing.assert_allclose(cache, signal.sosfiltfilt(filters[0], data, axis=0, padlen=12), atol=1e-5)
+
+
+def test_causal_filter_carries_state(data):
+    sos = signal.butter(4, 750 / 15000, 'high', output='sos')
+    causal = filtering.SOSFilter(sos, data.shape[1])
+    chunks = [causal(data[start:start + 1234]) for start in range(0, len(data), 1234)]
+    np.testing.assert_allclose(np.concatenate(chunks), signal.sosfilt(sos, data, axis=0), atol=1e-12)
+
+
+def test_settling_samples():
+    sos = signal.butter(4, 750 / 15000, 'high', output='sos')
+    n_settle = filtering.settling_samples(sos, rtol=1e-6)
+    assert 0 < n_settle < filtering.settling_samples(sos, rtol=1e-12)
+    with pytest.raises(ValueError):
+        filtering.settling_samples(np.array([[1.0, 0, 0, 1, -2.0, 1.0]]))
+    with pytest.raises(ValueError):
+        filtering.sosfiltfilt_blocks(sos, np.zeros((5, 2)))
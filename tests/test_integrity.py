@@ -0,0 +1,61 @@
+import os
+
+import h5py
+import numpy as np
+import polars as pl
+
+from neural_feature_identification import features, integrity
+
+
+def _write_session(job_dirpath, n_samples):
+    (job_dirpath / "features").mkdir(parents=True)
+    with h5py.File(job_dirpath / "kinematics.h5", 'w') as f:
+        f['kinematics'] = np.zeros((12, n_samples))
+
+
+def test_scan_flags_bad_files_and_is_incremental(tmp_path):
+    rng = np.random.default_rng(9)
+    _write_session(tmp_path / "1", 300)
+    _write_session(tmp_path / "2", 300)
+    features.write_feature_file(tmp_path / "1" / "features" / "NFR.h5", rng.random((300, 4)), np.zeros(300))
+    features.write_feature_file(tmp_path / "1" / "features" / "MAV.h5", rng.random((250, 4)), np.zeros(250))
+    nan_features = rng.random((300, 4))
+    nan_features[100:, 1] = np.nan
+    features.write_feature_file(tmp_path / "2" / "features" / "NFR.h5", nan_features, np.zeros(300))
+    with h5py.File(tmp_path / "2" / "features" / "MAV.h5", 'w') as f:
+        f['features'] = rng.random((4, 300))
+    (tmp_path / "2" / "features" / "DWT-DB4.h5").write_bytes(b"not an hdf5 file")
+
+    index = integrity.scan_feature_files(tmp_path, max_workers=2, block_rows=64)
+    statuses = {os.path.relpath(path, tmp_path): status
+                for path, status in index.select(['path', 'status']).iter_rows()}
+    assert statuses == {os.path.join("1", "features", "MAV.h5"): 'shape_mismatch',
+                        os.path.join("1", "features", "NFR.h5"): 'ok',
+                        os.path.join("2", "features", "DWT-DB4.h5"): 'corrupt',
+                        os.path.join("2", "features", "MAV.h5"): 'missing_keys',
+                        os.path.join("2", "features", "NFR.h5"): 'non_finite'}
+    assert index.filter(pl.col('status') == 'non_finite')['nan_count'][0] == 200
+
+    # An unreadable kinematics.h5 is recorded for its feature files instead of aborting the scan
+    _write_session(tmp_path / "3", 300)
+    features.write_feature_file(tmp_path / "3" / "features" / "NFR.h5", rng.random((300, 4)), np.zeros(300))
+    (tmp_path / "3" / "kinematics.h5").write_bytes(b"truncated")
+    result = integrity.inspect_feature_file(tmp_path / "3" / "features" / "NFR.h5")
+    assert result['status'] == 'kinematics_error' and result['checksum']
+    (tmp_path / "3" / "kinematics.h5").unlink()
+    (tmp_path / "3" / "features" / "NFR.h5").unlink()
+
+    # Only new or changed files are re-inspected: a marked, unchanged row survives the rescan
+    index_filepath = tmp_path / integrity.INTEGRITY_INDEX_FILENAME
+    nfr_path = str(tmp_path / "1" / "features" / "NFR.h5")
+    index.with_columns(message=pl.when(pl.col('path') == nfr_path).then(pl.lit('kept'))
+                       .otherwise(pl.col('message'))).write_parquet(index_filepath)
+    features.write_feature_file(tmp_path / "1" / "features" / "MAV.h5", rng.random((300, 4)), np.zeros(300))
+    (tmp_path / "2" / "features" / "DWT-DB4.h5").unlink()
+    rescanned = integrity.scan_feature_files(tmp_path, max_workers=1)
+    assert len(rescanned) == 4
+    rows = {row[0]: row[1:] for row in rescanned.select(['path', 'status', 'message']).iter_rows()}
+    assert rows[nfr_path] == ('ok', 'kept')
+    assert rows[str(tmp_path / "1" / "features" / "MAV.h5")][0] == 'ok'
+    assert integrity.scan_feature_files(tmp_path, max_workers=1, full=True).filter(
+        pl.col('path') == nfr_path)['message'][0] == ''
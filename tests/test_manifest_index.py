@@ -0,0 +1,73 @@
+from pathlib import Path
+
+import yaml
+
+from neural_feature_identification import manifest_index
+
+ANNOTATIONS_FILEPATH = Path(__file__).parents[1] / "reports" / "manifest_annotations.yaml"
+
+
+def _classify_loop(kinematics):
+    """Per-job set logic of classify_bidir_indep_datasets in summarize_manifest_tsv.py"""
+    fingers = set(manifest_index.FINGERS_DOFS)
+    categories = []
+    if set(manifest_index.TASKA_8_DOFS).issubset(kinematics):
+        categories.append('8DOF-TASKA')
+    if set(manifest_index.DEKA_6_DOFS).issubset(kinematics):
+        categories.append('6DOF-DEKA')
+    if 'd10' in kinematics and 'd12' in kinematics and fingers.intersection(kinematics):
+        categories.append('3DOF-ETDRF')
+    if 'd12' in kinematics and fingers.intersection(kinematics):
+        categories.append('2DOF-ETDR')
+    if fingers.intersection(kinematics):
+        categories.append('1DOF-ETD')
+    return categories or ['OTHER']
+
+
+def test_categories_match_set_logic(tmp_path):
+    index_filepath = tmp_path / manifest_index.MANIFEST_INDEX_FILENAME
+    assert manifest_index.compile_manifest_index(ANNOTATIONS_FILEPATH, None, index_filepath)
+    assert not manifest_index.compile_manifest_index(ANNOTATIONS_FILEPATH, None, index_filepath)
+    with open(ANNOTATIONS_FILEPATH, 'r') as f:
+        annotations = yaml.safe_load(f)
+    for mode in manifest_index.KINEMATICS_MODES:
+        expected = {category: [] for category in manifest_index.DOF_CATEGORIES + ['OTHER']}
+        for job_id, job_data in sorted(annotations.items()):
+            kinematics = {name for name, info in job_data['kinematics'].items()
+                          if mode == 'all' or len(info['gestures']) >= 2 and
+                          (mode == 'bidirectional' or info['type'] == 'independent')}
+            for category in _classify_loop(kinematics):
+                expected[category].append(job_id)
+        assert manifest_index.category_job_ids(index_filepath, mode) == expected
+
+    summary = manifest_index.kinematics_summary(index_filepath)
+    n_independent_bidirectional = sum(
+        info['type'] == 'independent' and len(info['gestures']) >= 2
+        for job_data in annotations.values() for info in job_data['kinematics'].values())
+    assert summary['datasets']['Independent']['Bidirectional'] == n_independent_bidirectional
+
+
+def test_category_manifest(tmp_path):
+    annotations_filepath = tmp_path / "manifest_annotations.yaml"
+    annotations_filepath.write_text(yaml.safe_dump({
+        1: {'kinematics': {dof: {'type': 'independent', 'gestures': {'flexion': 5, 'extension': 4}}
+                           for dof in manifest_index.TASKA_8_DOFS}},
+        2: {'kinematics': {'d1': {'type': 'independent', 'gestures': {'flexion': 5}},
+                           'd12': {'type': 'independent', 'gestures': {'flexion': 5, 'extension': 5}}}},
+    }))
+    manifest_filepath = tmp_path / "manifest.tsv"
+    manifest_filepath.write_text("job_id\tparticipant_id\tsession_dir\n2\tP2\ta/b\n1\tP1\t\n")
+    index_filepath = tmp_path / manifest_index.MANIFEST_INDEX_FILENAME
+    manifest_index.compile_manifest_index(annotations_filepath, manifest_filepath, index_filepath)
+
+    taska = manifest_index.category_manifest(index_filepath, '8DOF-TASKA')
+    assert taska['job_id'].to_list() == ['1'] and taska['participant_id'].to_list() == ['P1']
+    assert manifest_index.category_manifest(index_filepath, '2DOF-ETDR', 'all')['job_id'].to_list() == ['2', '1']
+    assert manifest_index.category_manifest(index_filepath, 'OTHER')['job_id'].to_list() == ['2']
+    assert manifest_index.kinematics_summary(index_filepath)['trials']['Independent'] == {
+        'Unidirectional': 5, 'Bidirectional': 8 * 4 + 5}
+
+    # Editing the manifest triggers a rebuild
+    manifest_filepath.write_text("job_id\tparticipant_id\tsession_dir\n1\tP1\t\n")
+    assert manifest_index.compile_manifest_index(annotations_filepath, manifest_filepath, index_filepath)
+    assert manifest_index.category_manifest(index_filepath, '2DOF-ETDR', 'all')['job_id'].to_list() == ['1']
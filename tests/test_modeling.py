@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+from neural_feature_identification.modeling import predict, train
+
+
+@pytest.fixture
+def decoding_data():
+    rng = np.random.default_rng(4)
+    n_samples, n_dofs, n_features = 2000, 3, 10
+    x = np.cumsum(rng.standard_normal((n_samples, n_dofs)), axis=0) * 0.05
+    z = x @ rng.standard_normal((n_dofs, n_features)) + 0.3 * rng.standard_normal((n_samples, n_features))
+    return x, z
+
+
+def _kalman_train_reference(x, z):
+    """Line-by-line port of kalman_train.m on (features x samples) inputs"""
+    x, z = x.T, z.T
+    M = x.shape[1]
+    A = x[:, 1:] @ x[:, :-1].T @ np.linalg.pinv(x[:, :-1] @ x[:, :-1].T)
+    W = (x[:, 1:] @ x[:, 1:].T - A @ (x[:, :-1] @ x[:, 1:].T)) / (M - 1)
+    Pzx, Rxx, Rzz = z @ x.T, x @ x.T, z @ z.T
+    H = Pzx @ np.linalg.pinv(Rxx)
+    Q = (Rzz - H @ Pzx.T) / M
+    return {'A': A, 'W': W, 'H': H, 'Q': Q}
+
+
+def _kalman_test_reference(z, model, klim=None):
+    """Port of kalman_test.m, run over every sample"""
+    A, W, H, Q = model['A'], model['W'], model['H'], model['Q']
+    x_hat, P = np.zeros(len(A)), np.zeros_like(A)
+    out = []
+    for z_t in z:
+        xm, Pm = A @ x_hat, A @ P @ A.T + W
+        K = Pm @ H.T @ np.linalg.pinv(H @ Pm @ H.T + Q)
+        x_hat, P = xm + K @ (z_t - H @ xm), (np.eye(len(A)) - K @ H) @ Pm
+        if klim is not None:
+            x_hat = np.clip(x_hat, klim[:, 0], klim[:, 1])
+        out.append(x_hat)
+    return np.array(out)
+
+
+def _assert_models_close(model, expected):
+    for key in train.KALMAN_MODEL_KEYS:
+        np.testing.assert_allclose(model[key], expected[key], rtol=1e-8, atol=1e-10)
+
+
+def test_kalman_train_matches_matlab(decoding_data):
+    x, z = decoding_data
+    _assert_models_close(train.kalman_train(x, z), _kalman_train_reference(x, z))
+
+
+def test_fold_statistics_and_feature_subsets(decoding_data):
+    x, z = decoding_data
+    fold_ids = np.repeat(np.arange(2), len(x) // 2)
+    models = train.fit_kalman_folds(train.compute_fold_statistics(x, z, fold_ids))
+    # Transitions are only counted within a fold, so compare against a single contiguous fold
+    _assert_models_close(models[0], _kalman_train_reference(x[fold_ids != 0], z[fold_ids != 0]))
+    subset = [7, 2, 5]
+    _assert_models_close(train.select_kalman_features(models[0], subset),
+                         _kalman_train_reference(x[fold_ids != 0], z[fold_ids != 0][:, subset]))
+    for bad_fold_ids in [np.full(len(x), -1), np.zeros(0), fold_ids[1:]]:
+        with pytest.raises(ValueError):
+            train.compute_fold_statistics(x, z, bad_fold_ids)
+    with pytest.raises(ValueError):
+        train.compute_fold_statistics(x[:0], z[:0])
+
+
+@pytest.mark.parametrize('klim', [None, np.array([[-0.5, 0.5]] * 3)])
+def test_kalman_predict_matches_matlab(decoding_data, klim):
+    x, z = decoding_data
+    model = train.kalman_train(x, z)
+    expected = _kalman_test_reference(z, model, klim)
+    np.testing.assert_allclose(predict.kalman_predict(z, model, klim), expected, atol=1e-8)
+    np.testing.assert_allclose(predict.kalman_predict(z, model, klim, steady_state_tol=None), expected, atol=1e-10)
+    assert len(predict.compute_kalman_gains(model, len(z))) < len(z)
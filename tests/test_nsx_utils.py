@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+
+from neural_feature_identification import nsx_utils
+
+
+def _write_ns5(filepath, data, nip_start=1234, segments=None):
+    """Writes a minimal NEURALCD (v2.3) file with (samples x channels) int16 data"""
+    n_chans = data.shape[1]
+    with open(filepath, 'wb') as f:
+        f.write(b'NEURALCD')
+        np.array([2, 3], dtype='u1').tofile(f)
+        np.array([0], dtype='<u4').tofile(f)
+        f.write(b'30 kS/s'.ljust(16, b'\x00'))
+        f.write(b''.ljust(252, b'\x00'))
+        np.array([nip_start, 1, 30000], dtype='<u4').tofile(f)
+        np.zeros(8, dtype='<u2').tofile(f)
+        np.array([n_chans], dtype='<u4').tofile(f)
+        channels = np.zeros(n_chans, dtype=nsx_utils._CHANNEL_HEADER_DTYPE)
+        channels['MinDigVal'], channels['MaxDigVal'] = -32764, 32764
+        channels['MinAnlgVal'], channels['MaxAnlgVal'] = -8191, 8191
+        channels.tofile(f)
+        for segment in segments or [data]:
+            np.array([1], dtype='u1').tofile(f)
+            np.array([0, len(segment)], dtype='<u4').tofile(f)
+            segment.astype('<i2').tofile(f)
+
+
+@pytest.fixture
+def ns5_file(tmp_path):
+    data = np.random.default_rng(7).integers(-2000, 2000, size=(5000, 200)).astype(np.int16)
+    filepath = tmp_path / "20250101-120000-001.ns5"
+    _write_ns5(filepath, data)
+    return filepath, data
+
+
+def test_read_nsx_header(ns5_file):
+    filepath, data = ns5_file
+    header = nsx_utils.read_nsx_header(filepath)
+    assert header['NIPStart'] == 1234
+    assert header['ChannelCount'] == data.shape[1]
+    assert header['channel_samples'] == len(data)
+    assert nsx_utils.get_scaling_factor(header) == pytest.approx(8191 / 32764)
+
+
+def test_read_nsx_range_matches_raw_slice(ns5_file):
+    filepath, data = ns5_file
+    scaled = nsx_utils.read_nsx_range(filepath, (101, 4100), block_samples=700)
+    assert scaled.shape == (4000, nsx_utils.NUM_CHANS)
+    expected = data[100:4100, :nsx_utils.NUM_CHANS].astype(np.float32) * np.float32(8191 / 32764)
+    np.testing.assert_array_equal(scaled, expected)
+
+
+def test_iter_nsx_blocks_overlap(ns5_file):
+    filepath, _ = ns5_file
+    blocks = list(nsx_utils.iter_nsx_blocks(filepath, (1, 5000), block_samples=1000, overlap_samples=64))
+    assert [start for start, _ in blocks] == [0, 936, 1936, 2936, 3936]
+    assert len(blocks[0][1]) == 1000
+    assert all(len(block) == 1064 for _, block in blocks[1:])
+    np.testing.assert_array_equal(blocks[1][1][:64], blocks[0][1][-64:])
+
+
+def test_split_file_uses_last_segment(tmp_path):
+    data = np.arange(40, dtype=np.int16).reshape(10, 4)
+    filepath = tmp_path / "split.ns5"
+    _write_ns5(filepath, data, segments=[data[:1], data[1:]])
+    header = nsx_utils.read_nsx_header(filepath)
+    assert header['channel_samples'] == 9
+    np.testing.assert_array_equal(nsx_utils.open_nsx_data(filepath, header), data[1:])
+
+
+def test_read_kdf(tmp_path):
+    n_samples = 12
+    values = np.arange(n_samples * 6, dtype='<f4').reshape(n_samples, 6)
+    filepath = tmp_path / "BaselineData.kdf"
+    np.concatenate([np.array([1, 0, 3, 2, 0], dtype='<f4'), values.ravel()]).tofile(filepath)
+    kdf = nsx_utils.read_kdf(filepath)
+    np.testing.assert_array_equal(kdf['nip_time'][:, 0], values[:, 0])
+    np.testing.assert_array_equal(kdf['kinematics'], values[:, 1:4])
+    assert kdf['features'].shape == (n_samples, 0)
@@ -0,0 +1,85 @@
+import h5py
+import numpy as np
+import polars as pl
+import pytest
+
+from neural_feature_identification import resources
+
+GB = 1024 ** 3
+
+
+class _Wildcards(dict):
+    def __getattr__(self, name):
+        return self[name]
+
+
+def test_fit_coefficients_cover_observations():
+    input_gb = np.array([1.0, 2.0, 4.0, 8.0])
+    mem_mb = np.array([14000.0, 24000.0, 43000.0, 85000.0])
+    intercept, slope = resources.fit_coefficients(input_gb, mem_mb, headroom=1.0)
+    assert np.all(intercept + slope * input_gb >= mem_mb - 1e-6)
+    assert slope == pytest.approx(np.polyfit(input_gb, mem_mb, 1)[0])
+    # A single job or a constant input size gives a flat prediction
+    assert resources.fit_coefficients([3.0, 3.0], [10.0, 20.0], headroom=1.5) == [30.0, 0.0]
+
+
+def test_prediction_escalates_on_retries_and_falls_back():
+    job_sizes = {1: {'full_stream_filename': 2 * GB}, 2: {}}
+    coefficients = {'extract_features': {'DWT-DB4': {'mem_mb': [2000.0, 20000.0]},
+                                         '*': {'mem_mb': [1000.0, 5000.0], 'runtime_min': [10.0, 30.0]}}}
+    model = resources.ResourceModel(coefficients, job_sizes, max_mem_mb=100000, retry_escalation=2.0)
+
+    assert model.predict('extract_features', 1, 'DWT-DB4') == {'mem_mb': 42000, 'runtime_min': 70}
+    assert model.predict('extract_features', 1, 'MAV') == {'mem_mb': 11000, 'runtime_min': 70}
+    assert model.predict('extract_features', 1, 'DWT-DB4', attempt=2)['mem_mb'] == 84000
+    assert model.predict('extract_features', 1, 'DWT-DB4', attempt=3)['mem_mb'] == 100000
+    # Rules without fitted coefficients use the priors, jobs of unknown size the old fixed reservations (capped)
+    intercept, slope = resources.DEFAULT_COEFFICIENTS['detect_spikes']['mem_mb']
+    assert model.predict('detect_spikes', 1)['mem_mb'] == intercept + 2 * slope
+    assert model.predict('extract_features', 2) == {'mem_mb': 100000, 'runtime_min': 120}
+
+    wildcards = _Wildcards(job_id='1', feature_set='DWT-DB4')
+    assert model.mem_mb('extract_features')(wildcards, 2) == 84000
+    assert model.runtime('extract_features')(wildcards, 2) == 140
+    assert resources.format_slurm_time(25 * 60 + 0.5) == "1-01:01:00"
+    with pytest.raises(ValueError):
+        model.predict('unknown_rule', 1)
+
+
+def test_collect_and_fit_from_finished_jobs(tmp_path):
+    results_root, scratch_root = tmp_path / "reports", tmp_path / "scratch"
+    benchmark_dirpath = results_root / "benchmarks" / "extract_features"
+    benchmark_dirpath.mkdir(parents=True)
+    log_dirpath = results_root / "logs" / "extract_features"
+    log_dirpath.mkdir(parents=True)
+    header = "s\th:m:s\tmax_rss\tmax_vms\tmax_uss\tmax_pss\tio_in\tio_out\tmean_load\tcpu_time\n"
+    job_sizes = {}
+    for job_id in range(1, 5):
+        job_sizes[job_id] = {'full_stream_filename': job_id * GB}
+        (benchmark_dirpath / f"{job_id}_NFR.tsv").write_text(
+            header + f"{600 * job_id}\t0:10:00\t{3000 + 2000 * job_id}\t0\t0\t0\t0\t0\t0\t0\n")
+    # Runtime from the MATLAB log when the benchmark has none, else from the feature file
+    (benchmark_dirpath / "1_MAV.tsv").write_text(header + "NA\tNA\t5000\tNA\tNA\tNA\tNA\tNA\tNA\tNA\n")
+    (log_dirpath / "1_MAV.log").write_text("[...] [INFO] - Feature extraction process finished. | "
+                                           "total_duration_sec=120\n")
+    (log_dirpath / "1_session.log").write_text("total_duration_sec=999\n")
+    (scratch_root / "2" / "features").mkdir(parents=True)
+    with h5py.File(scratch_root / "2" / "features" / "MAV.h5", 'w') as f:
+        f.create_dataset('computation_times', data=np.full((1, 100), 0.6))
+
+    observations = resources.collect_observations(results_root, scratch_root)
+    mav = observations.filter(pl.col('feature_set') == 'MAV').sort('job_id')
+    assert mav['runtime_min'].to_list() == pytest.approx([2.0, 1.0])
+    assert mav['source'].to_list() == ['benchmark+log', 'computation_times']
+    assert len(observations.filter(pl.col('feature_set') == 'NFR')) == 4
+
+    coefficients = resources.fit_resource_model(observations, job_sizes, min_observations=3, headroom=1.0)
+    assert coefficients['extract_features']['NFR']['mem_mb'] == pytest.approx([3000.0, 2000.0])
+    assert coefficients['extract_features']['NFR']['runtime_min'] == pytest.approx([0.0, 10.0])
+    assert 'MAV' not in coefficients['extract_features']
+    assert coefficients['extract_features']['*']['n_mem_mb'] == 5
+
+    model_filepath = tmp_path / resources.RESOURCE_MODEL_FILENAME
+    resources.ResourceModel(coefficients).save(model_filepath)
+    model = resources.ResourceModel.load(model_filepath, job_sizes)
+    assert model.predict('extract_features', 4, 'NFR') == {'mem_mb': 11000, 'runtime_min': 40}
@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from neural_feature_identification.session_clock import SessionClock
+
+
+@pytest.fixture
+def clock():
+    clock = SessionClock(nip_offset=1234.0)
+    clock.add_nsx_stream('ns5', 30_000)
+    clock.add_nsx_stream('ns2', 1_000)
+    jitter = np.random.default_rng(3).integers(-30, 30, 200)
+    clock.add_timestamps('kdf', 5000 + np.arange(200) * 1000 + jitter)
+    return clock
+
+
+def test_regular_streams_match_searchsorted(clock):
+    ns5_nip_time = clock.to_nip('ns5', np.arange(300_000))
+    # read_nsx_range(t + nip_offset) reads 1-based sample t + nip_offset, i.e. 0-based index t + nip_offset - 1
+    assert ns5_nip_time[0] == 1 - clock.nip_offset
+    query = np.random.default_rng(5).uniform(ns5_nip_time[0] - 10, ns5_nip_time[-1], 1000)
+    query[:10] = ns5_nip_time[100:110]  # exact hits
+    for side in ['left', 'right']:
+        np.testing.assert_array_equal(clock.to_index('ns5', query, side),
+                                      np.searchsorted(ns5_nip_time, query, side=side))
+    ns2_nip_time = clock.to_nip('ns2', np.arange(10_000))
+    np.testing.assert_array_equal(clock.to_index('ns2', query), np.searchsorted(ns2_nip_time, query))
+    np.testing.assert_array_equal(clock.convert(np.arange(100), 'ns2', 'ns5'), 29 + 30 * np.arange(100))
+
+
+def test_timestamp_streams(clock):
+    kdf_nip_time = clock.timestamps['kdf']
+    query = np.array([kdf_nip_time[3], kdf_nip_time[3] + 1, kdf_nip_time[10] - 1])
+    np.testing.assert_array_equal(clock.to_index('kdf', query), [3, 4, 10])
+    np.testing.assert_array_equal(clock.to_index('kdf', query, 'nearest'), [3, 3, 10])
+    first, last = clock.nsx_range(kdf_nip_time[0], kdf_nip_time[-1])
+    assert clock.to_index('ns5', kdf_nip_time[0]) == first - 1 and last == kdf_nip_time[-1] + clock.nip_offset
+
+    clock.add_timestamps('baseline_kdf', 100 + 1000.0 * np.arange(50))
+    assert clock.regular['baseline_kdf'] == (100.0, 1000.0)
+    with pytest.raises(ValueError):
+        clock.add_timestamps('unsorted', [3, 2, 1])
+    with pytest.raises(ValueError):
+        clock.to_index('ns3', 0)
+
+
+def test_save_load(clock, tmp_path):
+    filepath = tmp_path / "job" / "session_clock.h5"
+    clock.save(filepath)
+    loaded = SessionClock.load(filepath)
+    assert loaded.nip_offset == clock.nip_offset and loaded.regular == clock.regular
+    np.testing.assert_array_equal(loaded.timestamps['kdf'], clock.timestamps['kdf'])
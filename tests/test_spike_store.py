@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+from neural_feature_identification import features, spike_store
+
+
+@pytest.fixture
+def session(make_session):
+    return make_session(seed=7, n_chans=5, n_frames=50, n_baseline_frames=30)
+
+
+def _build_store(session, detection_threshold_std):
+    neural_data, kdf_nip_time, baseline_data, baseline_nip_time = session
+    neural_filtered = features.spike_highpass(neural_data)
+    return {
+        'neural': spike_store.build_spike_stream(
+            neural_filtered, np.std(neural_filtered, axis=0, ddof=1, dtype=np.float64), kdf_nip_time,
+            detection_threshold_std),
+        'baseline': spike_store.build_spike_stream(
+            features.spike_highpass(baseline_data), np.std(baseline_data, axis=0, ddof=1, dtype=np.float64),
+            baseline_nip_time, detection_threshold_std),
+    }
+
+
+def test_rebinned_nfr_matches_offline(session, tmp_path):
+    store_filepath = tmp_path / spike_store.SPIKE_STORE_FILENAME
+    spike_store.write_spike_store(store_filepath, _build_store(session, -1.5))
+    store = spike_store.read_spike_store(store_filepath)
+    for threshold_std in [-1.5, -2.0, 2.5]:
+        expected, _ = features.compute_nfr_features(*session, {'spike_threshold_std': threshold_std})
+        np.testing.assert_allclose(spike_store.compute_nfr_from_spike_store(store, threshold_std), expected)
+    with pytest.raises(ValueError):
+        spike_store.compute_nfr_from_spike_store(store, -1.0)
+
+
+def test_uniform_bins_match_detect_spikes(session):
+    store = _build_store(session, -2.0)
+    neural_filtered = features.spike_highpass(session[0])
+    thresholds = store['neural']['noise_std'] * -2.0
+    starts = np.arange(0, len(neural_filtered) - 600 + 1, 600)
+    channels, frames = features.detect_spikes(neural_filtered, thresholds, starts, starts + 600)
+    expected = features.binned_firing_rates(channels, frames, len(starts), neural_filtered.shape[1], 0.02)
+    np.testing.assert_allclose(spike_store.spike_stream_rates(store['neural'], -2.0, bin_width_sec=0.02), expected)
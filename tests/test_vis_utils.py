@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('altair')
+from neural_feature_identification import vis_utils
+
+
+def test_make_tidy_norm_bins_and_subsamples():
+    rng = np.random.default_rng(0)
+    n_samples = 1000
+    session_data = {
+        'kinematics': {'kinematics': rng.standard_normal((n_samples, 2)),
+                       'nip_time': np.arange(n_samples, dtype=np.float64).reshape(-1, 1) * 10},
+        'nfr': {'features': rng.random((n_samples, 3))},
+        'dwt-db4': {'features': rng.random((n_samples, 40))},
+    }
+    project_config = {'analysis': {'feature_sets': ['NFR', 'DWT-DB4']},
+                      'vis': {'num_of_x_points': 10, 'dwt_subsample_count': 8}}
+    tidy_df = vis_utils.make_tidy_norm(session_data, project_config)
+
+    # 9990 time units / 10 points -> bins of 999 units (~100 samples)
+    kinematics = tidy_df.filter(tidy_df['feature_id'] == 'kinematics_2')
+    bins = np.arange(n_samples) * 10 // 999
+    expected = [session_data['kinematics']['kinematics'][bins == b, 1].mean() for b in np.unique(bins)]
+    np.testing.assert_allclose(kinematics['value'].to_numpy(), expected)
+
+    nfr = tidy_df.filter(tidy_df['feature_type'] == 'NFR')['value'].to_numpy()
+    assert nfr.min() == 0 and nfr.max() <= 1
+    assert tidy_df.filter(tidy_df['feature_type'] == 'DWT-DB4')['feature_id'].n_unique() == 8
@@ -0,0 +1,35 @@
+rule compute_baseline_stats:
+    """
+    For each job_id, compute the baseline-derived quantities of the feature extractors (noise std, NFR/MAV
+    baseline levels, DWT thresholds) once and store them in baseline_stats.h5 next to kinematics.h5.
+    Feature extraction then reads these instead of re-reading and re-filtering the baseline NS5 range.
+    """
+    output:
+        baseline_stats=f"{SCRATCH_ROOT}/{{job_id}}/baseline_stats.h5"
+    input:
+        session_clock=f"{SCRATCH_ROOT}/{{job_id}}/session_clock.h5",
+        config_yaml="config.yaml"
+    log:
+        f"{RESULTS_ROOT}/logs/baseline_stats/{{job_id}}.log"
+    benchmark:
+        f"{RESULTS_ROOT}/benchmarks/compute_baseline_stats/{{job_id}}.tsv"
+    params:
+        job_info=lambda wildcards: manifest.loc[int(wildcards.job_id)],
+        feature_sets=",".join(FEATURE_SETS)
+    threads: 4
+    resources:
+      mem_mb=RESOURCE_MODEL.mem_mb("compute_baseline_stats"),
+      runtime=RESOURCE_MODEL.runtime("compute_baseline_stats"),
+      slurm_account="george",
+      slurm_partition="kingspeak"
+    shell:
+        r"""
+        mkdir -p $(dirname {output.baseline_stats})
+        mkdir -p $(dirname {log})
+
+        python -m neural_feature_identification.features baseline-stats \
+            "{DATA_ROOT}" "{params.job_info.session_dir}" "{params.job_info.full_stream_filename}" \
+            "{params.job_info.baseline_filename}" "{params.feature_sets}" "{output.baseline_stats}" \
+            --config-filepath "{input.config_yaml}" \
+            --session-clock-filepath "{input.session_clock}" > {log} 2>&1
+        """
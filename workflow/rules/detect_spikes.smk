@@ -0,0 +1,32 @@
+rule detect_spikes:
+    """
+    For each job_id, store every sample of the high-passed training and baseline data beyond the detection
+    threshold in spikes.h5 (CSR layout). NFR at any stricter threshold or bin width is then re-binned from
+    this file with `python -m neural_feature_identification.spike_store rebin`, without the raw NS5.
+    """
+    output:
+        spikes=f"{SCRATCH_ROOT}/{{job_id}}/spikes.h5"
+    input:
+        kinematics=f"{SCRATCH_ROOT}/{{job_id}}/kinematics.h5",
+        session_clock=f"{SCRATCH_ROOT}/{{job_id}}/session_clock.h5"
+    log:
+        f"{RESULTS_ROOT}/logs/detect_spikes/{{job_id}}.log"
+    benchmark:
+        f"{RESULTS_ROOT}/benchmarks/detect_spikes/{{job_id}}.tsv"
+    params:
+        job_info=lambda wildcards: manifest.loc[int(wildcards.job_id)]
+    threads: 4
+    resources:
+      mem_mb=RESOURCE_MODEL.mem_mb("detect_spikes"),
+      runtime=RESOURCE_MODEL.runtime("detect_spikes"),
+      slurm_account="george",
+      slurm_partition="kingspeak"
+    shell:
+        r"""
+        mkdir -p $(dirname {log})
+
+        python -m neural_feature_identification.spike_store detect \
+            "{DATA_ROOT}" "{params.job_info.session_dir}" "{params.job_info.full_stream_filename}" \
+            "{params.job_info.baseline_filename}" "{input.kinematics}" "{output.spikes}" \
+            --session-clock-filepath "{input.session_clock}" > {log} 2>&1
+        """
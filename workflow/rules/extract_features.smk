@@ -11,13 +11,15 @@ rule extract_features:
         config_json="workflow/matlab_config.json"
     log:
         f"{RESULTS_ROOT}/logs/extract_features/{{job_id}}_{{feature_set}}.log"
+    benchmark:
+        f"{RESULTS_ROOT}/benchmarks/extract_features/{{job_id}}_{{feature_set}}.tsv"
     params:
         job_info=lambda wildcards: manifest.loc[int(wildcards.job_id)],
         data_root=DATA_ROOT
     threads: 8
     resources:
-      mem_mb=120000,
-      time="02:00:00",
+      mem_mb=RESOURCE_MODEL.mem_mb("extract_features"),
+      runtime=RESOURCE_MODEL.runtime("extract_features"),
       slurm_account="george",
       slurm_partition="kingspeak"
     shell:
@@ -0,0 +1,41 @@
+rule extract_features_session:
+    """
+    For each job_id, extract every feature set in one Python process. The raw NS5 ranges and the D2A
+    scaling are loaded once and intermediates are shared between feature sets. The NIP offset comes from
+    session_clock.h5 and baseline statistics from baseline_stats.h5, so the baseline NS5 range is not read.
+    Used instead of extract_features when workflow.extraction_mode is "per_session".
+    """
+    output:
+        h5=expand(SCRATCH_ROOT + "/{{job_id}}/features/{feature_set}.h5", feature_set=FEATURE_SETS)
+    input:
+        kinematics=f"{SCRATCH_ROOT}/{{job_id}}/kinematics.h5",
+        events=f"{SCRATCH_ROOT}/{{job_id}}/events.h5",
+        baseline_stats=f"{SCRATCH_ROOT}/{{job_id}}/baseline_stats.h5",
+        session_clock=f"{SCRATCH_ROOT}/{{job_id}}/session_clock.h5",
+        config_yaml="config.yaml"
+    log:
+        f"{RESULTS_ROOT}/logs/extract_features/{{job_id}}_session.log"
+    benchmark:
+        f"{RESULTS_ROOT}/benchmarks/extract_features_session/{{job_id}}.tsv"
+    params:
+        job_info=lambda wildcards: manifest.loc[int(wildcards.job_id)],
+        feature_sets=",".join(FEATURE_SETS),
+        output_dir=lambda wildcards: f"{SCRATCH_ROOT}/{wildcards.job_id}/features"
+    threads: 8
+    resources:
+      mem_mb=RESOURCE_MODEL.mem_mb("extract_features_session"),
+      runtime=RESOURCE_MODEL.runtime("extract_features_session"),
+      slurm_account="george",
+      slurm_partition="kingspeak"
+    shell:
+        r"""
+        mkdir -p {params.output_dir}
+        mkdir -p $(dirname {log})
+
+        python -m neural_feature_identification.features extract-sets \
+            "{DATA_ROOT}" "{params.job_info.session_dir}" "{params.job_info.full_stream_filename}" \
+            "{params.job_info.baseline_filename}" "{input.kinematics}" "{params.feature_sets}" \
+            "{params.output_dir}" --config-filepath "{input.config_yaml}" \
+            --baseline-stats-filepath "{input.baseline_stats}" \
+            --session-clock-filepath "{input.session_clock}" > {log} 2>&1
+        """
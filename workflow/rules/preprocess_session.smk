@@ -8,12 +8,15 @@ rule preprocess_session:
         events=f"{SCRATCH_ROOT}/{{job_id}}/events.h5"
     log:
         f"{RESULTS_ROOT}/logs/preprocess_session/{{job_id}}.log"
+    benchmark:
+        f"{RESULTS_ROOT}/benchmarks/preprocess_session/{{job_id}}.tsv"
     params:
         job_info=lambda wildcards: manifest.loc[int(wildcards.job_id)],
     threads: 1
+    group: "session_batch"
     resources:
-        mem_mb=4000,
-        time="01:00:00",
+        mem_mb=RESOURCE_MODEL.mem_mb("preprocess_session"),
+        runtime=RESOURCE_MODEL.runtime("preprocess_session"),
         slurm_account="george",
         slurm_partition="kingspeak"
     shell:
@@ -0,0 +1,31 @@
+rule session_clock:
+    """
+    For each job_id, compute the NIP offset between the NSx and KDF clocks once (the only read of the NS2
+    header and RecStart file) and store it with the stream rates and KDF timestamps in session_clock.h5.
+    Later stages take the offset from this file instead of re-reading the session.
+    """
+    output:
+        session_clock=f"{SCRATCH_ROOT}/{{job_id}}/session_clock.h5"
+    input:
+        kinematics=f"{SCRATCH_ROOT}/{{job_id}}/kinematics.h5"
+    log:
+        f"{RESULTS_ROOT}/logs/session_clock/{{job_id}}.log"
+    benchmark:
+        f"{RESULTS_ROOT}/benchmarks/session_clock/{{job_id}}.tsv"
+    params:
+        job_info=lambda wildcards: manifest.loc[int(wildcards.job_id)]
+    threads: 1
+    group: "session_batch"
+    resources:
+        mem_mb=RESOURCE_MODEL.mem_mb("session_clock"),
+        runtime=RESOURCE_MODEL.runtime("session_clock"),
+        slurm_account="george",
+        slurm_partition="kingspeak"
+    shell:
+        r"""
+        mkdir -p $(dirname {log})
+
+        python -m neural_feature_identification.session_clock build \
+            "{DATA_ROOT}" "{params.job_info.session_dir}" "{params.job_info.full_stream_filename}" \
+            "{params.job_info.baseline_filename}" "{input.kinematics}" "{output.session_clock}" > {log} 2>&1
+        """